@@ -0,0 +1,50 @@
+import os
+from ultralytics import YOLO
+
+# Backends de inferencia disponibles: nombre -> sufijo del archivo de modelo.
+# Los archivos .onnx se generan a partir del .pt con 'exportar_modelos.py'.
+BACKENDS = {
+    "pytorch": ".pt",
+    "onnx": ".onnx",
+    "onnx_int8": "_int8.onnx",
+}
+
+def ruta_modelo_backend(ruta_pt, backend):
+    """Devuelve la ruta del archivo de modelo que corresponde a un backend."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend de inferencia desconocido: '{backend}'. Opciones: {', '.join(BACKENDS)}")
+    base, _ = os.path.splitext(ruta_pt)
+    return base + BACKENDS[backend]
+
+def _cargar_pytorch(ruta_modelo):
+    return YOLO(ruta_modelo, task="detect")
+
+def _cargar_onnx(ruta_modelo):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("El backend ONNX requiere el paquete 'onnxruntime' (pip install onnxruntime).")
+    # YOLO ejecuta el grafo con onnxruntime pero conserva el mismo preprocesado,
+    # el mismo NMS (conf/iou) y los nombres de clase guardados en los metadatos del .onnx
+    return YOLO(ruta_modelo, task="detect")
+
+_CARGADORES = {
+    "pytorch": _cargar_pytorch,
+    "onnx": _cargar_onnx,
+    "onnx_int8": _cargar_onnx,
+}
+
+def cargar_modelo(ruta_modelo, backend):
+    """Carga el modelo con el cargador del backend indicado."""
+    return _CARGADORES[backend](ruta_modelo)
+
+def verificar_nombres_clases(model, herramientas_esperadas):
+    """
+    Comprueba que el modelo conoce todas las herramientas del inventario.
+    Un .onnx exportado sin metadatos devuelve nombres genericos ('class0', ...).
+    """
+    nombres = set(model.names.values())
+    faltantes = [h for h in herramientas_esperadas if h not in nombres]
+    if faltantes:
+        print(f"ADVERTENCIA: El modelo no contiene las clases: {', '.join(faltantes)}. Revisa la exportacion del modelo.")
+    return not faltantes
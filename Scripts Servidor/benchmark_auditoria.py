@@ -0,0 +1,340 @@
+"""
+Benchmark reproducible de la auditoria de bandejas:
+
+    python benchmark_auditoria.py --imagenes fotos/                       # pipeline por etapas, backend por defecto
+    python benchmark_auditoria.py --imagenes fotos/ --backend pytorch onnx onnx_int8
+    python benchmark_auditoria.py --imagenes fotos/ --flujo --concurrencia 4
+    python benchmark_auditoria.py --imagenes fotos/ --referencia anterior.json
+
+La carpeta de imagenes puede tener subcarpetas '1' y '2' (o 'bandeja_1', 'bandeja_2')
+para indicar la bandeja de cada foto; si no, se usa --bandeja.
+Mide imagenes/s, latencia por etapa (carga, decodificacion, inferencia,
+comparacion, persistencia), RSS maximo y tiempos del modelo en frio y en caliente.
+Con --flujo ejecuta ademas la maquina de estados de handle_photo del servidor con
+Telegram y MongoDB simulados. Los resultados se guardan en JSON (--salida) y con
+--referencia se comparan contra un resultado anterior para detectar regresiones.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+import platform
+import datetime
+import resource
+import tempfile
+import backends_inferencia
+import preprocesamiento
+import reconocimiento_de_objetos as reconocimiento
+from cache_inferencia import CacheInferencia
+from diario_incidencias import DiarioIncidencias
+
+ETAPAS = ["carga", "decodificacion", "inferencia", "comparacion", "persistencia"]
+
+# --- Utilidades ---
+def cargar_corpus(carpeta, bandeja_por_defecto):
+    """Devuelve [(ruta, bandeja_id)] ordenado, para que cada ejecucion use el mismo orden."""
+    corpus = []
+    for ruta in sorted(glob.glob(os.path.join(carpeta, "**", "*.jp*g"), recursive=True)):
+        subcarpeta = os.path.basename(os.path.dirname(ruta)).lower().replace("bandeja_", "")
+        corpus.append((ruta, subcarpeta if subcarpeta in ("1", "2") else str(bandeja_por_defecto)))
+    if not corpus:
+        raise SystemExit(f"No hay imagenes .jpg en '{carpeta}'.")
+    return corpus
+
+def resumen(muestras_ms):
+    """p50/p95/p99, promedio y maximo de una lista de tiempos en ms."""
+    if not muestras_ms:
+        return {"n": 0}
+    ordenadas = sorted(muestras_ms)
+    def p(q):
+        return round(ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * q))], 2)
+    return {"n": len(ordenadas), "p50_ms": p(0.5), "p95_ms": p(0.95), "p99_ms": p(0.99),
+            "promedio_ms": round(sum(ordenadas) / len(ordenadas), 2), "max_ms": round(ordenadas[-1], 2)}
+
+def rss_maximo_mb():
+    """RSS maximo del proceso y de sus hijos (workers del pool), en MB (Linux: ru_maxrss en KB)."""
+    factor = 1 / 1024 if sys.platform != "darwin" else 1 / (1024 * 1024)
+    return {
+        "proceso_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * factor, 1),
+        "hijos_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * factor, 1),
+    }
+
+def _ms(inicio):
+    return (time.perf_counter() - inicio) * 1000
+
+# --- Pipeline por etapas (en este proceso) ---
+def medir_pipeline(corpus, backend, repeticiones):
+    reconocimiento.configurar_backend(backend)
+    ruta_modelo = reconocimiento.ruta_modelo_activo()
+    if not os.path.exists(ruta_modelo):
+        print(f"[{backend}] No existe '{ruta_modelo}', se omite.")
+        return None
+
+    # Frio: carga + calentamiento del modelo, y la primera inferencia real
+    reconocimiento._modelos_cargados.clear()
+    inicio = time.perf_counter()
+    model = reconocimiento.obtener_modelo()
+    carga_modelo_ms = _ms(inicio)
+
+    cache = CacheInferencia(capacidad=len(corpus)) # Solo memoria, como la cache del servidor entre guardados
+    tiempos = {etapa: [] for etapa in ETAPAS}
+    totales = []
+    primera_inferencia_ms = None
+    # Persistencia real: cada reporte se agrega al diario de incidencias (en un archivo temporal)
+    # con su fsync, como en el peor caso del servidor, cuando no hay otras incidencias con que agruparlo
+    carpeta_diario = tempfile.TemporaryDirectory()
+    diario = DiarioIncidencias(None, ruta_archivo=os.path.join(carpeta_diario.name, "diario_incidencias.jsonl"))
+    archivo_diario = open(diario.ruta_archivo, "ab")
+    inicio_total = time.perf_counter()
+    try:
+        for repeticion in range(repeticiones):
+            for ruta, bandeja_id in corpus:
+                inicio_imagen = time.perf_counter()
+
+                inicio = time.perf_counter()
+                with open(ruta, 'rb') as f:
+                    datos = f.read()
+                tiempos["carga"].append(_ms(inicio))
+
+                inicio = time.perf_counter()
+                entrada, transformacion = preprocesamiento.preparar_imagen(datos, reconocimiento.ROI_BANDEJAS.get(bandeja_id))
+                tiempos["decodificacion"].append(_ms(inicio))
+
+                inicio = time.perf_counter()
+                resultado = model(entrada, conf=reconocimiento.CONFIANZA_MINIMA, iou=reconocimiento.IOU_NMS,
+                                  imgsz=preprocesamiento.TAMANO_ENTRADA, verbose=False)[0]
+                inferencia_ms = _ms(inicio)
+                if primera_inferencia_ms is None:
+                    primera_inferencia_ms = inferencia_ms
+                tiempos["inferencia"].append(inferencia_ms)
+
+                inicio = time.perf_counter()
+                reporte, _ = reconocimiento._generar_reporte(model, resultado, transformacion, datos, bandeja_id, False)
+                detectadas = set(reporte["herramientas_detectadas"])
+                ideal = set(reporte["inventario_ideal"])
+                faltantes, sobrantes = ideal - detectadas, detectadas - ideal
+                tiempos["comparacion"].append(_ms(inicio))
+
+                inicio = time.perf_counter()
+                cache.guardar(datos, bandeja_id, backend, reconocimiento.CONFIANZA_MINIMA, reconocimiento.IOU_NMS, reporte)
+                diario._escribir(archivo_diario, [{
+                    "herramientas_faltantes": sorted(faltantes), "herramientas_sobrantes": sorted(sobrantes),
+                    "estado": "Benchmark", "fecha_reporte": datetime.datetime.now(datetime.timezone.utc),
+                    "bandeja": int(bandeja_id),
+                }])
+                tiempos["persistencia"].append(_ms(inicio))
+
+                totales.append(_ms(inicio_imagen))
+    finally:
+        archivo_diario.close()
+        carpeta_diario.cleanup()
+    duracion_s = time.perf_counter() - inicio_total
+
+    calientes = tiempos["inferencia"][1:]
+    return {
+        "modelo": ruta_modelo,
+        "imagenes": len(totales),
+        "imagenes_por_segundo": round(len(totales) / duracion_s, 2),
+        "etapas": {etapa: resumen(muestras) for etapa, muestras in tiempos.items()},
+        "total_por_imagen": resumen(totales),
+        "modelo_frio": {
+            "carga_y_calentamiento_ms": round(carga_modelo_ms, 2),
+            "primera_inferencia_ms": round(primera_inferencia_ms, 2),
+        },
+        "modelo_caliente": resumen(calientes),
+        "rss": rss_maximo_mb(),
+    }
+
+# --- Flujo completo de handle_photo con Telegram y MongoDB simulados ---
+class _ColeccionFalsa:
+    """Lo minimo de una coleccion de pymongo que usa el flujo de auditoria."""
+    def __init__(self, documentos=()):
+        self.documentos = [dict(d) for d in documentos]
+
+    def find(self, filtro=None):
+        return list(self.documentos)
+
+    def update_one(self, filtro, cambios, upsert=False):
+        class _Resultado:
+            modified_count = 1
+            upserted_id = None
+        return _Resultado()
+
+    def insert_many(self, documentos, ordered=True):
+        self.documentos.extend(documentos)
+
+class _Archivo:
+    def __init__(self, datos):
+        self._datos = datos
+
+    async def download_as_bytearray(self):
+        return bytearray(self._datos)
+
+class _Foto:
+    def __init__(self, datos, file_unique_id):
+        self._datos = datos
+        self.file_unique_id = file_unique_id
+        self.file_id = file_unique_id
+
+    async def get_file(self):
+        return _Archivo(self._datos)
+
+class _Mensaje:
+    def __init__(self, chat_id, foto, message_id):
+        self.chat_id = chat_id
+        self.photo = [foto]
+        self.message_id = message_id
+        self.media_group_id = None
+
+    async def reply_text(self, texto, **kwargs):
+        return None
+
+class _Update:
+    def __init__(self, mensaje):
+        self.message = mensaje
+
+class _JobQueue:
+    def get_jobs_by_name(self, nombre):
+        return []
+
+    def run_once(self, *args, **kwargs):
+        return None
+
+class _Contexto:
+    job_queue = _JobQueue()
+
+def medir_flujo(corpus, backend, repeticiones, concurrencia, workers):
+    """Ejecuta handle_photo (check-in de una bandeja) con 'concurrencia' cajas a la vez."""
+    # El servidor lee su configuracion al importarse: sin archivos en disco ni cache persistente
+    os.environ.update({"ARCHIVAR_FOTOS": "0", "CACHE_INFERENCIA_ARCHIVO": "", "BACKEND_INFERENCIA": backend})
+    import servidor_nuevo as servidor
+    from pool_inferencia import PoolInferencia
+
+    servidor.inicializar_recursos() # MongoClient no se conecta hasta la primera consulta
+    servidor.cache_inferencia = CacheInferencia(capacidad=0) # Sin aciertos de cache: siempre se infiere
+    servidor.estado_bandejas.coleccion = _ColeccionFalsa()
+    servidor.diario_incidencias.coleccion = _ColeccionFalsa()
+    servidor.pool_inferencia = PoolInferencia(workers, max(concurrencia * 2, 2), backend)
+
+    inicio = time.perf_counter()
+    servidor.pool_inferencia.iniciar() # Espera a que todos los workers carguen y calienten el modelo
+    # Primer analisis ya con los workers calientes
+    asyncio.run(servidor.pool_inferencia.analizar(open(corpus[0][0], 'rb').read(), corpus[0][1]))
+    arranque_pool_ms = _ms(inicio)
+
+    # Cuenta los analisis reales: una foto que no llega al pool mediria solo la maquina de estados
+    analisis = []
+    analizar = servidor.pool_inferencia.analizar
+    async def analizar_contando(datos_imagen, bandeja_id):
+        analisis.append(bandeja_id)
+        return await analizar(datos_imagen, bandeja_id)
+    servidor.pool_inferencia.analizar = analizar_contando
+
+    latencias = []
+    trabajos = [(i, ruta, bandeja_id) for i, (ruta, bandeja_id) in enumerate(corpus * repeticiones)]
+
+    async def caja(numero, cola):
+        box_id = f"bench_{numero}"
+        chat_id = f"9000{numero}"
+        while cola:
+            i, ruta, bandeja_id = cola.pop()
+            with open(ruta, 'rb') as f:
+                datos = f.read()
+            # Cada foto parte de una sesion nueva (las sesiones tienen version: no se sobrescriben a ciegas)
+            servidor.sesiones.reiniciar(box_id)
+            if not servidor.sesiones.iniciar({
+                "state": "ABIERTA_ESPERANDO_FOTO_INICIAL", "box_id": box_id, "user_chat_id": chat_id,
+                "user": "benchmark", "uid": "0", "active_tray": bandeja_id, "is_multi_tray": False,
+                f"inventario_esperado_checkin_{bandeja_id}": reconocimiento.INVENTARIO_BANDEJA_1 if bandeja_id == "1" else reconocimiento.INVENTARIO_BANDEJA_2,
+            }):
+                raise RuntimeError(f"No se pudo iniciar la sesion de la caja {box_id}")
+            update = _Update(_Mensaje(chat_id, _Foto(datos, f"bench-{i}"), i))
+            inicio = time.perf_counter()
+            await servidor.handle_photo(update, _Contexto())
+            latencias.append(_ms(inicio))
+
+    async def ejecutar():
+        cola = list(reversed(trabajos))
+        inicio = time.perf_counter()
+        await asyncio.gather(*(caja(n, cola) for n in range(concurrencia)))
+        return time.perf_counter() - inicio
+
+    duracion_s = asyncio.run(ejecutar())
+    servidor.pool_inferencia.cerrar()
+    if len(analisis) != len(latencias):
+        raise RuntimeError(f"Solo {len(analisis)} de {len(latencias)} fotos llegaron a la inferencia: el resultado no es valido.")
+    return {
+        "concurrencia": concurrencia,
+        "workers": servidor.pool_inferencia.num_workers,
+        "fotos": len(latencias),
+        "imagenes_por_segundo": round(len(latencias) / duracion_s, 2),
+        "handle_photo": resumen(latencias),
+        "arranque_pool_ms": round(arranque_pool_ms, 2),
+        "spans_servidor": servidor.trazador.metricas(),
+        "rss": rss_maximo_mb(),
+    }
+
+# --- Comparacion con una ejecucion anterior ---
+def comparar(actual, referencia, tolerancia):
+    """Avisa de las etapas cuyo p50 empeoro mas de 'tolerancia' (fraccion) respecto a la referencia."""
+    regresiones = []
+    for backend, datos in actual["backends"].items():
+        anterior = referencia.get("backends", {}).get(backend)
+        if not datos or not anterior:
+            continue
+        pares = [(f"{backend}.{etapa}", datos["etapas"][etapa], anterior["etapas"].get(etapa, {})) for etapa in ETAPAS]
+        pares.append((f"{backend}.total_por_imagen", datos["total_por_imagen"], anterior.get("total_por_imagen", {})))
+        for nombre, nuevo, viejo in pares:
+            if viejo.get("p50_ms") and nuevo.get("p50_ms", 0) > viejo["p50_ms"] * (1 + tolerancia):
+                regresiones.append(nombre)
+                print(f"REGRESION: {nombre} p50 {viejo['p50_ms']} ms -> {nuevo['p50_ms']} ms")
+    if not regresiones:
+        print("Sin regresiones respecto a la referencia.")
+    return regresiones
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de auditoria de bandejas.")
+    parser.add_argument("--imagenes", required=True, help="Carpeta con fotos .jpg de bandejas")
+    parser.add_argument("--bandeja", default="1", choices=["1", "2"], help="Bandeja de las fotos que no estan en una subcarpeta 1/2")
+    parser.add_argument("--backend", nargs="+", default=[reconocimiento.BACKEND_POR_DEFECTO], choices=list(backends_inferencia.BACKENDS))
+    parser.add_argument("--repeticiones", type=int, default=3, help="Pasadas sobre el corpus completo")
+    parser.add_argument("--flujo", action="store_true", help="Mide tambien handle_photo con el pool de inferencia")
+    parser.add_argument("--concurrencia", type=int, default=1, help="Cajas simultaneas en el modo --flujo")
+    parser.add_argument("--workers", type=int, default=0, help="Workers del pool en el modo --flujo (0 = CPUs - 1)")
+    parser.add_argument("--salida", default=f"benchmark_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_argument("--referencia", help="JSON de una ejecucion anterior para detectar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="Empeoramiento de p50 tolerado (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    corpus = cargar_corpus(args.imagenes, args.bandeja)
+    print(f"Corpus: {len(corpus)} imagenes x {args.repeticiones} repeticiones.")
+    resultado = {
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        "plataforma": {"python": platform.python_version(), "sistema": platform.platform(), "cpus": os.cpu_count()},
+        "corpus": {"carpeta": args.imagenes, "imagenes": len(corpus), "repeticiones": args.repeticiones},
+        "configuracion": {"conf": reconocimiento.CONFIANZA_MINIMA, "iou": reconocimiento.IOU_NMS, "tamano_entrada": preprocesamiento.TAMANO_ENTRADA},
+        "backends": {},
+    }
+    for backend in args.backend:
+        print(f"[{backend}] Midiendo pipeline por etapas...")
+        resultado["backends"][backend] = medir_pipeline(corpus, backend, args.repeticiones)
+        datos = resultado["backends"][backend]
+        if datos:
+            print(f"[{backend}] {datos['imagenes_por_segundo']} imagenes/s; inferencia p50 {datos['etapas']['inferencia']['p50_ms']} ms")
+    if args.flujo:
+        # El servidor se importa una sola vez, asi que el flujo se mide con el primer backend
+        print(f"[{args.backend[0]}] Midiendo handle_photo con concurrencia {args.concurrencia}...")
+        resultado["flujo"] = medir_flujo(corpus, args.backend[0], args.repeticiones, args.concurrencia, args.workers or None)
+        print(f"[{args.backend[0]}] handle_photo: {resultado['flujo']['imagenes_por_segundo']} fotos/s")
+
+    if args.referencia:
+        with open(args.referencia, "r", encoding="utf-8") as f:
+            resultado["regresiones"] = comparar(resultado, json.load(f), args.tolerancia)
+
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, indent=2)
+    print(f"Resultados guardados en '{args.salida}'.")
+    sys.exit(1 if resultado.get("regresiones") else 0)
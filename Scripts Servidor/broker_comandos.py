@@ -0,0 +1,115 @@
+import time
+import asyncio
+import threading
+from collections import deque
+
+class BrokerComandos:
+    """
+    Colas de comandos para los Pico, una por ID de dispositivo.
+    Cada comando lleva un numero de secuencia; el Pico lo confirma (ack) despues
+    de ejecutarlo y, si la confirmacion no llega a tiempo, se vuelve a entregar.
+    """
+    def __init__(self, espera_ack=5.0):
+        self.espera_ack = espera_ack
+        # Identifica esta ejecucion del servidor: si cambia, el Pico reinicia su registro de secuencias
+        self.epoca = int(time.time())
+        self._pendientes = {} # device_id -> deque de comandos aun no entregados
+        self._sin_confirmar = {} # device_id -> {seq: [comando, instante de la ultima entrega]}
+        self._secuencias = {} # device_id -> ultimo numero de secuencia asignado
+        self._condicion = threading.Condition()
+        self._esperas_async = {} # device_id -> set de (loop, future) de long-polls asincronos
+
+    def encolar(self, device_id, *comandos):
+        """Agrega comandos para un dispositivo y despierta a sus peticiones de long-poll."""
+        with self._condicion:
+            cola = self._pendientes.setdefault(device_id, deque())
+            for comando in comandos:
+                seq = self._secuencias.get(device_id, 0) + 1
+                self._secuencias[device_id] = seq
+                cola.append(dict(comando, seq=seq, epoca=self.epoca))
+            self._condicion.notify_all()
+            esperas = list(self._esperas_async.get(device_id, ()))
+        for loop, futuro in esperas:
+            loop.call_soon_threadsafe(_despertar, futuro)
+
+    def _siguiente(self, device_id, ahora):
+        """Primero reentrega los comandos cuyo ack vencio; si no hay, entrega el siguiente nuevo."""
+        sin_confirmar = self._sin_confirmar.setdefault(device_id, {})
+        for entrada in sin_confirmar.values():
+            if ahora - entrada[1] >= self.espera_ack:
+                entrada[1] = ahora
+                return entrada[0]
+        cola = self._pendientes.get(device_id)
+        if cola:
+            comando = cola.popleft()
+            sin_confirmar[comando["seq"]] = [comando, ahora]
+            return comando
+        return None
+
+    def _segundos_hasta_reentrega(self, device_id, ahora):
+        entregas = [entrada[1] for entrada in self._sin_confirmar.get(device_id, {}).values()]
+        if not entregas:
+            return None
+        return max(0.0, min(entregas) + self.espera_ack - ahora)
+
+    def obtener(self, device_id, espera=0):
+        """
+        Devuelve el siguiente comando del dispositivo o None. Con espera > 0 retiene
+        la llamada (long-poll) hasta que haya un comando o pasen 'espera' segundos.
+        """
+        with self._condicion:
+            ahora = time.monotonic()
+            limite = ahora + espera
+            comando = self._siguiente(device_id, ahora)
+            while comando is None and ahora < limite:
+                # Tambien hay que despertar cuando venza el ack de un comando ya entregado
+                reentrega = self._segundos_hasta_reentrega(device_id, ahora)
+                restante = limite - ahora if reentrega is None else min(limite - ahora, reentrega + 0.01)
+                self._condicion.wait(restante)
+                ahora = time.monotonic()
+                comando = self._siguiente(device_id, ahora)
+            return comando
+
+    async def obtener_async(self, device_id, espera=0):
+        """
+        Igual que obtener(), pero la espera no ocupa un hilo: el long-poll queda
+        suspendido en el loop de asyncio hasta que se encole un comando.
+        """
+        loop = asyncio.get_running_loop()
+        limite = time.monotonic() + espera
+        while True:
+            with self._condicion:
+                ahora = time.monotonic()
+                comando = self._siguiente(device_id, ahora)
+                if comando is not None or ahora >= limite:
+                    return comando
+                reentrega = self._segundos_hasta_reentrega(device_id, ahora)
+                restante = limite - ahora if reentrega is None else min(limite - ahora, reentrega + 0.01)
+                futuro = loop.create_future()
+                esperas = self._esperas_async.setdefault(device_id, set())
+                esperas.add((loop, futuro))
+            try:
+                await asyncio.wait_for(futuro, restante)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condicion:
+                    esperas.discard((loop, futuro))
+                    if not esperas:
+                        self._esperas_async.pop(device_id, None)
+
+    def confirmar(self, device_id, seq, epoca=None):
+        """Marca un comando como ejecutado. Devuelve False si no estaba pendiente de confirmacion."""
+        if epoca is not None and epoca != self.epoca:
+            return False
+        with self._condicion:
+            return self._sin_confirmar.get(device_id, {}).pop(seq, None) is not None
+
+    def pendientes(self, device_id):
+        """Cantidad de comandos sin entregar o sin confirmar de un dispositivo."""
+        with self._condicion:
+            return len(self._pendientes.get(device_id, ())) + len(self._sin_confirmar.get(device_id, {}))
+
+def _despertar(futuro):
+    if not futuro.done():
+        futuro.set_result(None)
@@ -0,0 +1,176 @@
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CacheInferencia:
+    """
+    Cache LRU de reportes de la IA indexada por el SHA-256 de los bytes de la foto,
+    la version del modelo, los umbrales (conf/iou) y la bandeja.
+    Opcionalmente detecta fotos casi identicas con un hash perceptual (dHash) y
+    guarda su contenido en un archivo JSON para sobrevivir a reinicios.
+    """
+    def __init__(self, capacidad=256, ruta_archivo=None, usar_hash_perceptual=False, distancia_maxima=4):
+        self.capacidad = capacidad
+        self.ruta_archivo = ruta_archivo
+        self.usar_hash_perceptual = usar_hash_perceptual
+        self.distancia_maxima = distancia_maxima # Bits distintos permitidos entre dos dHash de 64 bits
+        self._entradas = OrderedDict() # clave -> {"reporte", "contexto", "dhash"}
+        self._alias = OrderedDict() # file_unique_id de Telegram -> sha256 de la foto
+        self._lock = threading.Lock()
+        self._guardado_programado = None
+        self.aciertos = 0
+        self.aciertos_perceptuales = 0
+        self.fallos = 0
+        self._cargar()
+
+    # --- Claves ---
+    @staticmethod
+    def hash_contenido(datos_imagen):
+        return hashlib.sha256(datos_imagen).hexdigest()
+
+    @staticmethod
+    def _contexto(bandeja_id, version_modelo, conf, iou):
+        return f"{bandeja_id}|{version_modelo}|{conf}|{iou}"
+
+    @staticmethod
+    def hash_perceptual(datos_imagen):
+        """dHash de 64 bits: compara el brillo de pixeles vecinos en una miniatura 9x8."""
+        from PIL import Image
+        imagen = Image.open(io.BytesIO(datos_imagen))
+        imagen.draft("L", (72, 64)) # Decodifica el JPEG directamente a baja resolucion
+        pixeles = list(imagen.convert("L").resize((9, 8)).getdata())
+        valor = 0
+        for fila in range(8):
+            for columna in range(8):
+                izquierda = pixeles[fila * 9 + columna]
+                derecha = pixeles[fila * 9 + columna + 1]
+                valor = (valor << 1) | (1 if izquierda > derecha else 0)
+        return valor
+
+    # --- Consulta ---
+    def obtener_por_alias(self, file_unique_id, bandeja_id, version_modelo, conf, iou):
+        """Busca un reporte por el identificador unico de la foto en Telegram, sin descargarla."""
+        with self._lock:
+            sha = self._alias.get(file_unique_id)
+        if sha is None:
+            return None
+        return self._buscar_exacto(sha, self._contexto(bandeja_id, version_modelo, conf, iou))
+
+    def obtener(self, datos_imagen, bandeja_id, version_modelo, conf, iou, file_unique_id=None):
+        """Devuelve el reporte cacheado para esta foto o None (y cuenta un fallo)."""
+        sha = self.hash_contenido(datos_imagen)
+        contexto = self._contexto(bandeja_id, version_modelo, conf, iou)
+        if file_unique_id:
+            self._registrar_alias(file_unique_id, sha)
+
+        reporte = self._buscar_exacto(sha, contexto)
+        if reporte is not None:
+            return reporte
+
+        if self.usar_hash_perceptual:
+            try:
+                dhash = self.hash_perceptual(datos_imagen)
+            except Exception as e:
+                print(f"No se pudo calcular el hash perceptual: {e}")
+                dhash = None
+            if dhash is not None:
+                with self._lock:
+                    for entrada in reversed(self._entradas.values()):
+                        if entrada["contexto"] == contexto and entrada.get("dhash") is not None \
+                                and bin(entrada["dhash"] ^ dhash).count("1") <= self.distancia_maxima:
+                            self.aciertos_perceptuales += 1
+                            return entrada["reporte"]
+
+        with self._lock:
+            self.fallos += 1
+        return None
+
+    def _buscar_exacto(self, sha, contexto):
+        clave = f"{sha}|{contexto}"
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada["reporte"]
+
+    # --- Insercion ---
+    def guardar(self, datos_imagen, bandeja_id, version_modelo, conf, iou, reporte, file_unique_id=None):
+        """Guarda un reporte valido. Los reportes con error no se cachean."""
+        if reporte.get("error"):
+            return
+        sha = self.hash_contenido(datos_imagen)
+        contexto = self._contexto(bandeja_id, version_modelo, conf, iou)
+        dhash = None
+        if self.usar_hash_perceptual:
+            try:
+                dhash = self.hash_perceptual(datos_imagen)
+            except Exception:
+                pass
+        with self._lock:
+            clave = f"{sha}|{contexto}"
+            self._entradas[clave] = {"reporte": reporte, "contexto": contexto, "dhash": dhash}
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.capacidad:
+                self._entradas.popitem(last=False)
+        if file_unique_id:
+            self._registrar_alias(file_unique_id, sha)
+        self._programar_guardado()
+
+    def _registrar_alias(self, file_unique_id, sha):
+        with self._lock:
+            self._alias[file_unique_id] = sha
+            self._alias.move_to_end(file_unique_id)
+            while len(self._alias) > self.capacidad * 2:
+                self._alias.popitem(last=False)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "aciertos": self.aciertos,
+                "aciertos_perceptuales": self.aciertos_perceptuales,
+                "fallos": self.fallos,
+            }
+
+    # --- Persistencia ---
+    def _cargar(self):
+        if not self.ruta_archivo or not os.path.exists(self.ruta_archivo):
+            return
+        try:
+            with open(self.ruta_archivo, "r", encoding="utf-8") as f:
+                datos = json.load(f)
+            for clave, entrada in datos.get("entradas", [])[-self.capacidad:]:
+                self._entradas[clave] = entrada
+            for file_unique_id, sha in datos.get("alias", []):
+                self._alias[file_unique_id] = sha
+            print(f"Cache de inferencia cargada: {len(self._entradas)} entradas.")
+        except Exception as e:
+            print(f"No se pudo cargar la cache de inferencia '{self.ruta_archivo}': {e}")
+
+    def _programar_guardado(self, espera_segundos=2.0):
+        """Agrupa varias inserciones en una sola escritura a disco, fuera del hilo que llama."""
+        if not self.ruta_archivo:
+            return
+        with self._lock:
+            if self._guardado_programado:
+                return
+            self._guardado_programado = threading.Timer(espera_segundos, self.guardar_en_disco)
+            self._guardado_programado.daemon = True
+            self._guardado_programado.start()
+
+    def guardar_en_disco(self):
+        with self._lock:
+            self._guardado_programado = None
+            datos = {"entradas": list(self._entradas.items()), "alias": list(self._alias.items())}
+        ruta_temporal = self.ruta_archivo + ".tmp"
+        try:
+            with open(ruta_temporal, "w", encoding="utf-8") as f:
+                json.dump(datos, f)
+            os.replace(ruta_temporal, self.ruta_archivo) # Reemplazo atomico
+        except Exception as e:
+            print(f"No se pudo guardar la cache de inferencia: {e}")
@@ -0,0 +1,237 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import deque, OrderedDict
+
+LARGO_MAXIMO_TEXTO = 4096 # Limite de Telegram por mensaje
+LARGO_MAXIMO_CAPTION = 1024
+
+class _Cubeta:
+    """Token bucket: 'capacidad' envios seguidos y luego 'tasa' envios por segundo."""
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.fichas = capacidad
+        self.ultima = time.monotonic()
+        self.bloqueada_hasta = 0 # Por un 429 de Telegram (RetryAfter)
+
+    def espera(self, ahora):
+        """Segundos hasta que haya una ficha disponible (0 si ya la hay)."""
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.ultima) * self.tasa)
+        self.ultima = ahora
+        if ahora < self.bloqueada_hasta:
+            return self.bloqueada_hasta - ahora
+        return 0 if self.fichas >= 1 else (1 - self.fichas) / self.tasa
+
+    def consumir(self):
+        self.fichas -= 1
+
+class DespachadorTelegram:
+    """
+    Cola central de mensajes salientes de Telegram. Se puede usar desde cualquier
+    hilo (rutas de Flask) o desde el loop del bot. Limita la tasa por chat y global
+    con token buckets, une textos consecutivos para el mismo chat en un solo
+    mensaje, reutiliza el file_id de las fotos ya subidas y respeta los RetryAfter
+    (429) de Telegram. Ante un error de red el mensaje se reintenta con espera
+    exponencial, pausando todos los envios, hasta max_reintentos intentos.
+    metricas() devuelve la profundidad de la cola y la latencia.
+    """
+    def __init__(self, tasa_por_chat=1.0, rafaga_por_chat=3, tasa_global=25.0, max_reintentos=5, capacidad_file_ids=256, trazador=None,
+                 espera_reintento=1.0, espera_maxima_reintento=60.0):
+        self.trazador = trazador # Opcional: registra la duracion de cada llamada a Telegram
+        self.tasa_por_chat = tasa_por_chat
+        self.rafaga_por_chat = rafaga_por_chat
+        self.max_reintentos = max_reintentos
+        self.espera_reintento = espera_reintento # Primera espera tras un error de red; se duplica en cada intento
+        self.espera_maxima_reintento = espera_maxima_reintento
+        self.capacidad_file_ids = capacidad_file_ids
+        self._global = _Cubeta(tasa_global, tasa_global)
+        self._cubetas = {} # chat_id -> _Cubeta
+        self._colas = OrderedDict() # chat_id -> deque de mensajes pendientes (en orden de llegada)
+        self._ocupados = set() # Chats con un envio en curso (para conservar el orden)
+        self._file_ids = OrderedDict() # huella de la foto -> file_id de Telegram
+        self._lock = threading.Lock()
+        self._bot = None
+        self._loop = None
+        self._despertar = None
+        self._tareas = set()
+        self._latencias = deque(maxlen=500)
+        self.enviados = 0
+        self.unidos = 0
+        self.fotos_reutilizadas = 0
+        self.limitados_429 = 0
+        self.fallidos = 0
+
+    # --- API ---
+    async def iniciar(self, bot):
+        """Arranca el despachador en el loop del bot (llamar desde post_init)."""
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        self._tarea = asyncio.create_task(self._bucle())
+        self._senalar()
+
+    def encolar(self, chat_id, texto, reply_markup=None, foto=None):
+        """
+        Agrega un mensaje a la cola. 'foto' puede ser bytes o la ruta de un archivo.
+        No espera a Telegram, asi que se puede llamar desde cualquier hilo.
+        """
+        if chat_id is None:
+            return
+        mensaje = {"chat_id": str(chat_id), "texto": texto or "", "reply_markup": reply_markup, "foto": foto,
+                   "encolado": time.monotonic(), "intentos": 0}
+        with self._lock:
+            self._colas.setdefault(mensaje["chat_id"], deque()).append(mensaje)
+        self._senalar()
+
+    def metricas(self):
+        with self._lock:
+            profundidad = sum(len(cola) for cola in self._colas.values())
+            latencias = sorted(self._latencias)
+        def percentil(p):
+            return latencias[min(len(latencias) - 1, int(len(latencias) * p))] * 1000 if latencias else 0
+        return {
+            "en_cola": profundidad, "chats_en_cola": len(self._colas), "enviados": self.enviados,
+            "unidos": self.unidos, "fotos_reutilizadas": self.fotos_reutilizadas,
+            "limitados_429": self.limitados_429, "fallidos": self.fallidos,
+            "latencia_p50_ms": percentil(0.5), "latencia_p95_ms": percentil(0.95),
+        }
+
+    def _senalar(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    # --- Planificacion ---
+    def _cubeta(self, chat_id):
+        cubeta = self._cubetas.get(chat_id)
+        if cubeta is None:
+            cubeta = self._cubetas[chat_id] = _Cubeta(self.tasa_por_chat, self.rafaga_por_chat)
+        return cubeta
+
+    def _tomar_listos(self):
+        """Devuelve los (chat_id, mensaje) que se pueden enviar ya y la espera hasta el siguiente."""
+        listos, proxima = [], None
+        ahora = time.monotonic()
+        with self._lock:
+            for chat_id, cola in list(self._colas.items()):
+                if chat_id in self._ocupados:
+                    continue
+                espera = max(self._cubeta(chat_id).espera(ahora), self._global.espera(ahora))
+                if espera > 0:
+                    proxima = espera if proxima is None else min(proxima, espera)
+                    continue
+                self._cubeta(chat_id).consumir()
+                self._global.consumir()
+                listos.append((chat_id, self._unir(cola)))
+                if not cola:
+                    del self._colas[chat_id]
+                self._ocupados.add(chat_id)
+        return listos, proxima
+
+    def _unir(self, cola):
+        """Saca el primer mensaje de la cola uniendole los textos simples que le siguen."""
+        mensaje = cola.popleft()
+        if mensaje["foto"] is not None:
+            return mensaje
+        while cola and mensaje["reply_markup"] is None and cola[0]["foto"] is None:
+            siguiente = cola[0]
+            texto = f"{mensaje['texto']}\n\n{siguiente['texto']}"
+            if len(texto) > LARGO_MAXIMO_TEXTO:
+                break
+            cola.popleft()
+            # Se conserva el instante del mas antiguo para medir la latencia real
+            mensaje = dict(mensaje, texto=texto, reply_markup=siguiente["reply_markup"])
+            self.unidos += 1
+        return mensaje
+
+    async def _bucle(self):
+        while True:
+            # Se limpia antes de revisar las colas para no perder un aviso que llegue en medio
+            self._despertar.clear()
+            listos, proxima = self._tomar_listos()
+            for chat_id, mensaje in listos:
+                tarea = asyncio.create_task(self._enviar(chat_id, mensaje))
+                self._tareas.add(tarea) # Se guarda la referencia para que no se descarte
+                tarea.add_done_callback(self._tareas.discard)
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=proxima if proxima is not None else None)
+            except asyncio.TimeoutError:
+                pass
+
+    # --- Envio ---
+    async def _enviar(self, chat_id, mensaje):
+        from telegram.error import RetryAfter, NetworkError, BadRequest, Forbidden
+        try:
+            inicio = time.monotonic()
+            if mensaje["foto"] is not None:
+                await self._enviar_foto(mensaje)
+            else:
+                await self._bot.send_message(chat_id=chat_id, text=mensaje["texto"], reply_markup=mensaje["reply_markup"])
+            if self.trazador:
+                self.trazador.registrar("telegram_envio", (time.monotonic() - inicio) * 1000)
+            self.enviados += 1
+            self._latencias.append(time.monotonic() - mensaje["encolado"])
+        except RetryAfter as e:
+            # Telegram pide esperar: el mensaje vuelve al frente de su cola
+            self.limitados_429 += 1
+            espera = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+            print(f"Telegram limito los envios a {chat_id}; reintento en {espera:.0f} s.")
+            with self._lock:
+                self._cubeta(chat_id).bloqueada_hasta = time.monotonic() + espera
+                self._colas.setdefault(chat_id, deque()).appendleft(mensaje)
+                self._colas.move_to_end(chat_id, last=False)
+        except (BadRequest, Forbidden) as e:
+            self.fallidos += 1
+            print(f"Error al enviar mensaje a {chat_id}: {e}")
+        except NetworkError as e:
+            mensaje["intentos"] += 1
+            if mensaje["intentos"] < self.max_reintentos:
+                # Sin red no sirve reintentar de inmediato: se pausan este chat y los envios en general
+                espera = min(self.espera_reintento * 2 ** (mensaje["intentos"] - 1), self.espera_maxima_reintento)
+                print(f"Error de red al enviar a {chat_id} (intento {mensaje['intentos']}); reintento en {espera:.1f} s: {e}")
+                with self._lock:
+                    hasta = time.monotonic() + espera
+                    self._cubeta(chat_id).bloqueada_hasta = hasta
+                    self._global.bloqueada_hasta = max(self._global.bloqueada_hasta, hasta)
+                    self._colas.setdefault(chat_id, deque()).appendleft(mensaje)
+                    self._colas.move_to_end(chat_id, last=False)
+            else:
+                self.fallidos += 1
+                print(f"Error al enviar mensaje a {chat_id} tras {mensaje['intentos']} intentos: {e}")
+        except Exception as e:
+            self.fallidos += 1
+            print(f"Error al enviar mensaje a {chat_id}: {e}")
+        finally:
+            with self._lock:
+                self._ocupados.discard(chat_id)
+            self._despertar.set()
+
+    def _huella(self, foto):
+        if isinstance(foto, (bytes, bytearray)):
+            return hashlib.sha256(foto).hexdigest()
+        return f"{os.path.abspath(foto)}|{os.path.getmtime(foto)}"
+
+    async def _enviar_foto(self, mensaje):
+        foto = mensaje["foto"]
+        caption = mensaje["texto"][:LARGO_MAXIMO_CAPTION] or None
+        if not isinstance(foto, (bytes, bytearray)) and not os.path.exists(foto):
+            # La foto ya no existe: se envia solo el texto
+            await self._bot.send_message(chat_id=mensaje["chat_id"], text=mensaje["texto"], reply_markup=mensaje["reply_markup"])
+            return
+        huella = self._huella(foto)
+        file_id = self._file_ids.get(huella)
+        if file_id:
+            self.fotos_reutilizadas += 1
+            await self._bot.send_photo(chat_id=mensaje["chat_id"], photo=file_id, caption=caption, reply_markup=mensaje["reply_markup"])
+            return
+        if isinstance(foto, (bytes, bytearray)):
+            enviado = await self._bot.send_photo(chat_id=mensaje["chat_id"], photo=bytes(foto), caption=caption, reply_markup=mensaje["reply_markup"])
+        else:
+            with open(foto, 'rb') as archivo:
+                enviado = await self._bot.send_photo(chat_id=mensaje["chat_id"], photo=archivo, caption=caption, reply_markup=mensaje["reply_markup"])
+        # Telegram guarda la foto subida; las siguientes veces basta con su file_id
+        self._file_ids[huella] = enviado.photo[-1].file_id
+        while len(self._file_ids) > self.capacidad_file_ids:
+            self._file_ids.popitem(last=False)
@@ -0,0 +1,173 @@
+import os
+import time
+import queue
+import threading
+from bson import ObjectId, json_util
+
+class DiarioIncidencias:
+    """
+    Registro de incidencias con escritura diferida: cada incidencia se agrega a un
+    archivo local (una linea JSON por incidencia, con fsync agrupado) y un hilo en
+    segundo plano la copia a MongoDB con insert_many, reintentando si la base de
+    datos no responde. Un archivo de checkpoint guarda hasta que byte del diario ya
+    esta en MongoDB, asi que al reiniciar se reenvia lo que quedo pendiente.
+    registrar() nunca espera a la base de datos ni al disco.
+    """
+    def __init__(self, coleccion, ruta_archivo="diario_incidencias.jsonl", tamano_lote=100,
+                 intervalo_fsync=0.2, espera_maxima_reintento=60, tamano_compactacion=1024 * 1024, trazador=None):
+        self.coleccion = coleccion
+        self.ruta_archivo = ruta_archivo
+        self.ruta_checkpoint = ruta_archivo + ".offset"
+        self.tamano_lote = tamano_lote
+        self.intervalo_fsync = intervalo_fsync # Las incidencias de este intervalo comparten un fsync
+        self.espera_maxima_reintento = espera_maxima_reintento
+        self.tamano_compactacion = tamano_compactacion # Bytes ya enviados a partir de los cuales se vacia el diario
+        self.trazador = trazador # Opcional: mide cada insert_many
+        self._cola = queue.Queue()
+        self._hilo = None
+        self._offset = 0 # Bytes del diario ya guardados en MongoDB
+        self._espera_reintento = 1
+        self._proximo_intento = 0
+        self.pendientes_mongo = 0
+
+    # --- API ---
+    def iniciar(self):
+        """Abre el diario, recupera el checkpoint y arranca el hilo de escritura."""
+        self._offset = self._leer_checkpoint()
+        tamano = os.path.getsize(self.ruta_archivo) if os.path.exists(self.ruta_archivo) else 0
+        if self._offset > tamano: # El diario se compacto pero no llego a guardarse el checkpoint
+            self._offset = 0
+        if tamano > self._offset:
+            print(f"Diario de incidencias: {tamano - self._offset} bytes sin enviar a MongoDB. Se reenviaran.")
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+        self._hilo.start()
+
+    def registrar(self, incidencia):
+        """Encola la incidencia. El _id se asigna aqui para que los reintentos no la dupliquen."""
+        incidencia = dict(incidencia)
+        incidencia.setdefault("_id", ObjectId())
+        self._cola.put(incidencia)
+        return incidencia["_id"]
+
+    def cerrar(self, espera=5):
+        """Escribe lo que quede en la cola e intenta un ultimo envio a MongoDB."""
+        if self._hilo:
+            self._cola.put(None)
+            self._hilo.join(espera)
+
+    # --- Hilo de fondo ---
+    def _bucle(self):
+        with open(self.ruta_archivo, "ab") as diario:
+            while True:
+                lote, cerrar = self._tomar_lote()
+                if lote:
+                    self._escribir(diario, lote)
+                if time.monotonic() >= self._proximo_intento:
+                    self._enviar_a_mongo(diario)
+                if cerrar:
+                    return
+
+    def _tomar_lote(self):
+        """Espera la primera incidencia y junta las que lleguen durante el intervalo de fsync."""
+        lote = []
+        try:
+            primera = self._cola.get(timeout=1.0)
+        except queue.Empty:
+            return lote, False
+        if primera is None:
+            return lote, True
+        lote.append(primera)
+        limite = time.monotonic() + self.intervalo_fsync
+        while True:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return lote, False
+            try:
+                incidencia = self._cola.get(timeout=restante)
+            except queue.Empty:
+                return lote, False
+            if incidencia is None:
+                return lote, True
+            lote.append(incidencia)
+
+    def _escribir(self, diario, lote):
+        datos = b"".join(json_util.dumps(incidencia).encode("utf-8") + b"\n" for incidencia in lote)
+        diario.write(datos)
+        diario.flush()
+        os.fsync(diario.fileno())
+
+    def _leer_pendientes(self):
+        """Lee hasta 'tamano_lote' lineas completas desde el checkpoint. Devuelve (incidencias, bytes leidos)."""
+        incidencias, consumidos = [], 0
+        with open(self.ruta_archivo, "rb") as f:
+            f.seek(self._offset)
+            for linea in f:
+                if not linea.endswith(b"\n"): # Linea a medio escribir (corte de energia): se ignora
+                    break
+                consumidos += len(linea)
+                if linea.strip():
+                    try:
+                        incidencias.append(json_util.loads(linea))
+                    except ValueError as e:
+                        print(f"Diario de incidencias: linea corrupta descartada: {e}")
+                if len(incidencias) >= self.tamano_lote:
+                    break
+        return incidencias, consumidos
+
+    def _enviar_a_mongo(self, diario):
+        from pymongo.errors import BulkWriteError
+        while os.path.getsize(self.ruta_archivo) > self._offset:
+            incidencias, consumidos = self._leer_pendientes()
+            if not consumidos:
+                break
+            try:
+                if incidencias:
+                    inicio = time.monotonic()
+                    self.coleccion.insert_many(incidencias, ordered=False)
+                    if self.trazador:
+                        self.trazador.registrar("mongo_incidencias", (time.monotonic() - inicio) * 1000)
+            except BulkWriteError as e:
+                # Las duplicadas (11000) ya estaban guardadas de un intento anterior
+                otros = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                if otros:
+                    self._programar_reintento(otros[0].get("errmsg"))
+                    return
+            except Exception as e:
+                self._programar_reintento(e)
+                return
+            self._offset += consumidos
+            self._guardar_checkpoint()
+            self._espera_reintento = 1
+        self.pendientes_mongo = 0
+        self._compactar(diario)
+
+    def _programar_reintento(self, error):
+        print(f"Diario de incidencias: MongoDB no disponible ({error}). Reintento en {self._espera_reintento} s.")
+        self._proximo_intento = time.monotonic() + self._espera_reintento
+        self._espera_reintento = min(self._espera_reintento * 2, self.espera_maxima_reintento)
+        self.pendientes_mongo = os.path.getsize(self.ruta_archivo) - self._offset
+
+    def _compactar(self, diario):
+        """Vacia el diario cuando todo lo escrito ya esta en MongoDB y ocupa demasiado."""
+        if self._offset < self.tamano_compactacion or os.path.getsize(self.ruta_archivo) != self._offset:
+            return
+        diario.truncate(0)
+        os.fsync(diario.fileno())
+        self._offset = 0
+        self._guardar_checkpoint()
+
+    # --- Checkpoint ---
+    def _leer_checkpoint(self):
+        try:
+            with open(self.ruta_checkpoint, "r") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _guardar_checkpoint(self):
+        ruta_temporal = self.ruta_checkpoint + ".tmp"
+        with open(ruta_temporal, "w") as f:
+            f.write(str(self._offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta_temporal, self.ruta_checkpoint) # Reemplazo atomico
@@ -0,0 +1,121 @@
+import time
+import threading
+
+class DirectorioUsuarios:
+    """
+    Copia en memoria de la coleccion de usuarios, indexada por rfid_uid y por
+    telegram_chat_id, para verificar tarjetas sin consultar a MongoDB.
+    Se mantiene al dia con escritura directa (insertar/actualizar pasan por aqui),
+    con un change stream de MongoDB y, si el servidor no lo soporta (los change
+    streams requieren un replica set), recargando todo cada 'ttl_segundos'.
+    """
+    def __init__(self, coleccion, ttl_segundos=300):
+        self.coleccion = coleccion
+        self.ttl_segundos = ttl_segundos
+        self._por_uid = {} # rfid_uid -> documento del usuario
+        self._por_chat = {} # telegram_chat_id -> documento del usuario
+        self._uid_por_id = {} # _id de Mongo -> rfid_uid (los eventos de borrado solo traen el _id)
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.ultima_carga = 0
+
+    # --- Carga ---
+    def cargar(self):
+        """Lee toda la coleccion y reemplaza los indices de una vez."""
+        por_uid, por_chat, uid_por_id = {}, {}, {}
+        for usuario in self.coleccion.find():
+            por_uid[usuario.get("rfid_uid")] = usuario
+            if usuario.get("telegram_chat_id"):
+                por_chat[usuario["telegram_chat_id"]] = usuario
+            uid_por_id[usuario.get("_id")] = usuario.get("rfid_uid")
+        with self._lock:
+            self._por_uid, self._por_chat, self._uid_por_id = por_uid, por_chat, uid_por_id
+            self.ultima_carga = time.monotonic()
+        print(f"Directorio de usuarios cargado: {len(por_uid)} usuarios.")
+
+    def _indexar(self, usuario):
+        with self._lock:
+            anterior = self._por_uid.get(usuario.get("rfid_uid"))
+            if anterior and anterior.get("telegram_chat_id") and self._por_chat.get(anterior["telegram_chat_id"]) is anterior:
+                del self._por_chat[anterior["telegram_chat_id"]]
+            self._por_uid[usuario.get("rfid_uid")] = usuario
+            if usuario.get("telegram_chat_id"):
+                self._por_chat[usuario["telegram_chat_id"]] = usuario
+            if usuario.get("_id") is not None:
+                self._uid_por_id[usuario["_id"]] = usuario.get("rfid_uid")
+
+    def _desindexar(self, id_documento):
+        with self._lock:
+            uid = self._uid_por_id.pop(id_documento, None)
+            usuario = self._por_uid.pop(uid, None)
+            if usuario and usuario.get("telegram_chat_id") and self._por_chat.get(usuario["telegram_chat_id"]) is usuario:
+                del self._por_chat[usuario["telegram_chat_id"]]
+
+    # --- Consulta (solo memoria) ---
+    def por_uid(self, rfid_uid):
+        return self._por_uid.get(rfid_uid)
+
+    def por_chat(self, telegram_chat_id):
+        return self._por_chat.get(telegram_chat_id)
+
+    def todos(self):
+        with self._lock:
+            return list(self._por_uid.values())
+
+    def sin_enlazar(self):
+        """Usuarios que aun no tienen una cuenta de Telegram enlazada."""
+        with self._lock:
+            return [usuario for usuario in self._por_uid.values() if not usuario.get("telegram_chat_id")]
+
+    # --- Escritura directa ---
+    def insertar(self, usuario):
+        """Inserta el usuario en MongoDB y lo agrega al directorio."""
+        usuario = dict(usuario)
+        self.coleccion.insert_one(usuario) # insert_one agrega el _id al diccionario
+        self._indexar(usuario)
+
+    def actualizar(self, rfid_uid, cambios):
+        """Aplica un $set al usuario en MongoDB y en el directorio."""
+        self.coleccion.update_one({"rfid_uid": rfid_uid}, {"$set": cambios})
+        actual = self._por_uid.get(rfid_uid)
+        if actual is not None:
+            self._indexar(dict(actual, **cambios))
+
+    # --- Invalidacion ---
+    def iniciar_vigilancia(self):
+        """Arranca el hilo que aplica los cambios hechos en MongoDB por otros procesos."""
+        self._hilo = threading.Thread(target=self._vigilar, daemon=True)
+        self._hilo.start()
+
+    def _vigilar(self):
+        while True:
+            try:
+                with self.coleccion.watch(full_document="updateLookup") as stream:
+                    print("Directorio de usuarios: escuchando el change stream de MongoDB.")
+                    # Lo que cambio mientras no habia stream se recupera recargando una vez
+                    self.cargar()
+                    for cambio in stream:
+                        self._aplicar_cambio(cambio)
+            except Exception as e:
+                print(f"Directorio de usuarios: change stream no disponible ({e}). Se recargara cada {self.ttl_segundos} s.")
+                time.sleep(self.ttl_segundos)
+                try:
+                    self.cargar()
+                except Exception as e:
+                    print(f"Directorio de usuarios: no se pudo recargar: {e}")
+
+    def _aplicar_cambio(self, cambio):
+        operacion = cambio.get("operationType")
+        if operacion in ("insert", "update", "replace"):
+            usuario = cambio.get("fullDocument")
+            if usuario is None: # El documento se borro antes de poder leerlo
+                self._desindexar(cambio["documentKey"]["_id"])
+            else:
+                anterior_uid = self._uid_por_id.get(usuario["_id"])
+                if anterior_uid is not None and anterior_uid != usuario.get("rfid_uid"):
+                    self._desindexar(usuario["_id"])
+                self._indexar(usuario)
+        elif operacion == "delete":
+            self._desindexar(cambio["documentKey"]["_id"])
+        elif operacion in ("drop", "rename", "invalidate"):
+            self.cargar()
@@ -0,0 +1,78 @@
+import time
+import threading
+
+class ConflictoVersion(Exception):
+    """El documento de la bandeja cambio demasiadas veces mientras se intentaba actualizarlo."""
+
+class EstadoBandejas:
+    """
+    Cache del inventario esperado de cada bandeja (coleccion Estado_Bandejas).
+    Las lecturas se sirven de memoria y las bandejas que faltan (o cuya copia tiene
+    mas de 'ttl_segundos') se piden a MongoDB en una sola consulta. Cada documento
+    lleva un campo 'version': las escrituras solo se aplican si la version no
+    cambio desde la lectura y, si otra caja o proceso se adelanto, se reintentan
+    sobre el documento actualizado, de modo que no se pierden herramientas.
+    """
+    def __init__(self, coleccion, ttl_segundos=30, max_reintentos=5):
+        self.coleccion = coleccion
+        self.ttl_segundos = ttl_segundos
+        self.max_reintentos = max_reintentos
+        self._bandejas = {} # bandeja_id -> (documento, instante de lectura)
+        self._lock = threading.Lock()
+
+    def _guardar_en_cache(self, documento):
+        documento.setdefault("version", 0) # Documentos creados antes de usar versiones
+        with self._lock:
+            self._bandejas[documento["bandeja_id"]] = (documento, time.monotonic())
+
+    def cargar(self, bandeja_ids):
+        """Lee varias bandejas de MongoDB en una sola consulta."""
+        for documento in self.coleccion.find({"bandeja_id": {"$in": list(bandeja_ids)}}):
+            self._guardar_en_cache(documento)
+
+    def _documentos(self, bandeja_ids):
+        ahora = time.monotonic()
+        with self._lock:
+            vencidas = [b for b in bandeja_ids if b not in self._bandejas or ahora - self._bandejas[b][1] > self.ttl_segundos]
+        if vencidas:
+            self.cargar(vencidas)
+        with self._lock:
+            return {b: self._bandejas[b][0] for b in bandeja_ids if b in self._bandejas}
+
+    def inventarios(self, bandeja_ids):
+        """Devuelve {bandeja_id: inventario esperado} de las bandejas pedidas."""
+        return {b: list(documento.get("inventario_actual_esperado", [])) for b, documento in self._documentos(bandeja_ids).items()}
+
+    def crear_si_no_existe(self, bandeja_id, inventario):
+        """Crea el documento de la bandeja con su inventario maestro si aun no existe."""
+        resultado = self.coleccion.update_one(
+            {"bandeja_id": bandeja_id},
+            {"$setOnInsert": {"inventario_actual_esperado": list(inventario), "version": 0}},
+            upsert=True
+        )
+        return resultado.upserted_id is not None
+
+    def agregar_herramientas(self, bandeja_id, herramientas):
+        """Agrega herramientas al inventario esperado (como $addToSet) con control de version."""
+        for _ in range(self.max_reintentos):
+            documento = self._documentos([bandeja_id]).get(bandeja_id)
+            if documento is None:
+                raise KeyError(f"No existe el estado de la Bandeja {bandeja_id}.")
+            inventario = list(documento.get("inventario_actual_esperado", []))
+            nuevas = [h for h in dict.fromkeys(herramientas) if h not in inventario]
+            if not nuevas:
+                return inventario
+            version = documento["version"]
+            filtro_version = {"version": version} if version else {"version": {"$in": [0, None]}}
+            inventario += nuevas
+            resultado = self.coleccion.update_one(
+                {"bandeja_id": bandeja_id, **filtro_version},
+                {"$set": {"inventario_actual_esperado": inventario, "version": version + 1}}
+            )
+            if resultado.modified_count:
+                self._guardar_en_cache(dict(documento, inventario_actual_esperado=inventario, version=version + 1))
+                return inventario
+            # Otro escritor cambio la bandeja: se relee y se reintenta
+            print(f"Conflicto de version en Bandeja {bandeja_id} (v{version}). Reintentando...")
+            self.cargar([bandeja_id])
+        raise ConflictoVersion(f"No se pudo actualizar la Bandeja {bandeja_id} tras {self.max_reintentos} intentos.")
@@ -0,0 +1,107 @@
+"""
+Exporta el modelo entrenado (best_V3.pt) a los backends de inferencia para CPU:
+
+    python exportar_modelos.py                      # genera best_V3.onnx y best_V3_int8.onnx
+    python exportar_modelos.py --calibracion fotos/ # cuantizacion INT8 estatica con fotos reales
+    python exportar_modelos.py --verificar foto.jpg # compara las detecciones de los tres backends
+
+Luego se selecciona el backend en el .env del servidor con BACKEND_INFERENCIA.
+"""
+import os
+import glob
+import shutil
+import argparse
+import numpy as np
+from ultralytics import YOLO
+import backends_inferencia
+import preprocesamiento
+import reconocimiento_de_objetos as reconocimiento
+
+TAMANO_ENTRADA = preprocesamiento.TAMANO_ENTRADA
+
+def exportar_onnx(ruta_pt):
+    """Exporta el .pt a ONNX con batch dinamico (necesario para el analisis en lote)."""
+    print(f"Exportando '{ruta_pt}' a ONNX...")
+    ruta_generada = YOLO(ruta_pt).export(format="onnx", imgsz=TAMANO_ENTRADA, dynamic=True, simplify=True)
+    ruta_onnx = backends_inferencia.ruta_modelo_backend(ruta_pt, "onnx")
+    if os.path.abspath(ruta_generada) != os.path.abspath(ruta_onnx):
+        shutil.move(ruta_generada, ruta_onnx)
+    print(f"Modelo ONNX guardado en '{ruta_onnx}'.")
+    return ruta_onnx
+
+def _preparar_imagen_calibracion(ruta_imagen):
+    """Mismo preprocesado que en produccion y conversion a tensor NCHW float32 (igual que YOLO)."""
+    with open(ruta_imagen, 'rb') as f:
+        lienzo, _ = preprocesamiento.preparar_imagen(f.read())
+    tensor = lienzo[:, :, ::-1].transpose(2, 0, 1)[np.newaxis].astype(np.float32) / 255.0
+    return np.ascontiguousarray(tensor)
+
+def cuantizar_int8(ruta_onnx, ruta_pt, carpeta_calibracion=None):
+    """
+    Genera la variante INT8. Con una carpeta de fotos reales de las bandejas usa
+    cuantizacion estatica (mas rapida en CPU); sin ella, cuantizacion dinamica.
+    """
+    import onnx
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, CalibrationDataReader, QuantType
+
+    ruta_int8 = backends_inferencia.ruta_modelo_backend(ruta_pt, "onnx_int8")
+    if carpeta_calibracion:
+        imagenes = sorted(glob.glob(os.path.join(carpeta_calibracion, "*.jpg")))
+        if not imagenes:
+            raise RuntimeError(f"No hay imagenes .jpg en '{carpeta_calibracion}' para calibrar.")
+        nombre_entrada = onnx.load(ruta_onnx).graph.input[0].name
+
+        class LectorCalibracion(CalibrationDataReader):
+            def __init__(self):
+                self._iter = iter(imagenes)
+
+            def get_next(self):
+                ruta = next(self._iter, None)
+                return None if ruta is None else {nombre_entrada: _preparar_imagen_calibracion(ruta)}
+
+        print(f"Cuantizando a INT8 (estatica) con {len(imagenes)} imagenes de calibracion...")
+        quantize_static(ruta_onnx, ruta_int8, LectorCalibracion(), weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+    else:
+        print("Cuantizando a INT8 (dinamica)...")
+        quantize_dynamic(ruta_onnx, ruta_int8, weight_type=QuantType.QUInt8)
+
+    # La cuantizacion no conserva los metadatos; sin ellos YOLO pierde 'names' y el tamano de entrada
+    original = onnx.load(ruta_onnx)
+    cuantizado = onnx.load(ruta_int8)
+    del cuantizado.metadata_props[:]
+    cuantizado.metadata_props.extend(original.metadata_props)
+    onnx.save(cuantizado, ruta_int8)
+    print(f"Modelo INT8 guardado en '{ruta_int8}'.")
+    return ruta_int8
+
+def verificar_backends(ruta_pt, ruta_imagen):
+    """Compara nombres de clase y herramientas detectadas entre los tres backends."""
+    referencia = None
+    for backend in backends_inferencia.BACKENDS:
+        ruta_modelo = backends_inferencia.ruta_modelo_backend(ruta_pt, backend)
+        if not os.path.exists(ruta_modelo):
+            print(f"[{backend}] No existe '{ruta_modelo}', se omite.")
+            continue
+        model = backends_inferencia.cargar_modelo(ruta_modelo, backend)
+        resultado = model(ruta_imagen, conf=reconocimiento.CONFIANZA_MINIMA, iou=reconocimiento.IOU_NMS, verbose=False)[0]
+        detectadas = sorted({model.names[int(box.cls[0])] for box in resultado.boxes})
+        print(f"[{backend}] {len(detectadas)} herramientas: {', '.join(detectadas)}")
+        if referencia is None:
+            referencia = (backend, model.names, detectadas)
+            continue
+        if model.names != referencia[1]:
+            print(f"ADVERTENCIA: Los nombres de clase de '{backend}' no coinciden con '{referencia[0]}'.")
+        if detectadas != referencia[2]:
+            print(f"ADVERTENCIA: Las detecciones de '{backend}' difieren de '{referencia[0]}'.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exporta el modelo YOLO a los backends de inferencia para CPU.")
+    parser.add_argument("--modelo", default=reconocimiento.MODELO_ENTRENADO, help="Ruta al modelo .pt entrenado")
+    parser.add_argument("--calibracion", help="Carpeta con fotos .jpg de bandejas para la cuantizacion INT8 estatica")
+    parser.add_argument("--verificar", help="Foto de prueba para comparar las detecciones de los backends")
+    args = parser.parse_args()
+
+    ruta_onnx = exportar_onnx(args.modelo)
+    cuantizar_int8(ruta_onnx, args.modelo, args.calibracion)
+    if args.verificar:
+        verificar_backends(args.modelo, args.verificar)
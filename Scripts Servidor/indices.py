@@ -0,0 +1,65 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+# (coleccion, campos, opciones) de cada indice que necesita el servidor
+INDICES = [
+    ("Lista_usuarios_niveles", [("rfid_uid", ASCENDING)], {"unique": True, "name": "rfid_uid_unico"}),
+    # Sparse: solo indexa usuarios con el campo; una consulta por null/"" (usuarios sin
+    # enlazar) no puede usarlo, esa lista se sirve desde el directorio en memoria
+    ("Lista_usuarios_niveles", [("telegram_chat_id", ASCENDING)], {"sparse": True, "name": "telegram_chat_id"}),
+    ("Registro_Incidencias", [("bandeja", ASCENDING), ("fecha_reporte", DESCENDING)], {"name": "bandeja_fecha_reporte"}),
+    ("Estado_Bandejas", [("bandeja_id", ASCENDING)], {"unique": True, "name": "bandeja_id_unico"}),
+]
+
+# Consultas frecuentes cuyo plan se revisa al arrancar: (descripcion, coleccion, filtro, orden)
+CONSULTAS_FRECUENTES = [
+    ("usuario por tarjeta", "Lista_usuarios_niveles", {"rfid_uid": "00000000"}, None),
+    ("usuario por chat de Telegram", "Lista_usuarios_niveles", {"telegram_chat_id": "0"}, None),
+    ("incidencias recientes de una bandeja", "Registro_Incidencias", {"bandeja": 1}, [("fecha_reporte", DESCENDING)]),
+    ("estado de las bandejas", "Estado_Bandejas", {"bandeja_id": {"$in": [1, 2]}}, None),
+]
+
+def crear_indices(db):
+    """Crea los indices que falten (create_index no hace nada si ya existe)."""
+    for nombre_coleccion, campos, opciones in INDICES:
+        try:
+            db[nombre_coleccion].create_index(campos, **opciones)
+        except PyMongoError as e:
+            # Ej. el indice unico no se puede crear porque hay tarjetas duplicadas
+            print(f"ERROR: No se pudo crear el indice '{opciones['name']}' en {nombre_coleccion}: {e}")
+
+def _etapas(plan):
+    """Recorre el arbol del plan de ejecucion y devuelve los nombres de sus etapas."""
+    if isinstance(plan, dict):
+        etapas = [plan["stage"]] if "stage" in plan else []
+        for valor in plan.values():
+            etapas += _etapas(valor)
+        return etapas
+    if isinstance(plan, list):
+        return [etapa for elemento in plan for etapa in _etapas(elemento)]
+    return []
+
+def verificar_planes(db):
+    """Ejecuta explain() sobre las consultas frecuentes y avisa si alguna recorre toda la coleccion."""
+    correctas = True
+    for descripcion, nombre_coleccion, filtro, orden in CONSULTAS_FRECUENTES:
+        try:
+            cursor = db[nombre_coleccion].find(filtro)
+            if orden:
+                cursor = cursor.sort(orden)
+            etapas = _etapas(cursor.explain().get("queryPlanner", {}).get("winningPlan", {}))
+        except PyMongoError as e:
+            print(f"ADVERTENCIA: No se pudo revisar el plan de '{descripcion}': {e}")
+            continue
+        if "COLLSCAN" in etapas:
+            correctas = False
+            print(f"ADVERTENCIA: La consulta '{descripcion}' en {nombre_coleccion} recorre toda la coleccion (COLLSCAN).")
+        elif "SORT" in etapas:
+            print(f"ADVERTENCIA: La consulta '{descripcion}' en {nombre_coleccion} ordena en memoria (SORT sin indice).")
+    return correctas
+
+def inicializar_indices(db):
+    print("Verificando indices de la base de datos...")
+    crear_indices(db)
+    if verificar_planes(db):
+        print("Indices verificados: las consultas frecuentes usan indices.")
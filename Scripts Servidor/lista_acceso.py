@@ -0,0 +1,109 @@
+import hmac
+import time
+import hashlib
+import threading
+from collections import deque
+
+def mascara_permisos(permisos):
+    """[1, 2] -> 0b11: bit 0 para la Bandeja 1, bit 1 para la Bandeja 2."""
+    if not isinstance(permisos, list): permisos = [permisos]
+    mascara = 0
+    for bandeja in permisos:
+        try:
+            mascara |= 1 << (int(bandeja) - 1)
+        except (TypeError, ValueError):
+            pass
+    return mascara
+
+def huella_uid(clave, uid):
+    """
+    HMAC-SHA256 del UID con la clave compartida (32 hex). La lista publica solo
+    huellas: quien la descargue no obtiene UIDs para clonar tarjetas, y el Pico
+    calcula la misma huella de la tarjeta leida antes de buscarla.
+    """
+    return hmac.new(clave, str(uid).encode(), hashlib.sha256).hexdigest()[:32]
+
+def mensaje_firmado(tipo, epoca, desde, version, altas, bajas):
+    """Texto canonico que se firma; el Pico arma el mismo texto para verificar la firma."""
+    return "%s|%d|%d|%d|%s|%s" % (
+        tipo, epoca, desde, version,
+        ";".join("%s:%d" % (uid, altas[uid]) for uid in sorted(altas)),
+        ",".join(sorted(bajas)),
+    )
+
+class ListaAcceso:
+    """
+    Lista versionada y firmada (HMAC-SHA256) de las tarjetas que el servidor
+    autorizaria, con sus bandejas permitidas, para que el Pico decida localmente
+    sin esperar a /verificar_rfid. Se arma desde el directorio de usuarios en
+    memoria: solo entran usuarios con Telegram enlazado y con permisos, y cada
+    tarjeta aparece por su huella (huella_uid), nunca por su UID. Cada cambio
+    sube la version y se guarda como delta, asi el Pico pide solo lo que cambio
+    desde su version; si ya no hay historial (o el servidor se reinicio y cambio la
+    epoca) recibe la lista completa.
+    """
+    def __init__(self, directorio, clave, excluir=(), max_historial=64):
+        self.directorio = directorio
+        self.clave = clave.encode()
+        self.excluir = {uid for uid in excluir if uid}
+        self.epoca = int(time.time())
+        self.version = 0
+        self._entradas = {} # huella del rfid_uid -> mascara de bandejas
+        self._historial = deque(maxlen=max_historial) # (version, altas, bajas) de cada cambio
+        self._lock = threading.Lock()
+
+    def _calcular(self):
+        entradas = {}
+        for usuario in self.directorio.todos():
+            uid = usuario.get("rfid_uid")
+            if not uid or uid in self.excluir or not usuario.get("telegram_chat_id"):
+                continue
+            mascara = mascara_permisos(usuario.get("permisos", []))
+            if mascara:
+                entradas[huella_uid(self.clave, uid)] = mascara
+        return entradas
+
+    def actualizar(self):
+        """Compara con el directorio y, si algo cambio, sube la version y guarda el delta."""
+        entradas = self._calcular()
+        with self._lock:
+            if entradas == self._entradas and self.version:
+                return self.version
+            altas = {uid: mascara for uid, mascara in entradas.items() if self._entradas.get(uid) != mascara}
+            bajas = set(self._entradas) - set(entradas)
+            self.version += 1
+            self._historial.append((self.version, altas, bajas))
+            self._entradas = entradas
+            return self.version
+
+    def _firmar(self, tipo, desde, altas, bajas):
+        mensaje = mensaje_firmado(tipo, self.epoca, desde, self.version, altas, bajas)
+        return hmac.new(self.clave, mensaje.encode(), hashlib.sha256).hexdigest()
+
+    def respuesta(self, epoca=0, desde=0):
+        """La lista para un Pico que ya tiene la version 'desde' de la 'epoca' indicada."""
+        self.actualizar()
+        with self._lock:
+            if epoca == self.epoca and desde == self.version:
+                return {"tipo": "sin_cambios", "epoca": self.epoca, "version": self.version}
+            primera = self._historial[0][0] if self._historial else self.version + 1
+            if epoca == self.epoca and primera <= desde + 1 and desde < self.version:
+                # Se unen los deltas posteriores a 'desde'
+                altas, bajas = {}, set()
+                for version, altas_version, bajas_version in self._historial:
+                    if version <= desde:
+                        continue
+                    for uid, mascara in altas_version.items():
+                        altas[uid] = mascara
+                        bajas.discard(uid)
+                    for uid in bajas_version:
+                        altas.pop(uid, None)
+                        bajas.add(uid)
+                tipo = "delta"
+            else:
+                altas, bajas, desde, tipo = dict(self._entradas), set(), 0, "completa"
+            return {
+                "tipo": tipo, "epoca": self.epoca, "desde": desde, "version": self.version,
+                "altas": sorted([uid, mascara] for uid, mascara in altas.items()), "bajas": sorted(bajas),
+                "firma": self._firmar(tipo, desde, altas, bajas),
+            }
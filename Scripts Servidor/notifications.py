@@ -1,4 +1,7 @@
+import time
+import queue
 import smtplib
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -39,3 +42,153 @@ def send_incident_email(subject, body, receiver_email, sender_email, sender_pass
         if 'server' in locals() and server:
             server.quit()
 
+
+class ServicioNotificaciones:
+    """
+    Envia los correos desde un hilo en segundo plano reutilizando una conexion SMTP
+    autenticada (con NOOP periodico para mantenerla y reconexion si se cae).
+    Los correos que llegan en rafaga al mismo destinatario se agrupan en un solo
+    correo de resumen, y los envios fallidos se reintentan con espera exponencial.
+    Con usar_starttls=False y sin contrasena funciona contra un servidor SMTP local
+    de pruebas (ej. python -m aiosmtpd -n -l localhost:8025).
+    """
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password=None, usar_starttls=True,
+                 ventana_resumen=5.0, intervalo_keepalive=60.0, max_reintentos=6, espera_maxima_reintento=300.0, timeout=30):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        self.usar_starttls = usar_starttls
+        self.ventana_resumen = ventana_resumen # Segundos que se esperan mas correos antes de enviar
+        self.intervalo_keepalive = intervalo_keepalive
+        self.max_reintentos = max_reintentos
+        self.espera_maxima_reintento = espera_maxima_reintento
+        self.timeout = timeout
+        self._cola = queue.Queue()
+        self._servidor = None
+        self._hilo = None
+        self.enviados = 0
+        self.resumenes = 0
+        self.fallidos = 0
+
+    # --- API ---
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+        self._hilo.start()
+
+    def enviar(self, subject, body, receiver_email):
+        """Encola un correo; nunca espera al servidor SMTP."""
+        self._cola.put((subject, body, receiver_email))
+
+    def cerrar(self, espera=10):
+        """Envia lo que quede en la cola y cierra la conexion."""
+        if self._hilo:
+            self._cola.put(None)
+            self._hilo.join(espera)
+
+    # --- Conexion ---
+    def _conectar(self):
+        print(f"Conectando al servidor SMTP {self.smtp_server} en el puerto {self.smtp_port}...")
+        servidor = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        servidor.ehlo()
+        if self.usar_starttls:
+            servidor.starttls()  # Inicia una conexion segura
+            servidor.ehlo()
+        if self.sender_password:
+            servidor.login(self.sender_email, self.sender_password)
+        self._servidor = servidor
+
+    def _desconectar(self):
+        if self._servidor:
+            try:
+                self._servidor.quit()
+            except Exception:
+                pass
+            self._servidor = None
+
+    def _mantener_conexion(self):
+        """NOOP sobre la conexion abierta; si el servidor la cerro, se reabrira en el proximo envio."""
+        if not self._servidor:
+            return
+        try:
+            codigo, _ = self._servidor.noop()
+            if codigo != 250:
+                self._desconectar()
+        except Exception:
+            self._servidor = None
+
+    # --- Hilo de fondo ---
+    def _bucle(self):
+        while True:
+            try:
+                primero = self._cola.get(timeout=self.intervalo_keepalive)
+            except queue.Empty:
+                self._mantener_conexion()
+                continue
+            if primero is None:
+                break
+            lote, cerrar = self._juntar_rafaga(primero)
+            for receiver_email, correos in lote.items():
+                self._enviar_con_reintentos(receiver_email, *self._resumir(correos))
+            if cerrar:
+                break
+        self._desconectar()
+
+    def _juntar_rafaga(self, primero):
+        """Junta los correos que lleguen durante la ventana de resumen, por destinatario."""
+        lote = {}
+        correo, cerrar = primero, False
+        limite = time.monotonic() + self.ventana_resumen
+        while True:
+            subject, body, receiver_email = correo
+            lote.setdefault(receiver_email, []).append((subject, body))
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                correo = self._cola.get(timeout=restante)
+            except queue.Empty:
+                break
+            if correo is None:
+                cerrar = True
+                break
+        return lote, cerrar
+
+    def _resumir(self, correos):
+        if len(correos) == 1:
+            return correos[0]
+        self.resumenes += 1
+        subject = f"Resumen de {len(correos)} notificaciones de la Caja de Herramientas"
+        separador = "\n\n" + "-" * 40 + "\n\n"
+        body = separador.join(f"{asunto}\n\n{cuerpo}" for asunto, cuerpo in correos)
+        return subject, body
+
+    def _enviar_con_reintentos(self, receiver_email, subject, body):
+        message = MIMEMultipart()
+        message["From"] = self.sender_email
+        message["To"] = receiver_email
+        message["Subject"] = subject
+        message.attach(MIMEText(body, "plain"))
+        text = message.as_string()
+
+        espera = 1.0
+        for intento in range(1, self.max_reintentos + 1):
+            try:
+                if not self._servidor:
+                    self._conectar()
+                self._servidor.sendmail(self.sender_email, receiver_email, text)
+                self.enviados += 1
+                print(f"Correo '{subject}' enviado a {receiver_email}.")
+                return True
+            except smtplib.SMTPRecipientsRefused as e:
+                # Reintentar no sirve si el destinatario es invalido
+                print(f"Correo '{subject}' rechazado por el servidor: {e}")
+                break
+            except Exception as e:
+                print(f"Error al enviar el correo '{subject}' (intento {intento}/{self.max_reintentos}): {e}")
+                self._desconectar()
+                if intento < self.max_reintentos:
+                    time.sleep(espera)
+                    espera = min(espera * 2, self.espera_maxima_reintento)
+        self.fallidos += 1
+        return False
@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import reconocimiento_de_objetos as reconocimiento
+
+class ColaInferenciaLlena(Exception):
+    """Se lanza cuando ya hay demasiados analisis pendientes en el pool."""
+    pass
+
+_barrera_arranque = None # Barrera compartida por los workers de un mismo executor
+
+def _inicializar_worker(hilos_por_worker, backend, barrera):
+    """
+    Se ejecuta una vez al arrancar cada proceso del pool: limita los hilos de
+    torch para no sobresuscribir la CPU y deja el modelo cargado y caliente.
+    """
+    global _barrera_arranque
+    _barrera_arranque = barrera
+    reconocimiento.configurar_backend(backend)
+    try:
+        import torch
+        torch.set_num_threads(hilos_por_worker)
+    except Exception as e:
+        print(f"No se pudo limitar los hilos de torch en el worker: {e}")
+    reconocimiento.precargar_modelos()
+
+def _worker_listo(espera_maxima):
+    """
+    Tarea de arranque: espera en la barrera a que todos los workers hayan cargado
+    su modelo, asi ningun worker rapido toma la tarea de arranque de otro.
+    """
+    try:
+        _barrera_arranque.wait(espera_maxima)
+    except threading.BrokenBarrierError:
+        pass
+    return os.getpid()
+
+class PoolInferencia:
+    """
+    Pool de procesos para ejecutar la inferencia YOLO fuera del event loop.
+    Cada worker mantiene su propia copia del modelo ya cargada. Si un worker
+    muere (ej. sin memoria) el executor queda roto: se crea uno nuevo y el
+    analisis en curso lanza BrokenProcessPool para que el llamador avise al usuario.
+    """
+    ESPERA_ARRANQUE_SEGUNDOS = 300 # Maximo para que todos los workers carguen y calienten su modelo
+
+    def __init__(self, num_workers=None, max_pendientes=None, backend=reconocimiento.BACKEND_POR_DEFECTO):
+        cpus = os.cpu_count() or 2
+        self.num_workers = num_workers or max(1, cpus - 1)
+        self.max_pendientes = max_pendientes or self.num_workers * 2
+        self.hilos_por_worker = max(1, cpus // self.num_workers)
+        self.backend = backend
+        self._executor = None
+        self._pendientes = 0
+        self._lock = threading.Lock()
+
+    def iniciar(self, esperar=True):
+        """
+        Crea los procesos del pool y los arranca ya: el executor solo crea los
+        workers al recibir tareas, asi que se envia una tarea de arranque por
+        worker. Con esperar=True (bloque __main__) no vuelve hasta que todos
+        tienen el modelo cargado y caliente, y la primera foto paga solo la inferencia.
+        """
+        print(f"Iniciando pool de inferencia con {self.num_workers} workers, backend '{self.backend}' (max. {self.max_pendientes} analisis pendientes)...")
+        # 'spawn' evita heredar hilos y estado de torch del proceso principal
+        contexto = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=contexto,
+            initializer=_inicializar_worker,
+            initargs=(self.hilos_por_worker, self.backend, contexto.Barrier(self.num_workers))
+        )
+        inicio = time.monotonic()
+        tareas = [self._executor.submit(_worker_listo, self.ESPERA_ARRANQUE_SEGUNDOS) for _ in range(self.num_workers)]
+        if esperar:
+            wait(tareas, timeout=self.ESPERA_ARRANQUE_SEGUNDOS)
+            listos = {tarea.result() for tarea in tareas if tarea.done() and not tarea.exception()}
+            print(f"Pool de inferencia listo: {len(listos)}/{self.num_workers} workers con el modelo cargado en {time.monotonic() - inicio:.1f} s.")
+
+    def hay_capacidad(self):
+        """Indica si se puede aceptar un nuevo analisis sin superar la cola maxima."""
+        return self._pendientes < self.max_pendientes
+
+    def pendientes(self):
+        return self._pendientes
+
+    async def analizar(self, datos_imagen, bandeja_id):
+        """
+        Envia los bytes de una foto al pool y espera el resultado sin bloquear el
+        event loop. El worker la decodifica en memoria y no escribe nada en disco.
+        Lanza ColaInferenciaLlena si la cola esta al limite.
+        """
+        if self._executor is None:
+            raise RuntimeError("El pool de inferencia no ha sido iniciado.")
+        with self._lock:
+            if self._pendientes >= self.max_pendientes:
+                raise ColaInferenciaLlena(f"{self._pendientes} analisis pendientes")
+            self._pendientes += 1
+        executor = self._executor
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, reconocimiento.analizar_inventario_ia, datos_imagen, bandeja_id, False)
+        except BrokenProcessPool:
+            self._reiniciar(executor)
+            raise
+        finally:
+            with self._lock:
+                self._pendientes -= 1
+
+    async def analizar_lote(self, pares):
+        """
+        Analiza varias (datos_imagen, bandeja_id) en una sola pasada del modelo.
+        Cuenta una plaza de la cola por cada imagen del lote.
+        """
+        if self._executor is None:
+            raise RuntimeError("El pool de inferencia no ha sido iniciado.")
+        with self._lock:
+            if self._pendientes and self._pendientes + len(pares) > self.max_pendientes:
+                raise ColaInferenciaLlena(f"{self._pendientes} analisis pendientes")
+            self._pendientes += len(pares)
+        executor = self._executor
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, reconocimiento.analizar_inventario_lote, pares, False)
+        except BrokenProcessPool:
+            self._reiniciar(executor)
+            raise
+        finally:
+            with self._lock:
+                self._pendientes -= len(pares)
+
+    def _reiniciar(self, executor_roto):
+        """Reemplaza el executor roto; si varios analisis fallan a la vez, solo el primero lo recrea."""
+        with self._lock:
+            if self._executor is not executor_roto:
+                return # Ya se reinicio, o el pool se cerro
+            print("El pool de inferencia perdio un worker. Reiniciando...")
+            executor_roto.shutdown(wait=False, cancel_futures=True)
+            self.iniciar(esperar=False) # Los workers nuevos cargan el modelo sin bloquear el event loop
+
+    def cerrar(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
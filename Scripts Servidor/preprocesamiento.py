@@ -0,0 +1,74 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+TAMANO_ENTRADA = 640 # Lado de la entrada del modelo (imgsz con el que se entreno y exporto)
+COLOR_RELLENO = 114 # Gris que usa YOLO para rellenar el letterbox
+
+def decodificar_orientada(datos_imagen, lado_largo_minimo=None):
+    """
+    Decodifica la foto aplicando la orientacion EXIF y la devuelve como arreglo BGR.
+    Si se indica lado_largo_minimo, los JPEG se decodifican directamente a una
+    escala reducida (1/2, 1/4 o 1/8) que conserve al menos ese tamano.
+    """
+    imagen = Image.open(io.BytesIO(datos_imagen))
+    if lado_largo_minimo and imagen.format == "JPEG":
+        ancho, alto = imagen.size
+        escala = lado_largo_minimo / max(ancho, alto)
+        if escala < 1:
+            imagen.draft("RGB", (int(ancho * escala), int(alto * escala)))
+    imagen = ImageOps.exif_transpose(imagen)
+    return np.ascontiguousarray(np.asarray(imagen.convert("RGB"))[:, :, ::-1])
+
+def recortar_roi(imagen, roi):
+    """Recorta la region de interes (fracciones x0, y0, x1, y1). Devuelve la vista y su origen."""
+    if not roi:
+        return imagen, 0, 0
+    alto, ancho = imagen.shape[:2]
+    x0, y0, x1, y1 = (np.clip(roi, 0, 1) * [ancho, alto, ancho, alto]).astype(int)
+    return imagen[y0:y1, x0:x1], x0, y0
+
+def letterbox(imagen, tamano=TAMANO_ENTRADA):
+    """Redimensiona manteniendo la proporcion y rellena hasta un cuadrado de 'tamano' pixeles."""
+    alto, ancho = imagen.shape[:2]
+    escala = tamano / max(alto, ancho)
+    nuevo_ancho, nuevo_alto = int(round(ancho * escala)), int(round(alto * escala))
+    interpolacion = cv2.INTER_AREA if escala < 1 else cv2.INTER_LINEAR
+    redimensionada = cv2.resize(imagen, (nuevo_ancho, nuevo_alto), interpolation=interpolacion)
+    lienzo = np.full((tamano, tamano, 3), COLOR_RELLENO, dtype=np.uint8)
+    dx, dy = (tamano - nuevo_ancho) // 2, (tamano - nuevo_alto) // 2
+    lienzo[dy:dy + nuevo_alto, dx:dx + nuevo_ancho] = redimensionada
+    return lienzo, escala, dx, dy
+
+def preparar_imagen(datos_imagen, roi=None, tamano=TAMANO_ENTRADA):
+    """
+    Etapa completa de preprocesado de una bandeja: decodificacion con orientacion
+    EXIF, recorte a la ROI y letterbox al tamano de entrada del modelo.
+    Devuelve (imagen lista para el modelo, transformacion para deshacer las coordenadas).
+    """
+    # Basta con que la ROI conserve 'tamano' pixeles en su lado largo
+    fraccion = min(roi[2] - roi[0], roi[3] - roi[1]) if roi else 1.0
+    imagen = decodificar_orientada(datos_imagen, lado_largo_minimo=int(tamano / max(fraccion, 1e-3)))
+    alto_total, ancho_total = imagen.shape[:2]
+    recorte, x0, y0 = recortar_roi(imagen, roi)
+    lienzo, escala, dx, dy = letterbox(recorte, tamano)
+    transformacion = {"escala": escala, "dx": dx, "dy": dy, "x0": x0, "y0": y0, "ancho": ancho_total, "alto": alto_total}
+    return lienzo, transformacion
+
+def transformacion_identidad(imagen):
+    """Transformacion para una imagen que se pasa al modelo tal cual."""
+    alto, ancho = imagen.shape[:2]
+    return {"escala": 1.0, "dx": 0, "dy": 0, "x0": 0, "y0": 0, "ancho": ancho, "alto": alto}
+
+def normalizar_cajas(cajas_xyxy, transformacion):
+    """
+    Convierte cajas en coordenadas de la entrada del modelo a fracciones (0-1) de la
+    foto original orientada, para poder dibujarlas sobre ella a cualquier resolucion.
+    """
+    t = transformacion
+    cajas = np.asarray(cajas_xyxy, dtype=np.float32).reshape(-1, 4)
+    desplazamiento = np.array([t["dx"], t["dy"], t["dx"], t["dy"]], dtype=np.float32)
+    origen = np.array([t["x0"], t["y0"], t["x0"], t["y0"]], dtype=np.float32)
+    dimensiones = np.array([t["ancho"], t["alto"], t["ancho"], t["alto"]], dtype=np.float32)
+    return np.clip(((cajas - desplazamiento) / t["escala"] + origen) / dimensiones, 0, 1)
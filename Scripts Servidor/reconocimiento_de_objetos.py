@@ -1,6 +1,14 @@
-from ultralytics import YOLO
+import os
+import threading
+import cv2
+import numpy as np
+import backends_inferencia
+import preprocesamiento
 
 MODELO_ENTRENADO = "best_V3.pt"
+BACKEND_POR_DEFECTO = "pytorch" # pytorch | onnx | onnx_int8 (ver backends_inferencia.BACKENDS)
+CONFIANZA_MINIMA = 0.8
+IOU_NMS = 0.5 #iou sirve para filtrar las cajas que se solapan, mediante el valor de interseccion sobre union
 
 INVENTARIO_BANDEJA_1 = [
     "llave_6",
@@ -23,43 +31,189 @@ INVENTARIO_BANDEJA_2 = [
     "plano_peque",
 ]
 
-def analizar_inventario_ia(ruta_imagen, bandeja_id):
+# Region de interes de cada bandeja dentro de la foto, como fracciones (x0, y0, x1, y1)
+# de la imagen ya orientada. None = se analiza la foto completa.
+ROI_BANDEJA_1 = None
+ROI_BANDEJA_2 = None
+ROI_BANDEJAS = {"1": ROI_BANDEJA_1, "2": ROI_BANDEJA_2}
+
+# --- Registro de Modelos ---
+# Cada archivo de modelo se carga una sola vez por proceso y se reutiliza en
+# todas las auditorias. Se guarda el mtime para recargarlo si el archivo cambia.
+_modelos_cargados = {}
+_lock_modelos = threading.Lock()
+_backend_activo = BACKEND_POR_DEFECTO
+
+def configurar_backend(backend):
+    """Selecciona el backend de inferencia que usara este proceso."""
+    global _backend_activo
+    backends_inferencia.ruta_modelo_backend(MODELO_ENTRENADO, backend) # Valida el nombre
+    _backend_activo = backend
+    print(f"Backend de inferencia seleccionado: {backend}")
+
+def ruta_modelo_activo():
+    """Ruta del archivo de modelo correspondiente al backend activo."""
+    return backends_inferencia.ruta_modelo_backend(MODELO_ENTRENADO, _backend_activo)
+
+def version_modelo():
+    """Identifica la version del modelo activo (backend + fecha del archivo) sin cargarlo."""
+    ruta = ruta_modelo_activo()
+    try:
+        mtime = os.path.getmtime(ruta)
+    except OSError:
+        mtime = 0
+    return f"{_backend_activo}:{os.path.basename(ruta)}:{mtime}"
+
+def version_pipeline():
+    """Version del modelo mas la configuracion de preprocesado; cambia si cambia cualquiera de los dos."""
+    return f"{version_modelo()}|{preprocesamiento.TAMANO_ENTRADA}|{ROI_BANDEJAS}"
+
+def _calentar_modelo(model):
+    """Ejecuta una inferencia sobre una imagen vacia para inicializar el grafo."""
+    imagen_vacia = np.zeros((preprocesamiento.TAMANO_ENTRADA, preprocesamiento.TAMANO_ENTRADA, 3), dtype=np.uint8)
+    model(imagen_vacia, conf=CONFIANZA_MINIMA, iou=IOU_NMS, imgsz=preprocesamiento.TAMANO_ENTRADA, verbose=False)
+
+def obtener_modelo(ruta_modelo=None):
+    """
+    Devuelve la instancia cacheada del modelo (por defecto, el del backend activo).
+    Si el archivo cambio en disco (mtime distinto) lo vuelve a cargar y calentar
+    antes de devolverlo.
+    """
+    ruta_modelo = ruta_modelo or ruta_modelo_activo()
+    backend = _backend_activo
+    mtime = os.path.getmtime(ruta_modelo)
+    with _lock_modelos:
+        entrada = _modelos_cargados.get(ruta_modelo)
+        if entrada is None or entrada["mtime"] != mtime:
+            print(f"Cargando modelo YOLO desde '{ruta_modelo}' (backend: {backend})...")
+            try:
+                model = backends_inferencia.cargar_modelo(ruta_modelo, backend)
+                backends_inferencia.verificar_nombres_clases(model, INVENTARIO_BANDEJA_1 + INVENTARIO_BANDEJA_2)
+                _calentar_modelo(model)
+            except Exception as e:
+                # Si la recarga falla (ej. archivo a medio copiar) se sigue usando el modelo anterior
+                if entrada is None:
+                    raise
+                print(f"Error al recargar el modelo, se mantiene la version anterior: {e}")
+                return entrada["modelo"]
+            entrada = {"modelo": model, "mtime": mtime}
+            _modelos_cargados[ruta_modelo] = entrada
+            print(f"Modelo '{ruta_modelo}' cargado y listo.")
+    return entrada["modelo"]
+
+def precargar_modelos(rutas=None):
+    """Carga y calienta los modelos al arrancar el servidor."""
+    for ruta in rutas or [ruta_modelo_activo()]:
+        try:
+            obtener_modelo(ruta)
+        except Exception as e:
+            print(f"ERROR: No se pudo precargar el modelo '{ruta}': {e}")
+
+def _preparar_entrada(imagen, bandeja_id):
+    """
+    Acepta una ruta, los bytes de la foto o un arreglo BGR ya preparado.
+    Las rutas y los bytes pasan por el preprocesado de la bandeja (EXIF, ROI, letterbox).
+    Devuelve (imagen para el modelo, transformacion de coordenadas).
+    """
+    if isinstance(imagen, str):
+        with open(imagen, 'rb') as f:
+            imagen = f.read()
+    if isinstance(imagen, (bytes, bytearray, memoryview)):
+        return preprocesamiento.preparar_imagen(bytes(imagen), ROI_BANDEJAS.get(str(bandeja_id)))
+    return imagen, preprocesamiento.transformacion_identidad(imagen)
+
+def analizar_inventario_ia(imagen, bandeja_id, guardar_resultado=True):
     """
     Analiza una imagen usando un modelo YOLOv8 entrenado.
-    Devuelve un diccionario con los resultados y la ruta a la imagen con las detecciones.
+    'imagen' puede ser la ruta a un archivo, los bytes de la foto o un arreglo BGR.
+    Devuelve un diccionario con los resultados y la ruta a la imagen con las detecciones
+    (solo si se paso una ruta y guardar_resultado es True; si no, None).
     """
     try:
-        model = YOLO(MODELO_ENTRENADO)
-        results = model(ruta_imagen, conf=0.8, iou=0.5) #iou sirve para filtrar las cajas que se solapan, mediante el valor de interseccion sobre union
+        entrada, transformacion = _preparar_entrada(imagen, bandeja_id)
+        model = obtener_modelo()
+        results = model(entrada, conf=CONFIANZA_MINIMA, iou=IOU_NMS, imgsz=preprocesamiento.TAMANO_ENTRADA)
     except Exception as e:
         print(f"Error al cargar o usar el modelo YOLO: {e}")
         return {"error": str(e), "herramientas_detectadas": []}, None
 
+    return _generar_reporte(model, results[0], transformacion, imagen, bandeja_id, guardar_resultado)
+
+def analizar_inventario_lote(pares, guardar_resultado=True):
+    """
+    Analiza varias bandejas en una sola pasada del modelo.
+    Recibe una lista de tuplas (imagen, bandeja_id) y devuelve una lista
+    de (reporte, ruta_resultado) en el mismo orden, una por bandeja.
+    """
+    try:
+        preparadas = [_preparar_entrada(imagen, bandeja_id) for imagen, bandeja_id in pares]
+        model = obtener_modelo()
+        results = model([entrada for entrada, _ in preparadas], conf=CONFIANZA_MINIMA, iou=IOU_NMS,
+                        imgsz=preprocesamiento.TAMANO_ENTRADA, batch=len(preparadas))
+    except Exception as e:
+        print(f"Error al cargar o usar el modelo YOLO: {e}")
+        return [({"error": str(e), "herramientas_detectadas": []}, None) for _ in pares]
+
+    return [_generar_reporte(model, r, transformacion, imagen, bandeja_id, guardar_resultado)
+            for r, (_, transformacion), (imagen, bandeja_id) in zip(results, preparadas, pares)]
+
+def _generar_reporte(model, resultado, transformacion, imagen, bandeja_id, guardar_resultado):
+    """Construye el reporte de una bandeja a partir del resultado YOLO de su imagen."""
     herramientas_detectadas = set()
+    detecciones = []
+
+    # Las cajas se guardan como fracciones de la foto original para poder dibujarlas
+    # despues, solo si alguien pide verlas
+    cajas = preprocesamiento.normalizar_cajas(resultado.boxes.xyxy.cpu().numpy(), transformacion)
     
     # Procesar los resultados
-    for r in results:
-        for box in r.boxes:
-            # Obtener el ID de la clase detectada
-            cls_id = int(box.cls[0])
-            # Obtener el nombre de la herramienta a partir del ID
-            nombre_herramienta = model.names[cls_id]
-            herramientas_detectadas.add(nombre_herramienta)
+    for box, caja in zip(resultado.boxes, cajas):
+        # Obtener el ID de la clase detectada
+        cls_id = int(box.cls[0])
+        # Obtener el nombre de la herramienta a partir del ID
+        nombre_herramienta = model.names[cls_id]
+        herramientas_detectadas.add(nombre_herramienta)
+        detecciones.append({
+            "herramienta": nombre_herramienta,
+            "confianza": round(float(box.conf[0]), 3),
+            "caja": [round(float(v), 4) for v in caja]
+        })
     
-    # Guardar la imagen con las detecciones dibujadas para enviarla de vuelta al usuario
-    ruta_resultado = ruta_imagen.replace(".jpg", "_resultado.jpg")
-    try:
-        results[0].save(filename=ruta_resultado)
-    except Exception as e:
-        print(f"Error al guardar imagen de resultado: {e}")
-        ruta_resultado = None # No se pudo guardar la imagen
+    # Guardar la imagen con las detecciones dibujadas (solo en el modo con archivos en disco)
+    ruta_resultado = None
+    if guardar_resultado and isinstance(imagen, str):
+        ruta_resultado = imagen.replace(".jpg", "_resultado.jpg")
+        try:
+            resultado.save(filename=ruta_resultado)
+        except Exception as e:
+            print(f"Error al guardar imagen de resultado: {e}")
+            ruta_resultado = None # No se pudo guardar la imagen
     
     # El reporte ahora incluye el inventario ideal para esa bandeja,
     # lo que facilita la comparación en el servidor principal.
     reporte = {
         "bandeja_id": bandeja_id,
         "herramientas_detectadas": list(herramientas_detectadas),
+        "detecciones": detecciones,
         "inventario_ideal": INVENTARIO_BANDEJA_1 if str(bandeja_id) == '1' else INVENTARIO_BANDEJA_2
     }
     
     return reporte, ruta_resultado
+
+def renderizar_detecciones(datos_imagen, reporte):
+    """
+    Dibuja las detecciones de un reporte sobre la foto original y devuelve el JPEG
+    resultante en memoria. Se llama solo cuando alguien pide ver la imagen anotada.
+    """
+    imagen = preprocesamiento.decodificar_orientada(datos_imagen)
+    alto, ancho = imagen.shape[:2]
+    for deteccion in reporte.get("detecciones", []):
+        fx1, fy1, fx2, fy2 = deteccion["caja"]
+        x1, y1, x2, y2 = int(fx1 * ancho), int(fy1 * alto), int(fx2 * ancho), int(fy2 * alto)
+        etiqueta = f"{deteccion['herramienta']} {deteccion['confianza']:.2f}"
+        cv2.rectangle(imagen, (x1, y1), (x2, y2), (0, 200, 0), 2)
+        cv2.putText(imagen, etiqueta, (x1, max(y1 - 6, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 200, 0), 1, cv2.LINE_AA)
+    ok, jpeg = cv2.imencode(".jpg", imagen)
+    if not ok:
+        raise ValueError("No se pudo codificar la imagen anotada.")
+    return jpeg.tobytes()
@@ -1,15 +1,28 @@
 import os
 import time
-import threading
+import asyncio
 import logging
 import datetime
-from flask import Flask, request, jsonify
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from aiohttp import web
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 import reconocimiento_de_objetos as reconocimiento 
 import notifications
+from pool_inferencia import PoolInferencia, ColaInferenciaLlena
+from cache_inferencia import CacheInferencia
+from broker_comandos import BrokerComandos
+import sesiones as gestor_sesiones
+from directorio_usuarios import DirectorioUsuarios
+from estado_bandejas import EstadoBandejas, ConflictoVersion
+from diario_incidencias import DiarioIncidencias
+import indices
+from despachador_telegram import DespachadorTelegram
+from trazas import Trazador
+from lista_acceso import ListaAcceso
 
 # --- Cargar Variables de Entorno ---
 load_dotenv()
@@ -18,40 +31,106 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 MASTER_UID = os.getenv("MASTER_UID")
 DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER", "imagenes_recibidas")
+ARCHIVAR_FOTOS = os.getenv("ARCHIVAR_FOTOS", "1") == "1" # Copia de las fotos en DOWNLOAD_FOLDER (en segundo plano)
 EMAIL_SENDER_ADDRESS = os.getenv("EMAIL_SENDER_ADDRESS")
 EMAIL_SENDER_PASSWORD = os.getenv("EMAIL_SENDER_PASSWORD")
 CORREO_ADMIN = os.getenv("CORREO_ADMIN")
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1" # 0 para un servidor SMTP local de pruebas
+CORREO_VENTANA_RESUMEN = float(os.getenv("CORREO_VENTANA_RESUMEN", 5)) # Segundos para agrupar correos en un resumen
+TELEGRAM_TASA_POR_CHAT = float(os.getenv("TELEGRAM_TASA_POR_CHAT", 1)) # Mensajes por segundo a un mismo chat
+TELEGRAM_TASA_GLOBAL = float(os.getenv("TELEGRAM_TASA_GLOBAL", 25)) # Mensajes por segundo en total (limite de Telegram: 30)
+INFERENCIA_WORKERS = int(os.getenv("INFERENCIA_WORKERS", 0)) or None # 0 = numero de CPUs - 1
+INFERENCIA_MAX_PENDIENTES = int(os.getenv("INFERENCIA_MAX_PENDIENTES", 0)) or None # 0 = 2 por worker
+BACKEND_INFERENCIA = os.getenv("BACKEND_INFERENCIA", reconocimiento.BACKEND_POR_DEFECTO) # pytorch | onnx | onnx_int8
+CACHE_INFERENCIA_CAPACIDAD = int(os.getenv("CACHE_INFERENCIA_CAPACIDAD", 256))
+CACHE_INFERENCIA_ARCHIVO = os.getenv("CACHE_INFERENCIA_ARCHIVO", "cache_inferencia.json")
+CACHE_HASH_PERCEPTUAL = os.getenv("CACHE_HASH_PERCEPTUAL", "0") == "1"
+ULTIMAS_FOTOS_MAXIMO = int(os.getenv("ULTIMAS_FOTOS_MAXIMO", 64)) # Fotos guardadas para 'Ver Detecciones' (las mas antiguas se descartan)
+ULTIMAS_FOTOS_TTL_SEGUNDOS = float(os.getenv("ULTIMAS_FOTOS_TTL_SEGUNDOS", 3600)) # Tambien se descartan pasado este tiempo
+DISPOSITIVO_POR_DEFECTO = os.getenv("DISPOSITIVO_POR_DEFECTO", "caja_1") # Para Picos que no envian su ID
+ESPERA_ACK_COMANDO = float(os.getenv("ESPERA_ACK_COMANDO", 5)) # Segundos antes de reentregar un comando sin ack
+DIRECTORIO_TTL_SEGUNDOS = int(os.getenv("DIRECTORIO_TTL_SEGUNDOS", 300)) # Recarga de usuarios si no hay change streams
+DIARIO_INCIDENCIAS_ARCHIVO = os.getenv("DIARIO_INCIDENCIAS_ARCHIVO", "diario_incidencias.jsonl")
+LISTA_ACCESO_CLAVE = os.getenv("LISTA_ACCESO_CLAVE") # Clave compartida con los Pico; sin ella no se publica la lista de acceso
 
 # --- Configuración Inicial ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-client = MongoClient(MONGO_URI)
-db = client.Caja_de_Herramientas_Usuarios
-users_collection = db.Lista_usuarios_niveles
-incidents_collection = db.Registro_Incidencias
-estado_bandejas_collection = db.Estado_Bandejas 
+trazador = Trazador() # Latencias de punta a punta (toque de tarjeta -> servo) y de cada etapa
+
+# Se crean en inicializar_recursos(), desde el bloque __main__: los workers del pool de
+# inferencia ('spawn') vuelven a importar este archivo y no deben conectarse a MongoDB,
+# leer la cache ni crear carpetas.
+client = db = None
+directorio_usuarios = None
+estado_bandejas = None
+lista_acceso = None # Tarjetas autorizadas que el Pico puede decidir localmente
+servicio_notificaciones = None
+diario_incidencias = None # Las incidencias se guardan en disco y luego en MongoDB
+pool_inferencia = None
+cache_inferencia = None
+
+def inicializar_recursos():
+    """Crea las conexiones y servicios del servidor (solo en el proceso principal)."""
+    global client, db, directorio_usuarios, estado_bandejas, lista_acceso
+    global servicio_notificaciones, diario_incidencias, pool_inferencia, cache_inferencia
+    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    client = MongoClient(MONGO_URI)
+    db = client.Caja_de_Herramientas_Usuarios
+    directorio_usuarios = DirectorioUsuarios(db.Lista_usuarios_niveles, DIRECTORIO_TTL_SEGUNDOS)
+    estado_bandejas = EstadoBandejas(db.Estado_Bandejas)
+    # La tarjeta maestra siempre pasa por el servidor
+    lista_acceso = ListaAcceso(directorio_usuarios, LISTA_ACCESO_CLAVE, excluir=[MASTER_UID]) if LISTA_ACCESO_CLAVE else None
+    servicio_notificaciones = notifications.ServicioNotificaciones(
+        SMTP_SERVER, SMTP_PORT, EMAIL_SENDER_ADDRESS, EMAIL_SENDER_PASSWORD, SMTP_STARTTLS, CORREO_VENTANA_RESUMEN
+    )
+    diario_incidencias = DiarioIncidencias(db.Registro_Incidencias, DIARIO_INCIDENCIAS_ARCHIVO, trazador=trazador)
+    reconocimiento.configurar_backend(BACKEND_INFERENCIA)
+    pool_inferencia = PoolInferencia(INFERENCIA_WORKERS, INFERENCIA_MAX_PENDIENTES, BACKEND_INFERENCIA)
+    cache_inferencia = CacheInferencia(CACHE_INFERENCIA_CAPACIDAD, CACHE_INFERENCIA_ARCHIVO, CACHE_HASH_PERCEPTUAL)
 
 # --- Variables de Estado Global ---
-session = {"state": "INACTIVE"}
+sesiones = gestor_sesiones.crear_gestor() # Una sesion por caja (ID del Pico)
 admin_state = {} 
-command_queue = []
+broker_comandos = BrokerComandos(ESPERA_ACK_COMANDO)
+dispositivo_admin = DISPOSITIVO_POR_DEFECTO # Caja donde se paso la tarjeta maestra por ultima vez
+ESPERA_MAXIMA_POLL = 25 # Segundos maximos que /poll_command retiene una peticion sin comandos
+ultimo_evento_pico = {} # device -> (boot, ultimo seq procesado), para descartar eventos reenviados
+candados_eventos_pico = {} # device -> asyncio.Lock: los lotes de un mismo Pico se procesan de a uno
 telegram_app = None
+PUERTO_HTTP = int(os.getenv("PUERTO_HTTP", 5000)) # API de los Pico
+KEEPALIVE_HTTP_SEGUNDOS = float(os.getenv("KEEPALIVE_HTTP_SEGUNDOS", 75)) # Los Pico reutilizan su conexion (HTTP/1.1 keep-alive)
+despachador = DespachadorTelegram(TELEGRAM_TASA_POR_CHAT, tasa_global=TELEGRAM_TASA_GLOBAL, trazador=trazador) # Todos los mensajes salientes pasan por aqui
+albumes_pendientes = {} # media_group_id -> fotos de un album aun sin analizar
+ESPERA_ALBUM_SEGUNDOS = 1.5 # Tiempo para recibir todas las fotos de un album antes de analizarlas
+ultimas_fotos = OrderedDict() # (user_chat_id, bandeja) -> (bytes de la foto o la foto de Telegram sin descargar, reporte, instante), para dibujar las detecciones bajo demanda
+tareas_archivo = set() # Escrituras a disco en curso (se guarda la referencia para que no se descarten)
 
 # =================================================================================
 # Lógica de Telegram y Callbacks
 # =================================================================================
 
-async def send_message(chat_id, message, reply_markup=None, photo_path=None):
-    if telegram_app:
-        try:
-            if photo_path and os.path.exists(photo_path):
-                await telegram_app.bot.send_photo(chat_id=chat_id, photo=open(photo_path, 'rb'), caption=message, reply_markup=reply_markup)
-            else:
-                await telegram_app.bot.send_message(chat_id=chat_id, text=message, reply_markup=reply_markup)
-        except Exception as e:
-            print(f"Error al enviar mensaje a {chat_id}: {e}")
+async def send_message(chat_id, message, reply_markup=None, photo=None):
+    """Encola el mensaje en el despachador sin esperar a Telegram. 'photo' puede ser bytes o una ruta."""
+    despachador.encolar(chat_id, message, reply_markup, photo)
+
+def encolar_comando(device_id, *comandos, traza=None):
+    """Agrega comandos para el Pico indicado y despierta a sus peticiones de long-poll en espera."""
+    if traza:
+        # El ID de traza viaja con el comando hasta el ack del Pico
+        comandos = [dict(comando, trace=traza) for comando in comandos]
+        trazador.esperar_comandos(traza, len(comandos))
+    broker_comandos.encolar(device_id, *comandos)
+    if traza:
+        trazador.marcar(traza, "encolado")
+
+def avisar_modo_admin(activo):
+    """
+    Avisa al Pico de la caja administrada que la proxima tarjeta es para registrar
+    o enlazar un usuario: mientras tanto no abre bandejas con su lista local.
+    """
+    encolar_comando(dispositivo_admin, {"command": "modo_admin", "activo": activo})
 
 async def admin_menu_callback(context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
@@ -65,25 +144,102 @@ async def admin_menu_callback(context: ContextTypes.DEFAULT_TYPE):
     await send_message(ADMIN_CHAT_ID, "Modo Administrador Activado. Selecciona una opcion:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def checkin_timeout_callback(context: ContextTypes.DEFAULT_TYPE):
-    global session
     job_data = context.job.data
     tray_id = job_data["tray_id"]
     user_chat_id = job_data["user_chat_id"]
+    box_id = job_data["box_id"]
     
-    if session.get("state") == f"MULTI_CHECKIN_PENDIENTE_FOTO_{tray_id}" or session.get("state") == "ABIERTA_ESPERANDO_FOTO_INICIAL":
-        print(f"Timeout de Check-in para Bandeja {tray_id}. Registrando incidencia.")
-        incidents_collection.insert_one({
-            "incidencia": "Falta foto de Check-in",
-            "usuario_responsable": session.get("user"), "uid_responsable": session.get("uid"),
-            "fecha_reporte": datetime.datetime.now(datetime.timezone.utc), "bandeja": int(tray_id)
-        })
-        session["state"] = "EN_USO"
+    with sesiones.bloqueo(box_id):
+        session = sesiones.obtener(box_id)
+        vencido = session.get("user_chat_id") == user_chat_id and (session.get("state") == f"MULTI_CHECKIN_PENDIENTE_FOTO_{tray_id}" or session.get("state") == "ABIERTA_ESPERANDO_FOTO_INICIAL")
+        if vencido:
+            session["state"] = "EN_USO"
+            vencido = sesiones.guardar(session)
+        if vencido:
+            print(f"Timeout de Check-in para Bandeja {tray_id} (caja {box_id}). Registrando incidencia.")
+            diario_incidencias.registrar({
+                "incidencia": "Falta foto de Check-in",
+                "usuario_responsable": session.get("user"), "uid_responsable": session.get("uid"),
+                "fecha_reporte": datetime.datetime.now(datetime.timezone.utc), "bandeja": int(tray_id)
+            })
+    if vencido:
         await send_message(user_chat_id, f"ALERTA: No se recibio la foto inicial para la Bandeja {tray_id} en 5 minutos. La sesion ha sido marcada para revision.")
 
 # =================================================================================
 # Handlers de Telegram
 # =================================================================================
 
+def claves_cache():
+    """Version del modelo/preprocesado y umbrales que forman parte de la clave de la cache de inferencia."""
+    return reconocimiento.version_pipeline(), reconocimiento.CONFIANZA_MINIMA, reconocimiento.IOU_NMS
+
+def _escribir_archivo(ruta, datos):
+    with open(ruta, 'wb') as f:
+        f.write(datos)
+
+def archivar_foto(datos, tray_id, file_id):
+    """Guarda una copia de la foto en DOWNLOAD_FOLDER en un hilo aparte, sin esperar al disco."""
+    if not ARCHIVAR_FOTOS:
+        return
+    ruta = os.path.join(DOWNLOAD_FOLDER, f"bandeja_{tray_id}_{file_id}.jpg")
+    tarea = asyncio.get_running_loop().run_in_executor(None, _escribir_archivo, ruta, datos)
+    tareas_archivo.add(tarea)
+    tarea.add_done_callback(tareas_archivo.discard)
+
+async def descargar_foto(foto, tray_id):
+    """Descarga la foto de Telegram directamente a memoria y devuelve sus bytes."""
+    photo_file = await foto.get_file()
+    datos = bytes(await photo_file.download_as_bytearray())
+    archivar_foto(datos, tray_id, photo_file.file_id)
+    return datos
+
+def guardar_foto(user_chat_id, tray_id, foto, reporte):
+    """
+    Guarda la foto para 'Ver Detecciones'. Las sesiones abandonadas nunca llegan
+    al cierre final, asi que el almacen tiene tamano maximo y vencimiento.
+    """
+    clave = (user_chat_id, tray_id)
+    ahora = time.monotonic()
+    ultimas_fotos[clave] = (foto, reporte, ahora)
+    ultimas_fotos.move_to_end(clave)
+    while ultimas_fotos and (len(ultimas_fotos) > ULTIMAS_FOTOS_MAXIMO
+                             or ahora - next(iter(ultimas_fotos.values()))[2] > ULTIMAS_FOTOS_TTL_SEGUNDOS):
+        ultimas_fotos.popitem(last=False)
+
+def obtener_foto(user_chat_id, tray_id):
+    """(foto, reporte) guardados para 'Ver Detecciones', o None si no hay o ya vencio."""
+    entrada = ultimas_fotos.get((user_chat_id, tray_id))
+    if not entrada or time.monotonic() - entrada[2] > ULTIMAS_FOTOS_TTL_SEGUNDOS:
+        return None
+    return entrada[0], entrada[1]
+
+def olvidar_fotos(user_chat_id):
+    """Descarta las fotos guardadas para 'Ver Detecciones' cuando termina la sesion del usuario."""
+    for clave in [clave for clave in ultimas_fotos if clave[0] == user_chat_id]:
+        del ultimas_fotos[clave]
+
+async def cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra al administrador los contadores de la cache de inferencia."""
+    if str(update.message.chat_id) != ADMIN_CHAT_ID:
+        return
+    stats = cache_inferencia.estadisticas()
+    await update.message.reply_text(
+        f"Cache de inferencia: {stats['entradas']} entradas\n"
+        f"Aciertos: {stats['aciertos']} (casi identicas: {stats['aciertos_perceptuales']})\nFallos: {stats['fallos']}"
+    )
+
+async def mensajes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra al administrador el estado de la cola de mensajes salientes."""
+    if str(update.message.chat_id) != ADMIN_CHAT_ID:
+        return
+    m = despachador.metricas()
+    await update.message.reply_text(
+        f"Mensajes en cola: {m['en_cola']} ({m['chats_en_cola']} chats)\n"
+        f"Enviados: {m['enviados']} (unidos: {m['unidos']}, fotos reutilizadas: {m['fotos_reutilizadas']})\n"
+        f"Limitados por Telegram (429): {m['limitados_429']}\nFallidos: {m['fallidos']}\n"
+        f"Latencia p50/p95: {m['latencia_p50_ms']:.0f} / {m['latencia_p95_ms']:.0f} ms"
+    )
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global admin_state
     user_chat_id = str(update.message.chat_id)
@@ -94,6 +250,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_message(user_chat_id, "Gracias. Tu cuenta de Telegram esta lista para ser enlazada. El administrador debe completar el proceso.")
         await send_message(ADMIN_CHAT_ID, f"El usuario '{user_to_link['nombre']}' ha iniciado el enlace. Para confirmar, pasa la tarjeta RFID de '{user_to_link['nombre']}' por el lector.")
         admin_state["state"] = "awaiting_linking_card_scan"
+        avisar_modo_admin(True)
     else:
         await update.message.reply_text(f"Hola, soy el bot de la caja de herramientas. Tu ID de chat es: {user_chat_id}")
 
@@ -101,13 +258,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Maneja la logica de auditoria de Check-in y Check-out usando el inventario dinamico.
     """
-    global session
     user_chat_id = str(update.message.chat_id)
 
-    if session.get("user_chat_id") != user_chat_id:
+    session = sesiones.obtener_por_chat(user_chat_id)
+    if not session:
         await update.message.reply_text("No tienes una sesion de auditoria activa en este momento.")
         return
 
+    box_id = session["box_id"]
     current_state = session.get("state")
     tray_to_audit = None
     
@@ -122,116 +280,282 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No estoy esperando ninguna foto en este momento.")
         return
 
-    # Descarga y analiza la foto
-    photo_file = await update.message.photo[-1].get_file()
-    file_path = os.path.join(DOWNLOAD_FOLDER, f"bandeja_{tray_to_audit}_{photo_file.file_id}.jpg")
-    await photo_file.download_to_drive(file_path)
-    await update.message.reply_text(f"Foto de bandeja {tray_to_audit} recibida. Analizando...")
+    # Si el usuario multi-bandeja envia ambas fotos en un album, se agrupan y se analizan en lote
+    media_group_id = update.message.media_group_id
+    if media_group_id and session.get("is_multi_tray") and current_state in ["MULTI_CHECKIN_PENDIENTE_FOTO_1", "CERRANDO_ESPERANDO_FOTO_1"]:
+        album = albumes_pendientes.setdefault(media_group_id, {"user_chat_id": user_chat_id, "box_id": box_id, "fotos": []})
+        album["fotos"].append((update.message.message_id, update.message.photo[-1]))
+        if len(album["fotos"]) == 1:
+            context.job_queue.run_once(procesar_album_callback, ESPERA_ALBUM_SEGUNDOS, data={"media_group_id": media_group_id}, name=f"album_{media_group_id}")
+        return
 
-    reporte, _ = reconocimiento.analizar_inventario_ia(file_path, tray_to_audit)
-    detected_tools = set(reporte.get("herramientas_detectadas", []))
+    foto = update.message.photo[-1]
+    version, conf, iou = claves_cache()
 
-    # --- Logica de estado para Check-in ---
-    if current_state in ["ABIERTA_ESPERANDO_FOTO_INICIAL", "MULTI_CHECKIN_PENDIENTE_FOTO_1", "MULTI_CHECKIN_PENDIENTE_FOTO_2"]:
-        job_name = f"checkin_timer_{tray_to_audit}"
-        for job in context.job_queue.get_jobs_by_name(job_name): job.schedule_removal()
+    # Si Telegram entrega otra vez la misma foto, se reutiliza el reporte sin descargarla
+    reporte = cache_inferencia.obtener_por_alias(foto.file_unique_id, tray_to_audit, version, conf, iou)
+    if reporte is not None:
+        await update.message.reply_text(f"Foto de bandeja {tray_to_audit} recibida (ya analizada anteriormente).")
+        guardar_foto(user_chat_id, tray_to_audit, foto, reporte) # Se descarga solo si piden ver las detecciones
+    else:
+        if not pool_inferencia.hay_capacidad():
+            await update.message.reply_text("El servidor esta ocupado analizando otras fotos. Por favor, vuelve a enviar la foto en unos segundos.")
+            return
 
-        # Carga el inventario esperado desde la DB (guardado en la sesion por 'handle_verification')
-        inventario_esperado = set(session.get(f"inventario_esperado_checkin_{tray_to_audit}", []))
-        
-        # Compara la foto con el inventario esperado
-        if detected_tools == inventario_esperado:
-            await send_message(user_chat_id, f"Check-in de Bandeja {tray_to_audit} exitoso. El inventario coincide.")
+        # Descarga y analiza la foto
+        datos = await descargar_foto(foto, tray_to_audit)
+        await update.message.reply_text(f"Foto de bandeja {tray_to_audit} recibida. Analizando...")
+
+        reporte = cache_inferencia.obtener(datos, tray_to_audit, version, conf, iou, foto.file_unique_id)
+        if reporte is None:
+            # La inferencia corre en el pool de procesos para no congelar el bot
+            try:
+                with trazador.span("inferencia"):
+                    reporte, _ = await pool_inferencia.analizar(datos, tray_to_audit)
+            except ColaInferenciaLlena:
+                await update.message.reply_text("El servidor esta ocupado analizando otras fotos. Por favor, vuelve a enviar la foto en unos segundos.")
+                return
+            except BrokenProcessPool:
+                # Un worker murio (ej. sin memoria); el pool ya se esta reiniciando
+                await update.message.reply_text("Hubo un error al analizar la foto. Por favor, vuelve a enviarla en unos segundos.")
+                return
+            cache_inferencia.guardar(datos, tray_to_audit, version, conf, iou, reporte, foto.file_unique_id)
+        guardar_foto(user_chat_id, tray_to_audit, datos, reporte)
+
+    await procesar_reporte(context, box_id, tray_to_audit, reporte, current_state)
+
+async def procesar_album_callback(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Analiza en un solo lote las fotos de un album (Bandeja 1 y Bandeja 2) y
+    aplica el reporte de cada bandeja en orden sobre la sesion.
+    """
+    album = albumes_pendientes.pop(context.job.data["media_group_id"], None)
+    if not album:
+        return
+    user_chat_id = album["user_chat_id"]
+    box_id = album["box_id"]
+    session = sesiones.obtener(box_id)
+    current_state = session.get("state")
+
+    if session.get("user_chat_id") != user_chat_id or current_state not in ["MULTI_CHECKIN_PENDIENTE_FOTO_1", "CERRANDO_ESPERANDO_FOTO_1"]:
+        return
+
+    # Las fotos del album llegan como mensajes separados; el orden de envio define la bandeja
+    fotos = [foto for _, foto in sorted(album["fotos"], key=lambda f: f[0])]
+    if len(fotos) > 2:
+        await send_message(user_chat_id, "El album tiene mas de 2 fotos. Solo se usaran las dos primeras (Bandeja 1 y Bandeja 2).")
+
+    version, conf, iou = claves_cache()
+    reportes = {}
+    por_analizar = [] # (tray_id, datos, foto) de las fotos que no estan en cache
+    for tray_id, foto in zip(["1", "2"], fotos):
+        reporte = cache_inferencia.obtener_por_alias(foto.file_unique_id, tray_id, version, conf, iou)
+        if reporte is None:
+            datos = await descargar_foto(foto, tray_id)
+            reporte = cache_inferencia.obtener(datos, tray_id, version, conf, iou, foto.file_unique_id)
+            if reporte is None:
+                por_analizar.append((tray_id, datos, foto))
+                continue
+            guardar_foto(user_chat_id, tray_id, datos, reporte)
         else:
-            faltantes_al_inicio = list(inventario_esperado - detected_tools)
-            encontradas_al_inicio = list(detected_tools - inventario_esperado)
-            
-            message = f"ATENCION (Bandeja {tray_to_audit}): Se detecto una discrepancia en el inventario inicial."
-            if faltantes_al_inicio:
-                message += f"\nFaltaban: {', '.join(faltantes_al_inicio)}."
-                # Registrar incidencia para el turno anterior
-                incidents_collection.insert_one({
-                    "herramientas_faltantes": faltantes_al_inicio, "estado": "Faltante al Check-in",
-                    "usuario_responsable": "Turno Anterior/Desconocido", "uid_responsable": "N/A",
-                    "fecha_reporte": datetime.datetime.now(datetime.timezone.utc), "bandeja": int(tray_to_audit)
-                })
-            if encontradas_al_inicio:
-                 message += f"\nSe encontraron herramientas extra: {', '.join(encontradas_al_inicio)}."
+            guardar_foto(user_chat_id, tray_id, foto, reporte) # Se descarga solo si piden ver las detecciones
+        reportes[tray_id] = reporte
+
+    await send_message(user_chat_id, f"{len(fotos[:2])} foto(s) recibida(s). Analizando...")
+    if por_analizar:
+        try:
+            with trazador.span("inferencia_lote"):
+                resultados = await pool_inferencia.analizar_lote([(datos, tray_id) for tray_id, datos, _ in por_analizar])
+        except ColaInferenciaLlena:
+            await send_message(user_chat_id, "El servidor esta ocupado analizando otras fotos. Por favor, vuelve a enviar las fotos en unos segundos.")
+            return
+        except BrokenProcessPool:
+            await send_message(user_chat_id, "Hubo un error al analizar las fotos. Por favor, vuelve a enviarlas en unos segundos.")
+            return
+        for (tray_id, datos, foto), (reporte, _) in zip(por_analizar, resultados):
+            cache_inferencia.guardar(datos, tray_id, version, conf, iou, reporte, foto.file_unique_id)
+            guardar_foto(user_chat_id, tray_id, datos, reporte)
+            reportes[tray_id] = reporte
+
+    if "2" in reportes:
+        # Se guarda el reporte de la Bandeja 2 hasta que el flujo la solicite
+        with sesiones.bloqueo(box_id):
+            session = sesiones.obtener(box_id)
+            session["reporte_pendiente_2"] = reportes["2"]
+            pendiente_guardado = sesiones.guardar(session)
+        if not pendiente_guardado:
+            await send_message(user_chat_id, "No se pudo guardar el analisis de la Bandeja 2. Cuando se solicite, vuelve a enviar su foto.")
+    await procesar_reporte(context, box_id, "1", reportes["1"], current_state)
+
+async def aplicar_reporte_pendiente(context, box_id):
+    """Si hay un reporte de Bandeja 2 ya analizado (de un album) y el flujo lo espera, lo aplica."""
+    with sesiones.bloqueo(box_id):
+        session = sesiones.obtener(box_id)
+        reporte = None
+        if session.get("state") in ["MULTI_CHECKIN_PENDIENTE_FOTO_2", "CERRANDO_ESPERANDO_FOTO_2"] and session.get("reporte_pendiente_2"):
+            reporte = session.pop("reporte_pendiente_2")
+            if not sesiones.guardar(session):
+                reporte = None
+    if reporte:
+        await procesar_reporte(context, box_id, "2", reporte, session["state"])
+
+async def procesar_reporte(context, box_id, tray_to_audit, reporte, estado_esperado):
+    """
+    Aplica el reporte de la IA de una bandeja sobre la sesion de la caja segun el
+    estado actual (Check-in o Check-out) y avanza el flujo. La sesion se lee y se
+    guarda bajo el candado de la caja, sin awaits en medio; los mensajes se envian
+    despues, solo si el cambio se guardo.
+    """
+    mensajes = [] # (chat_id, texto, reply_markup) a enviar cuando la sesion este guardada
+    herramientas_devueltas = []
+    with sesiones.bloqueo(box_id):
+        session = sesiones.obtener(box_id)
+        current_state = session.get("state")
+        if current_state != estado_esperado:
+            # La sesion cambio mientras se analizaba la foto (ej. expiro el check-in o se cerro la caja)
+            print(f"Reporte de Bandeja {tray_to_audit} descartado: la sesion de la caja {box_id} paso a {current_state}.")
+            return
+        user_chat_id = session.get("user_chat_id")
+        detected_tools = set(reporte.get("herramientas_detectadas", []))
+
+        # --- Logica de estado para Check-in ---
+        if current_state in ["ABIERTA_ESPERANDO_FOTO_INICIAL", "MULTI_CHECKIN_PENDIENTE_FOTO_1", "MULTI_CHECKIN_PENDIENTE_FOTO_2"]:
+            job_name = f"checkin_timer_{box_id}_{tray_to_audit}"
+            for job in context.job_queue.get_jobs_by_name(job_name): job.schedule_removal()
+
+            # Carga el inventario esperado desde la DB (guardado en la sesion por 'handle_verification')
+            inventario_esperado = set(session.get(f"inventario_esperado_checkin_{tray_to_audit}", []))
             
-            message += "\nSe ha notificado al administrador. Tu sesion ha comenzado con el inventario actual."
-            await send_message(user_chat_id, message)
-            await send_message(ADMIN_CHAT_ID, f"ALERTA DE CHECK-IN (Usuario: {session.get('user')}):\n{message}")
+            # Compara la foto con el inventario esperado
+            if detected_tools == inventario_esperado:
+                mensajes.append((user_chat_id, f"Check-in de Bandeja {tray_to_audit} exitoso. El inventario coincide.", None))
+            else:
+                faltantes_al_inicio = list(inventario_esperado - detected_tools)
+                encontradas_al_inicio = list(detected_tools - inventario_esperado)
+                
+                message = f"ATENCION (Bandeja {tray_to_audit}): Se detecto una discrepancia en el inventario inicial."
+                if faltantes_al_inicio:
+                    message += f"\nFaltaban: {', '.join(faltantes_al_inicio)}."
+                    # Registrar incidencia para el turno anterior
+                    diario_incidencias.registrar({
+                        "herramientas_faltantes": faltantes_al_inicio, "estado": "Faltante al Check-in",
+                        "usuario_responsable": "Turno Anterior/Desconocido", "uid_responsable": "N/A",
+                        "fecha_reporte": datetime.datetime.now(datetime.timezone.utc), "bandeja": int(tray_to_audit)
+                    })
+                if encontradas_al_inicio:
+                     message += f"\nSe encontraron herramientas extra: {', '.join(encontradas_al_inicio)}."
+                
+                message += "\nSe ha notificado al administrador. Tu sesion ha comenzado con el inventario actual."
+                keyboard = [[InlineKeyboardButton("Ver Detecciones", callback_data=f'ver_detecciones_{tray_to_audit}')]]
+                mensajes.append((user_chat_id, message, InlineKeyboardMarkup(keyboard)))
+                mensajes.append((ADMIN_CHAT_ID, f"ALERTA DE CHECK-IN (Usuario: {session.get('user')}):\n{message}", None))
 
-        # Guarda el inventario REAL detectado como la base para esta sesion
-        session[f"inventario_sesion_{tray_to_audit}"] = list(detected_tools)
+            # Guarda el inventario REAL detectado como la base para esta sesion
+            session[f"inventario_sesion_{tray_to_audit}"] = list(detected_tools)
 
-        # Logica para avanzar en el flujo de check-in
-        if current_state == "ABIERTA_ESPERANDO_FOTO_INICIAL":
-            session["state"] = "EN_USO"
-        elif current_state == "MULTI_CHECKIN_PENDIENTE_FOTO_1":
-            session["state"] = "MULTI_CHECKIN_PENDIENTE_FOTO_2"
-            await send_message(user_chat_id, f"Ahora, envia la foto de 'antes' para la BANDEJA 2.")
-        elif current_state == "MULTI_CHECKIN_PENDIENTE_FOTO_2":
-            session["state"] = "EN_USO"
-            await send_message(user_chat_id, f"Check-in completado para ambas bandejas.")
+            # Logica para avanzar en el flujo de check-in
+            if current_state == "ABIERTA_ESPERANDO_FOTO_INICIAL":
+                session["state"] = "EN_USO"
+            elif current_state == "MULTI_CHECKIN_PENDIENTE_FOTO_1":
+                session["state"] = "MULTI_CHECKIN_PENDIENTE_FOTO_2"
+                if not session.get("reporte_pendiente_2"):
+                    mensajes.append((user_chat_id, f"Ahora, envia la foto de 'antes' para la BANDEJA 2.", None))
+            elif current_state == "MULTI_CHECKIN_PENDIENTE_FOTO_2":
+                session["state"] = "EN_USO"
+                mensajes.append((user_chat_id, f"Check-in completado para ambas bandejas.", None))
 
-    # --- Logica de estado para Check-out ---
-    elif current_state in ["CERRANDO_ESPERANDO_FOTO_1", "CERRANDO_ESPERANDO_FOTO_2", "CERRANDO_ESPERANDO_FOTO_FINAL"]:
-        # Compara la foto de 'despues' con el inventario que el usuario recibio al 'antes'
-        inventario_de_sesion = set(session.get(f"inventario_sesion_{tray_to_audit}", []))
-        
-        faltantes_ahora = list(inventario_de_sesion - detected_tools)
-        encontradas_ahora = list(detected_tools - inventario_de_sesion)
+        # --- Logica de estado para Check-out ---
+        elif current_state in ["CERRANDO_ESPERANDO_FOTO_1", "CERRANDO_ESPERANDO_FOTO_2", "CERRANDO_ESPERANDO_FOTO_FINAL"]:
+            # Compara la foto de 'despues' con el inventario que el usuario recibio al 'antes'
+            inventario_de_sesion = set(session.get(f"inventario_sesion_{tray_to_audit}", []))
+            
+            faltantes_ahora = list(inventario_de_sesion - detected_tools)
+            encontradas_ahora = list(detected_tools - inventario_de_sesion)
 
-        if not faltantes_ahora and not encontradas_ahora:
-            # Caso 1: Todo coincide perfectamente
-            if session.get("is_multi_tray"):
-                if current_state == "CERRANDO_ESPERANDO_FOTO_1":
-                    session["state"] = "CERRANDO_ESPERANDO_FOTO_2"
-                    await send_message(user_chat_id, f"Auditoria de Bandeja 1 correcta. Ahora, envia la foto de 'despues' para la BANDEJA 2.")
-                elif current_state == "CERRANDO_ESPERANDO_FOTO_2":
+            if not faltantes_ahora and not encontradas_ahora:
+                # Caso 1: Todo coincide perfectamente
+                if session.get("is_multi_tray"):
+                    if current_state == "CERRANDO_ESPERANDO_FOTO_1":
+                        session["state"] = "CERRANDO_ESPERANDO_FOTO_2"
+                        if session.get("reporte_pendiente_2"):
+                            mensajes.append((user_chat_id, f"Auditoria de Bandeja 1 correcta.", None))
+                        else:
+                            mensajes.append((user_chat_id, f"Auditoria de Bandeja 1 correcta. Ahora, envia la foto de 'despues' para la BANDEJA 2.", None))
+                    elif current_state == "CERRANDO_ESPERANDO_FOTO_2":
+                        session["state"] = "ESPERANDO_BLOQUEO_MANUAL"
+                        keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandejas", callback_data='lock_now')]]
+                        mensajes.append((user_chat_id, f"Auditoria de Bandeja 2 correcta. Por favor, asegura que ambas bandejas esten cerradas y presiona el boton para bloquear.", InlineKeyboardMarkup(keyboard)))
+                else:
                     session["state"] = "ESPERANDO_BLOQUEO_MANUAL"
-                    keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandejas", callback_data='lock_now')]]
-                    await send_message(user_chat_id, f"Auditoria de Bandeja 2 correcta. Por favor, asegura que ambas bandejas esten cerradas y presiona el boton para bloquear.", reply_markup=InlineKeyboardMarkup(keyboard))
-            else:
-                session["state"] = "ESPERANDO_BLOQUEO_MANUAL"
-                keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandeja", callback_data='lock_now')]]
-                await send_message(user_chat_id, f"Auditoria final correcta. Por favor, asegura que la bandeja este cerrada y presiona el boton para bloquear.", reply_markup=InlineKeyboardMarkup(keyboard))
-        
-        else:
-            # Caso 2: El usuario encontro una herramienta que faltaba
-            if encontradas_ahora:
-                await send_message(user_chat_id, f"Gracias por devolver herramientas que faltaban: {', '.join(encontradas_ahora)}.")
-                # Actualiza el inventario de referencia de la base de datos
-                estado_bandejas_collection.update_one(
-                    {"bandeja_id": int(tray_to_audit)},
-                    {"$addToSet": {"inventario_actual_esperado": {"$each": encontradas_ahora}}}
-                )
+                    keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandeja", callback_data='lock_now')]]
+                    mensajes.append((user_chat_id, f"Auditoria final correcta. Por favor, asegura que la bandeja este cerrada y presiona el boton para bloquear.", InlineKeyboardMarkup(keyboard)))
             
-            # Caso 3: El usuario perdio una herramienta
-            if faltantes_ahora:
-                session["missing_tools"] = faltantes_ahora
-                session["state"] = "AUDITORIA_FALLIDA_ESPERANDO_DECISION"
-                keyboard = [[InlineKeyboardButton("Enviar Nueva Foto", callback_data=f'retry_photo_{tray_to_audit}')], [InlineKeyboardButton("Declarar Incidencia", callback_data=f'declare_incident_{tray_to_audit}')]]
-                await send_message(user_chat_id, f"ALERTA: Discrepancia en Bandeja {tray_to_audit}. Faltan: {', '.join(faltantes_ahora)}.", reply_markup=InlineKeyboardMarkup(keyboard))
             else:
-                # Si solo encontro herramientas pero no falta ninguna, permite el cierre
-                session["state"] = "ESPERANDO_BLOQUEO_MANUAL" # Asume que el flujo multi-bandeja ya termino
-                keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandejas", callback_data='lock_now')]]
-                await send_message(user_chat_id, f"Auditoria final correcta. Presiona el boton para bloquear.", reply_markup=InlineKeyboardMarkup(keyboard))
+                # Caso 2: El usuario encontro una herramienta que faltaba
+                if encontradas_ahora:
+                    mensajes.append((user_chat_id, f"Gracias por devolver herramientas que faltaban: {', '.join(encontradas_ahora)}.", None))
+                    herramientas_devueltas = encontradas_ahora
+                
+                # Caso 3: El usuario perdio una herramienta
+                if faltantes_ahora:
+                    session["missing_tools"] = faltantes_ahora
+                    session["state"] = "AUDITORIA_FALLIDA_ESPERANDO_DECISION"
+                    keyboard = [[InlineKeyboardButton("Enviar Nueva Foto", callback_data=f'retry_photo_{tray_to_audit}')], [InlineKeyboardButton("Declarar Incidencia", callback_data=f'declare_incident_{tray_to_audit}')], [InlineKeyboardButton("Ver Detecciones", callback_data=f'ver_detecciones_{tray_to_audit}')]]
+                    mensajes.append((user_chat_id, f"ALERTA: Discrepancia en Bandeja {tray_to_audit}. Faltan: {', '.join(faltantes_ahora)}.", InlineKeyboardMarkup(keyboard)))
+                else:
+                    # Si solo encontro herramientas pero no falta ninguna, permite el cierre
+                    session["state"] = "ESPERANDO_BLOQUEO_MANUAL" # Asume que el flujo multi-bandeja ya termino
+                    keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandejas", callback_data='lock_now')]]
+                    mensajes.append((user_chat_id, f"Auditoria final correcta. Presiona el boton para bloquear.", InlineKeyboardMarkup(keyboard)))
+
+        guardada = sesiones.guardar(session)
+
+    if not guardada:
+        await send_message(user_chat_id, f"No se pudo registrar la foto de la Bandeja {tray_to_audit} porque la sesion cambio. Por favor, vuelve a enviarla.")
+        return
+    for chat_id, texto, reply_markup in mensajes:
+        await send_message(chat_id, texto, reply_markup=reply_markup)
+    if herramientas_devueltas:
+        # Actualiza el inventario de referencia de la base de datos (con control de version);
+        # la escritura y sus reintentos corren en un hilo para no bloquear el loop
+        try:
+            await asyncio.to_thread(estado_bandejas.agregar_herramientas, int(tray_to_audit), herramientas_devueltas)
+        except ConflictoVersion as e:
+            print(f"ERROR: {e}")
+    await aplicar_reporte_pendiente(context, box_id)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Maneja TODAS las interacciones con los botones en linea enviados por el bot.
     """
-    global admin_state, session
+    global admin_state
     
     query = update.callback_query
     await query.answer() # Responde al callback inmediatamente
     chat_id = str(query.message.chat_id)
 
-    if session.get("state") == "AUDITORIA_FALLIDA_ESPERANDO_DECISION":
-        if chat_id != session.get("user_chat_id"):
+    if query.data.startswith('ver_detecciones_'):
+        # La imagen anotada se dibuja solo ahora, cuando el usuario la pide
+        tray_id = query.data.split('_')[-1]
+        foto = obtener_foto(chat_id, tray_id)
+        if not foto:
+            await query.answer(text="La foto ya no esta disponible.", show_alert=True)
+            return
+        datos, reporte = foto
+        if not isinstance(datos, bytes):
+            # Reporte reutilizado de la cache por alias: la foto aun no se habia descargado
+            photo_file = await datos.get_file()
+            datos = bytes(await photo_file.download_as_bytearray())
+            guardar_foto(chat_id, tray_id, datos, reporte)
+        jpeg = await asyncio.to_thread(reconocimiento.renderizar_detecciones, datos, reporte)
+        await send_message(chat_id, f"Detecciones de la Bandeja {tray_id}: {', '.join(reporte.get('herramientas_detectadas', [])) or 'ninguna'}", photo=jpeg)
+        return
+
+    # Sesion de la caja que este usuario tiene abierta (vacia si no tiene ninguna)
+    session = sesiones.obtener_por_chat(chat_id) or {}
+
+    if query.data.startswith(('retry_photo_', 'declare_incident_')):
+        if session.get("state") != "AUDITORIA_FALLIDA_ESPERANDO_DECISION":
             await query.answer(text="Esta accion solo puede ser realizada por el usuario que inicio la sesion.", show_alert=True)
             return
 
@@ -240,6 +564,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Borra el mensaje con la foto y los botones de incidencia
         await query.delete_message()
 
+        # La sesion pudo cambiar durante el await (ej. se reinicio la caja): se vuelve a leer
+        session = sesiones.obtener(session["box_id"])
+        if session.get("user_chat_id") != chat_id or session.get("state") != "AUDITORIA_FALLIDA_ESPERANDO_DECISION":
+            return
+
         if query.data.startswith('retry_photo_'):
             # --- CORRECCIÓN DEL BUG DE REINTENTO ---
             # Restaura el estado de "espera de foto" correcto
@@ -250,15 +579,24 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     session["state"] = "CERRANDO_ESPERANDO_FOTO_1"
                 elif tray_id == "2":
                     session["state"] = "CERRANDO_ESPERANDO_FOTO_2"
+            if not sesiones.guardar(session):
+                await query.answer("Esta accion ya no es valida.", show_alert=True)
+                return
             
             await send_message(chat_id, f"Entendido. Por favor, envia la nueva foto para la revalidacion de la Bandeja {tray_id}.")
             
         elif query.data.startswith('declare_incident_'):
             missing_tools = session.get("missing_tools", [])
+            # Se guarda primero el avance del flujo: si la sesion cambio no se registra nada
+            ultima_bandeja = not session.get("is_multi_tray") or tray_id == "2"
+            session["state"] = "ESPERANDO_BLOQUEO_MANUAL" if ultima_bandeja else "CERRANDO_ESPERANDO_FOTO_2"
+            if not sesiones.guardar(session):
+                await query.answer("Esta accion ya no es valida.", show_alert=True)
+                return
             
             if missing_tools:
                 # 1. Registrar en la base de datos
-                incidents_collection.insert_one({
+                diario_incidencias.registrar({
                     "herramientas_faltantes": missing_tools,
                     "estado": "Extraviada/Danada",
                     "usuario_responsable": session.get("user"),
@@ -272,30 +610,27 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 body = (f"Se ha reportado una incidencia para la(s) siguiente(s) herramienta(s):\n- {', '.join(missing_tools)}\n\n"
                         f"Usuario responsable: {session.get('user')}\nFecha del reporte: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-                telegram_app.job_queue.run_once(lambda ctx: send_message(ADMIN_CHAT_ID, f"INCIDENCIA REGISTRADA:\n{body}"), 0)
-                try:
-                    notifications.send_incident_email(subject, body, CORREO_ADMIN, EMAIL_SENDER_ADDRESS, EMAIL_SENDER_PASSWORD, SMTP_SERVER, SMTP_PORT)
-                    print("Notificacion de incidencia enviada por correo exitosamente.")
-                except Exception as e:
-                    print(f"Error al enviar correo de incidencia: {e}")
+                despachador.encolar(ADMIN_CHAT_ID, f"INCIDENCIA REGISTRADA:\n{body}")
+                # El correo se envia en segundo plano; el bot no espera al servidor SMTP
+                servicio_notificaciones.enviar(subject, body, CORREO_ADMIN)
 
             # 3. Continuar con el flujo de cierre
             # Comprobar si era la ultima bandeja
-            if not session.get("is_multi_tray") or (session.get("is_multi_tray") and tray_id == "2"):
-                session["state"] = "ESPERANDO_BLOQUEO_MANUAL"
+            if ultima_bandeja:
                 keyboard = [[InlineKeyboardButton("Confirmar y Bloquear Bandeja(s)", callback_data='lock_now')]]
                 await send_message(chat_id, f"Incidencia registrada para: {', '.join(missing_tools)}. Gracias. Ahora puedes terminar de cerrar la(s) bandeja(s) y presionar el boton para bloquear.", reply_markup=InlineKeyboardMarkup(keyboard))
             else:
                 # Era la bandeja 1 de 2, pedimos la foto de la bandeja 2
-                session["state"] = "CERRANDO_ESPERANDO_FOTO_2"
                 await send_message(chat_id, f"Incidencia registrada para Bandeja 1. Ahora, por favor envia la foto de 'despues' para la BANDEJA 2.")
+                await aplicar_reporte_pendiente(context, session["box_id"])
         
         return
     
     if query.data == 'lock_now':
-        if session.get("state") == "ESPERANDO_BLOQUEO_MANUAL" and chat_id == session.get("user_chat_id"):
-            command_queue.append({"command": "close_all"})
-            session["state"] = "BLOQUEANDO" 
+        session["state"], estado_anterior = "BLOQUEANDO", session.get("state")
+        # Solo se bloquea si la sesion sigue como se leyo (guardar() rechaza una copia vieja)
+        if estado_anterior == "ESPERANDO_BLOQUEO_MANUAL" and sesiones.guardar(session):
+            encolar_comando(session["box_id"], {"command": "close_all"})
             await query.edit_message_text("Comando de bloqueo enviado. Esperando confirmacion del sistema...")
         else:
             await query.answer("Esta accion ya no es valida.", show_alert=True)
@@ -310,7 +645,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_state[chat_id] = {'state': 'awaiting_new_user_name'}
 
     elif query.data == 'link_user':
-        unlinked_users = list(users_collection.find({"telegram_chat_id": {"$in": [None, ""]}}))
+        unlinked_users = directorio_usuarios.sin_enlazar()
         if not unlinked_users:
             await query.edit_message_text("No hay usuarios pendientes de enlazar.")
             return
@@ -319,7 +654,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         admin_state[chat_id] = {"state": "selecting_user_to_link"}
 
     elif query.data == 'link_user_manual':
-        unlinked_users = list(users_collection.find({"telegram_chat_id": {"$in": [None, ""]}}))
+        unlinked_users = directorio_usuarios.sin_enlazar()
         if not unlinked_users:
             await query.edit_message_text("No hay usuarios pendientes de enlazar.")
             return
@@ -330,24 +665,31 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data.startswith('toggle_tray_'):
         tray_id = query.data.split('_')[-1]
         current_state_key = f"admin_tray_{tray_id}_state"
-        if session.get(current_state_key, "BLOQUEADA") == "BLOQUEADA":
-            command_queue.append({'command': 'open', 'tray': int(tray_id)})
-            session[current_state_key] = 'ABIERTA'
+        with sesiones.bloqueo(dispositivo_admin):
+            # El estado de las bandejas en modo admin se guarda en la sesion de la caja que se esta administrando
+            sesion_caja = sesiones.obtener(dispositivo_admin)
+            abrir = sesion_caja.get(current_state_key, "BLOQUEADA") == "BLOQUEADA"
+            sesion_caja[current_state_key] = 'ABIERTA' if abrir else 'BLOQUEADA'
+            guardada = sesiones.guardar(sesion_caja)
+        if not guardada:
+            await query.answer(text="La caja cambio de estado. Intenta de nuevo.", show_alert=True)
+        elif abrir:
+            encolar_comando(dispositivo_admin, {'command': 'open', 'tray': int(tray_id)})
             await query.answer(text=f"Comando enviado: Abrir Bandeja {tray_id}") # Notificacion temporal
         else:
-            command_queue.append({'command': 'close', 'tray': int(tray_id)})
-            session[current_state_key] = 'BLOQUEADA'
+            encolar_comando(dispositivo_admin, {'command': 'close', 'tray': int(tray_id)})
             await query.answer(text=f"Comando enviado: Cerrar Bandeja {tray_id}") # Notificacion temporal
     
     elif query.data == 'cancel_admin':
         await query.edit_message_text(text="Modo Administrador finalizado.")
         admin_state.pop(chat_id, None)
+        avisar_modo_admin(False)
 
     # --- Logica del Flujo de Enlace de Cuentas (Auto) ---
     elif query.data.startswith('link_'):
         if admin_state.get(chat_id, {}).get("state") == "selecting_user_to_link":
             rfid_uid_to_link = query.data.split('_')[1]
-            user = users_collection.find_one({"rfid_uid": rfid_uid_to_link})
+            user = directorio_usuarios.por_uid(rfid_uid_to_link)
             if user:
                 admin_state[chat_id] = {"state": "awaiting_user_start", "user_to_link": user}
                 await query.edit_message_text(f"Perfecto. Por favor, dile a '{user['nombre']}' que abra un chat conmigo y me envie el comando /start.")
@@ -356,7 +698,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data.startswith('manual_link_'):
         if admin_state.get(chat_id, {}).get("state") == "selecting_user_for_manual_link":
             rfid_uid_to_link = query.data.split('_')[-1]
-            user = users_collection.find_one({"rfid_uid": rfid_uid_to_link})
+            user = directorio_usuarios.por_uid(rfid_uid_to_link)
             if user:
                 admin_state[chat_id] = {"state": "awaiting_manual_chat_id", "user_to_link": user}
                 await query.edit_message_text(f"Usuario '{user['nombre']}' seleccionado. Ahora, por favor, envia el Chat ID numerico del usuario.")
@@ -373,6 +715,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_data['permissions'] = permissions
             user_data['state'] = 'awaiting_new_user_uid'
             admin_state[chat_id] = user_data
+            avisar_modo_admin(True)
             await query.edit_message_text(
                 text="Permisos guardados. Ahora, por favor, pasa la nueva tarjeta del usuario por el lector RFID para finalizar."
             )
@@ -402,10 +745,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_to_link = current_state_info.get("user_to_link")
 
             if manual_chat_id.isdigit() and user_to_link:
-                users_collection.update_one(
-                    {"rfid_uid": user_to_link["rfid_uid"]},
-                    {"$set": {"telegram_chat_id": manual_chat_id}}
-                )
+                await asyncio.to_thread(directorio_usuarios.actualizar, user_to_link["rfid_uid"], {"telegram_chat_id": manual_chat_id})
                 await send_message(ADMIN_CHAT_ID, f"Exito. El usuario '{user_to_link['nombre']}' ha sido enlazado manualmente al Chat ID {manual_chat_id}.")
                 await send_message(manual_chat_id, "Tu cuenta ha sido enlazada al sistema por un administrador.")
                 admin_state.pop(chat_id, None)
@@ -414,49 +754,107 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 admin_state.pop(chat_id, None)
 
 # =================================================================================
-# Lógica del Servidor Web (Flask)
+# Lógica del Servidor Web (aiohttp, en el mismo loop que el bot de Telegram)
 # =================================================================================
-flask_app = Flask(__name__)
-
-@flask_app.route('/report_event', methods=['POST'])
-def handle_pico_event():
-    global session
-    data = request.get_json()
-    if not data: return jsonify({"status": "error", "message": "No data received"}), 400
-
-    event = data.get("event")
-    print(f"Evento recibido del Pico: {event}")
-    user_chat_id = session.get("user_chat_id")
-    if not user_chat_id: return jsonify({"status": "no_active_session"})
-
-    # --- Logica de Check-out ---
-    if session.get("state") == "EN_USO":
-        if event == "inicio_cierre_1" and session.get("is_multi_tray"):
-            session["state"] = "CERRANDO_ESPERANDO_FOTO_1"
-            telegram_app.job_queue.run_once(lambda ctx: send_message(user_chat_id, "Detectado intento de cierre de Bandeja 1. Por favor, envia la foto de 'check-out'."), 0)
-        
-        elif not session.get("is_multi_tray") and event == f"inicio_cierre_{session.get('active_tray')}":
-            session["state"] = "CERRANDO_ESPERANDO_FOTO_FINAL"
-            telegram_app.job_queue.run_once(lambda ctx: send_message(user_chat_id, f"Detectado intento de cierre de Bandeja {session.get('active_tray')}. Por favor, envia la foto de 'check-out'."), 0)
+async def leer_json(request):
+    """Cuerpo JSON de la peticion, o None si no es JSON valido."""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+async def handle_pico_event(request):
+    """
+    Recibe eventos del Pico. Los Pico actuales envian lotes desde su buffer de
+    eventos: {"device", "boot", "events": [{"seq", "event", "edad_ms"}, ...]}. Un lote
+    se reenvia si no llego la respuesta, asi que se descartan los eventos con un
+    numero de secuencia ya procesado para ese arranque ('boot') del Pico. Un
+    evento solo cuenta como procesado cuando termina sin error; si falla, se
+    responde 500 y el Pico reenvia el lote desde ese evento. Los eventos
+    'acceso_local' traen ademas "uid", "trace" y "bandejas".
+    """
+    data = await leer_json(request)
+    if not data: return web.json_response({"status": "error", "message": "No data received"}, status=400)
+    box_id = data.get("device", DISPOSITIVO_POR_DEFECTO)
+
+    if "events" not in data:
+        # Pico antiguos: un solo evento por peticion, sin numero de secuencia
+        print(f"Evento recibido del Pico ({box_id}): {data.get('event')}")
+        if data.get("event") == "acceso_local":
+            return web.json_response({"status": await procesar_acceso_local(box_id, data)})
+        return web.json_response({"status": procesar_evento_pico(box_id, data.get("event"))})
 
-    # --- Logica de Cierre Final ---
-    elif event == "cierre_exitoso_final":
-        message = "Bandeja(s) cerrada(s) y bloqueada(s) de forma segura."
-        telegram_app.job_queue.run_once(lambda ctx: send_message(user_chat_id, message), 0)
-        print("DEBUG: Reseteando la sesion a INACTIVE.")
-        session = {"state": "INACTIVE"}
+    # Un reenvio del lote mientras el anterior sigue en proceso espera aqui y luego descarta lo ya procesado
+    async with candados_eventos_pico.setdefault(box_id, asyncio.Lock()):
+        boot = data.get("boot")
+        boot_anterior, ultimo_seq = ultimo_evento_pico.get(box_id, (None, 0))
+        if boot != boot_anterior:
+            ultimo_seq = 0 # El Pico se reinicio: su secuencia vuelve a empezar
+        procesados = duplicados = 0
+        for evento in sorted(data["events"], key=lambda e: e.get("seq", 0)):
+            seq = evento.get("seq", 0)
+            if seq <= ultimo_seq:
+                duplicados += 1
+                continue
+            if ultimo_seq and seq > ultimo_seq + 1:
+                print(f"ADVERTENCIA: Se perdieron {seq - ultimo_seq - 1} evento(s) del Pico ({box_id}) por desborde de su buffer.")
+            print(f"Evento recibido del Pico ({box_id}): {evento.get('event')} (seq {seq}, hace {evento.get('edad_ms', 0)} ms)")
+            try:
+                if evento.get("event") == "acceso_local":
+                    await procesar_acceso_local(box_id, evento)
+                else:
+                    procesar_evento_pico(box_id, evento.get("event"))
+            except Exception as e:
+                # No se marca como procesado: el Pico conserva el evento y lo reenvia
+                print(f"ERROR: No se pudo procesar el evento {seq} del Pico ({box_id}): {e}")
+                return web.json_response({"status": "error", "ultimo_seq": ultimo_seq, "procesados": procesados, "duplicados": duplicados}, status=500)
+            ultimo_seq = seq
+            ultimo_evento_pico[box_id] = (boot, ultimo_seq)
+            procesados += 1
+    return web.json_response({"status": "events_received", "ultimo_seq": ultimo_seq, "procesados": procesados, "duplicados": duplicados})
 
-    return jsonify({"status": "event_received"})
+def procesar_evento_pico(box_id, event):
+    """Aplica un evento del Pico (cierre de bandeja o bloqueo final) a la sesion de la caja."""
+    with sesiones.bloqueo(box_id):
+        session = sesiones.obtener(box_id)
+        user_chat_id = session.get("user_chat_id")
+        if not user_chat_id: return "no_active_session"
+        active_tray = session.get("active_tray")
 
-@flask_app.route('/verificar_rfid', methods=['POST'])
-def handle_verification():
+        # --- Logica de Check-out ---
+        if session.get("state") == "EN_USO":
+            if event == "inicio_cierre_1" and session.get("is_multi_tray"):
+                session["state"] = "CERRANDO_ESPERANDO_FOTO_1"
+                if sesiones.guardar(session):
+                    despachador.encolar(user_chat_id, "Detectado intento de cierre de Bandeja 1. Por favor, envia la foto de 'check-out' (o ambas bandejas en un solo album, primero la Bandeja 1).")
+            
+            elif not session.get("is_multi_tray") and event == f"inicio_cierre_{active_tray}":
+                session["state"] = "CERRANDO_ESPERANDO_FOTO_FINAL"
+                if sesiones.guardar(session):
+                    despachador.encolar(user_chat_id, f"Detectado intento de cierre de Bandeja {active_tray}. Por favor, envia la foto de 'check-out'.")
+
+        # --- Logica de Cierre Final ---
+        elif event == "cierre_exitoso_final":
+            message = "Bandeja(s) cerrada(s) y bloqueada(s) de forma segura."
+            despachador.encolar(user_chat_id, message)
+            print(f"DEBUG: Reseteando la sesion de la caja {box_id} a INACTIVE.")
+            sesiones.reiniciar(box_id)
+            olvidar_fotos(user_chat_id)
+
+    return "event_received"
+
+async def handle_verification(request):
     """
     Punto de entrada principal para las verificaciones de RFID.
     """
-    start_time = time.time()
-    global session, admin_state
-    uid = request.get_json().get('uid')
-    print(f"Peticion de verificacion recibida. UID: {uid}")
+    global admin_state, dispositivo_admin
+    data = await leer_json(request)
+    if not data: return web.json_response({"status": "error", "message": "No data received"}, status=400)
+    uid = data.get('uid')
+    device_id = data.get('device', DISPOSITIVO_POR_DEFECTO)
+    # El Pico crea el ID de traza al leer la tarjeta; los Pico antiguos no lo envian
+    traza = trazador.iniciar(data.get('trace'), device_id)
+    print(f"Peticion de verificacion recibida. UID: {uid} (traza {traza})")
     
     chat_id = ADMIN_CHAT_ID
     current_admin_state = admin_state.get(chat_id)
@@ -466,97 +864,204 @@ def handle_verification():
         user_to_link = current_admin_state.get("user_to_link", {})
         if uid == user_to_link.get("rfid_uid"):
             linking_chat_id = current_admin_state.get("linking_chat_id")
-            users_collection.update_one({"rfid_uid": uid}, {"$set": {"telegram_chat_id": linking_chat_id}})
+            await asyncio.to_thread(directorio_usuarios.actualizar, uid, {"telegram_chat_id": linking_chat_id})
             message = f"Confirmado. La cuenta de '{user_to_link['nombre']}' ha sido enlazada."
-            telegram_app.job_queue.run_once(lambda ctx: send_message(ADMIN_CHAT_ID, message), 0)
-            telegram_app.job_queue.run_once(lambda ctx: send_message(linking_chat_id, "Tu cuenta ha sido enlazada con exito."), 0)
+            despachador.encolar(ADMIN_CHAT_ID, message)
+            despachador.encolar(linking_chat_id, "Tu cuenta ha sido enlazada con exito.")
             admin_state.pop(chat_id, None)
-            return jsonify({"status": "linking_complete"})
+            avisar_modo_admin(False)
+            trazador.terminar(traza, "enlace")
+            return web.json_response({"status": "linking_complete"})
         else:
-            telegram_app.job_queue.run_once(lambda ctx: send_message(ADMIN_CHAT_ID, "Tarjeta incorrecta. El proceso de enlace ha sido cancelado."), 0)
+            despachador.encolar(ADMIN_CHAT_ID, "Tarjeta incorrecta. El proceso de enlace ha sido cancelado.")
             admin_state.pop(chat_id, None)
-            return jsonify({"status": "linking_failed"})
+            avisar_modo_admin(False)
+            trazador.terminar(traza, "enlace fallido")
+            return web.json_response({"status": "linking_failed"})
 
     # --- Flujo 2: Finalizar el registro de un nuevo usuario ---
     if isinstance(current_admin_state, dict) and current_admin_state.get('state') == 'awaiting_new_user_uid':
-        if users_collection.find_one({"rfid_uid": uid}):
+        if directorio_usuarios.por_uid(uid):
             message = f"ERROR: La tarjeta con UID {uid} ya esta registrada."
         else:
             new_user = {"rfid_uid": uid, "nombre": current_admin_state['name'], "permisos": current_admin_state['permissions'], "telegram_chat_id": ""}
-            users_collection.insert_one(new_user)
+            await asyncio.to_thread(directorio_usuarios.insertar, new_user)
             message = f"Exito. El usuario '{current_admin_state['name']}' ha sido registrado con la tarjeta UID {uid}."
-        telegram_app.job_queue.run_once(lambda ctx: send_message(ADMIN_CHAT_ID, message), 0)
+        despachador.encolar(ADMIN_CHAT_ID, message)
         admin_state.pop(chat_id, None)
-        return jsonify({"status": "registration_complete"})
+        avisar_modo_admin(False)
+        trazador.terminar(traza, "registro")
+        return web.json_response({"status": "registration_complete"})
 
     # --- Flujo 3: Detección de Tarjeta Maestra ---
     if uid == MASTER_UID:
         print("TARJETA MAESTRA DETECTADA")
-        telegram_app.job_queue.run_once(admin_menu_callback, 0)
-        
-        #### Calculo de latencia ####
-        end_time = time.time()
-        latency_ms = (end_time - start_time) * 1000
-        print(f"--- LATENCIA (RFID a Bot - Admin): {latency_ms:.0f} ms ---")
-        #### FIN calculo de latencia ####
+        dispositivo_admin = device_id
+        await admin_menu_callback(None)
+        trazador.terminar(traza, "admin")
+        return web.json_response({"status": "master_mode"})
 
-        return jsonify({"status": "master_mode"})
-    
-    user = users_collection.find_one({"rfid_uid": uid})
-    if user and session.get("state") in ["INACTIVE", "BLOQUEADA"]:
+    return web.json_response(await conceder_acceso(device_id, uid, traza))
+
+async def conceder_acceso(device_id, uid, traza=None):
+    """
+    Si el usuario de la tarjeta puede abrir la caja, inicia su sesion y ordena
+    abrir sus bandejas. Devuelve la respuesta para el Pico.
+    """
+    user = directorio_usuarios.por_uid(uid) # Solo memoria: sin consultas a MongoDB en la verificacion
+    trazador.marcar(traza, "busqueda_usuario")
+    if user and sesiones.obtener(device_id).get("state") in ["INACTIVE", "BLOQUEADA"]:
         user_chat_id = user.get("telegram_chat_id")
         if not user_chat_id:
             message = f"Alerta: El usuario '{user['nombre']}' intento abrir una bandeja pero no tiene una cuenta de Telegram enlazada."
-            telegram_app.job_queue.run_once(lambda ctx: send_message(ADMIN_CHAT_ID, message), 0)
-
-            #### Calculo de latencia intento de ingreso fallido ####
-            end_time = time.time()
-            latency_ms = (end_time - start_time) * 1000
-            print(f"--- LATENCIA (RFID a Bot - Alerta): {latency_ms:.0f} ms ---")
-            #### FIN calculo de latencia ####
-
-            return jsonify({"status": "acceso_denegado", "reason": "no_telegram_link"})
+            despachador.encolar(ADMIN_CHAT_ID, message)
+            trazador.terminar(traza, "sin Telegram")
+            return {"status": "acceso_denegado", "reason": "no_telegram_link"}
 
         permisos = user.get('permisos', [])
         if not isinstance(permisos, list): permisos = [permisos]
         
-        # --- NUEVA LOGICA: Cargar el inventario dinamico esperado ---
-        inventario_esperado_1 = estado_bandejas_collection.find_one({"bandeja_id": 1}).get("inventario_actual_esperado", [])
-        inventario_esperado_2 = estado_bandejas_collection.find_one({"bandeja_id": 2}).get("inventario_actual_esperado", [])
+        # --- NUEVA LOGICA: Cargar el inventario dinamico esperado (solo de las bandejas permitidas) ---
+        # Normalmente sale de la cache; si hay que ir a MongoDB no se bloquea el loop
+        with trazador.span("mongo_bandejas", traza):
+            inventarios = await asyncio.to_thread(estado_bandejas.inventarios, sorted({int(p) for p in permisos}))
         
         if sorted(permisos) == [1, 2]:
-            command_queue.extend([{"command": "open", "tray": 1}, {"command": "open", "tray": 2}])
+            inventario_esperado_1 = inventarios.get(1, [])
+            inventario_esperado_2 = inventarios.get(2, [])
             session = {
                 "state": "MULTI_CHECKIN_PENDIENTE_FOTO_1", "user": user.get("nombre"), "uid": uid, 
-                "user_chat_id": user_chat_id, "is_multi_tray": True,
+                "user_chat_id": user_chat_id, "is_multi_tray": True, "box_id": device_id,
                 "inventario_esperado_checkin_1": inventario_esperado_1,
                 "inventario_esperado_checkin_2": inventario_esperado_2
             }
-            telegram_app.job_queue.run_once(lambda ctx: send_message(user_chat_id, f"Hola, {user.get('nombre')}. Abriendo ambas bandejas. Por favor, envia la foto de 'antes' para la BANDEJA 1."), 0)
-            return jsonify({"status": "acceso_concedido"})
+            if not sesiones.iniciar(session):
+                print(f"Acceso denegado: la caja {device_id} se ocupo o '{user.get('nombre')}' ya tiene otra caja abierta.")
+                trazador.terminar(traza, "denegado")
+                return {"status": "acceso_denegado"}
+            encolar_comando(device_id, {"command": "open", "tray": 1}, {"command": "open", "tray": 2}, traza=traza)
+            despachador.encolar(user_chat_id, f"Hola, {user.get('nombre')}. Abriendo ambas bandejas. Por favor, envia la foto de 'antes' para la BANDEJA 1 (o ambas fotos en un solo album: primero Bandeja 1, luego Bandeja 2).")
+            return {"status": "acceso_concedido"}
         
         elif permisos:
             tray_id = str(permisos[0])
-            inventario_esperado = inventario_esperado_1 if tray_id == "1" else inventario_esperado_2
+            inventario_esperado = inventarios.get(int(tray_id), [])
             
-            command_queue.append({"command": "open", "tray": int(tray_id)})
             session = {
                 "state": "ABIERTA_ESPERANDO_FOTO_INICIAL", "user": user.get("nombre"), "uid": uid, 
-                "user_chat_id": user_chat_id, "active_tray": tray_id, "is_multi_tray": False,
+                "user_chat_id": user_chat_id, "active_tray": tray_id, "is_multi_tray": False, "box_id": device_id,
                 f"inventario_esperado_checkin_{tray_id}": inventario_esperado
             }
-            telegram_app.job_queue.run_once(checkin_timeout_callback, 300, data={"tray_id": tray_id, "user_chat_id": user_chat_id}, name=f"checkin_timer_{tray_id}")
-            telegram_app.job_queue.run_once(lambda ctx: send_message(user_chat_id, f"Hola, {user.get('nombre')}. Abriendo Bandeja {tray_id}. Tienes 5 minutos para enviar la foto de 'antes'."), 0)
-            return jsonify({"status": "acceso_concedido"})
+            if not sesiones.iniciar(session):
+                print(f"Acceso denegado: la caja {device_id} se ocupo o '{user.get('nombre')}' ya tiene otra caja abierta.")
+                trazador.terminar(traza, "denegado")
+                return {"status": "acceso_denegado"}
+            encolar_comando(device_id, {"command": "open", "tray": int(tray_id)}, traza=traza)
+            telegram_app.job_queue.run_once(checkin_timeout_callback, 300, data={"tray_id": tray_id, "user_chat_id": user_chat_id, "box_id": device_id}, name=f"checkin_timer_{device_id}_{tray_id}")
+            despachador.encolar(user_chat_id, f"Hola, {user.get('nombre')}. Abriendo Bandeja {tray_id}. Tienes 5 minutos para enviar la foto de 'antes'.")
+            return {"status": "acceso_concedido"}
 
     print("Acceso denegado (Usuario no encontrado, sin permisos, o sesion ya activa).")
-    return jsonify({"status": "acceso_denegado"})
+    trazador.terminar(traza, "denegado")
+    return {"status": "acceso_denegado"}
+
+async def procesar_acceso_local(box_id, evento):
+    """
+    El Pico abrio bandejas con su lista local mientras el servidor no respondia
+    y lo informa con el evento 'acceso_local' cuando vuelve a tener red. Si el
+    usuario todavia puede abrir la caja se inicia su sesion como si la
+    verificacion hubiera llegado a tiempo; si no, la apertura sin servidor queda
+    registrada como incidencia, se avisa al administrador y se vuelven a cerrar
+    esas bandejas si la caja no tiene otra sesion.
+    """
+    uid = evento.get("uid")
+    mascara = evento.get("bandejas", 0)
+    bandejas = [bandeja for bandeja in (1, 2) if mascara & (1 << (bandeja - 1))]
+    session = sesiones.obtener(box_id)
+    if uid and session.get("uid") == uid and session.get("state") not in ["INACTIVE", "BLOQUEADA"]:
+        return "acceso_local_confirmado" # La verificacion si llego al servidor y la sesion ya existe
+
+    respuesta = await conceder_acceso(box_id, uid) if uid and uid != MASTER_UID else {"status": "acceso_denegado"}
+    if respuesta["status"] == "acceso_concedido":
+        print(f"Apertura sin servidor en la caja {box_id} confirmada: se inicio la sesion de la tarjeta {uid}.")
+        return "acceso_local_confirmado"
+
+    user = directorio_usuarios.por_uid(uid) or {}
+    edad = datetime.timedelta(milliseconds=evento.get("edad_ms", 0))
+    diario_incidencias.registrar({
+        "incidencia": "Apertura sin servidor", "estado": "Sin sesion",
+        "usuario_responsable": user.get("nombre", "Desconocido"), "uid_responsable": uid,
+        "fecha_reporte": datetime.datetime.now(datetime.timezone.utc) - edad, "bandejas": bandejas,
+    })
+    mensaje = (f"Alerta: La caja {box_id} abrio la(s) bandeja(s) {', '.join(map(str, bandejas))} sin servidor "
+               f"para la tarjeta {uid} ({user.get('nombre', 'usuario desconocido')}) y no se pudo iniciar su sesion.")
+    if sesiones.obtener(box_id).get("state") in ["INACTIVE", "BLOQUEADA"]:
+        encolar_comando(box_id, *[{"command": "close", "tray": bandeja} for bandeja in bandejas])
+        mensaje += " Se ordeno volver a bloquearlas."
+    despachador.encolar(ADMIN_CHAT_ID, mensaje)
+    return "acceso_local_rechazado"
+
+async def poll_command(request):
+    """
+    Entrega el siguiente comando al Pico. Con '?espera=N' funciona como long-poll:
+    retiene la peticion hasta que se encole un comando o pasen N segundos.
+    """
+    device_id = request.query.get('device', DISPOSITIVO_POR_DEFECTO)
+    try:
+        espera = min(float(request.query.get('espera', 0)), ESPERA_MAXIMA_POLL)
+    except ValueError:
+        espera = 0
+    # La espera queda suspendida en el loop, sin ocupar un hilo por cada Pico conectado
+    comando = await broker_comandos.obtener_async(device_id, espera)
+    if comando and comando.get("trace"):
+        trazador.marcar(comando["trace"], "entrega")
+    return web.json_response(comando or {})
+
+async def ack_command(request):
+    """El Pico confirma que ejecuto un comando; si no lo hace, el comando se reentrega."""
+    data = await leer_json(request)
+    if not data or "seq" not in data: return web.json_response({"status": "error", "message": "No data received"}, status=400)
+    device_id = data.get('device', DISPOSITIVO_POR_DEFECTO)
+    confirmado = broker_comandos.confirmar(device_id, data["seq"], data.get("epoca"))
+    traza = data.get("trace")
+    if traza and confirmado:
+        # Tiempos medidos en el Pico: movimiento del servo y desde la lectura de la tarjeta
+        if data.get("servo_ms") is not None:
+            trazador.registrar("servo", data["servo_ms"], traza)
+        if data.get("toque_a_servo_ms") is not None:
+            trazador.registrar("pico_toque_a_servo", data["toque_a_servo_ms"], traza)
+        trazador.confirmar_comando(traza)
+    return web.json_response({"status": "ack_received" if confirmado else "ack_ignored"})
+
+async def lista_tarjetas(request):
+    """
+    Lista firmada de tarjetas autorizadas para que el Pico decida localmente.
+    Con '?epoca=E&desde=N' devuelve solo los cambios posteriores a la version N.
+    """
+    if lista_acceso is None:
+        return web.json_response({"status": "error", "message": "Lista de acceso deshabilitada"}, status=404)
+    try:
+        epoca = int(request.query.get('epoca', 0))
+        desde = int(request.query.get('desde', 0))
+    except ValueError:
+        epoca = desde = 0
+    return web.json_response(lista_acceso.respuesta(epoca, desde))
 
-@flask_app.route('/poll_command', methods=['GET'])
-def poll_command():
-    if command_queue:
-        return jsonify(command_queue.pop(0))
-    return jsonify({})
+async def metrics(request):
+    """Histogramas de latencia (p50/p95/p99) en formato Prometheus, o JSON con '?formato=json'."""
+    if request.query.get('formato') == 'json':
+        return web.json_response({"latencias": trazador.metricas(), "telegram": despachador.metricas()})
+    return web.Response(text=trazador.texto_prometheus(), content_type="text/plain")
+
+def crear_app_http():
+    app = web.Application()
+    app.router.add_post('/report_event', handle_pico_event)
+    app.router.add_post('/verificar_rfid', handle_verification)
+    app.router.add_get('/poll_command', poll_command)
+    app.router.add_post('/ack_command', ack_command)
+    app.router.add_get('/lista_acceso', lista_tarjetas)
+    app.router.add_get('/metrics', metrics)
+    return app
 
 # =================================================================================
 # Función Principal e Inicialización
@@ -573,28 +1078,44 @@ def inicializar_estado_bandejas():
         print(f"ERROR: No se pudieron cargar las listas de inventario desde 'reconocimiento_de_objetos.py'. Verifica que las listas INVENTARIO_BANDEJA_1 y 2 existan. Error: {e}")
         return
 
-    # Verifica Bandeja 1
-    if not estado_bandejas_collection.find_one({"bandeja_id": 1}):
-        print("Creando documento de estado para Bandeja 1...")
-        estado_bandejas_collection.insert_one({
-            "bandeja_id": 1,
-            "inventario_actual_esperado": list(lista_maestra_1)
-        })
-    
-    # Verifica Bandeja 2
-    if not estado_bandejas_collection.find_one({"bandeja_id": 2}):
-        print("Creando documento de estado para Bandeja 2...")
-        estado_bandejas_collection.insert_one({
-            "bandeja_id": 2,
-            "inventario_actual_esperado": list(lista_maestra_2)
-        })
+    # Crea los documentos que falten (un upsert por bandeja, sin leer antes)
+    if estado_bandejas.crear_si_no_existe(1, lista_maestra_1):
+        print("Creado documento de estado para Bandeja 1.")
+    if estado_bandejas.crear_si_no_existe(2, lista_maestra_2):
+        print("Creado documento de estado para Bandeja 2.")
+
+    # Deja ambas bandejas en la cache con una sola consulta
+    estado_bandejas.cargar([1, 2])
     print("Estado de las bandejas verificado y listo.")
 
+async def iniciar_servicios(application):
+    """Se ejecuta dentro del loop del bot: arranca el despachador y la API HTTP de los Pico."""
+    await despachador.iniciar(application.bot)
+    # El tiempo de keep-alive debe superar la pausa entre peticiones de un Pico inactivo y el long-poll
+    runner = web.AppRunner(crear_app_http(), keepalive_timeout=KEEPALIVE_HTTP_SEGUNDOS)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PUERTO_HTTP).start()
+    application.bot_data["runner_http"] = runner
+    print(f"Servidor HTTP iniciado en el puerto {PUERTO_HTTP}...")
+
+async def detener_servicios(application):
+    runner = application.bot_data.get("runner_http")
+    if runner:
+        await runner.cleanup()
+
+    # Lo que quedo pendiente en los hilos de fondo se escribe antes de salir
+    pool_inferencia.cerrar()
+    cache_inferencia.guardar_en_disco()
+    servicio_notificaciones.cerrar()
+    diario_incidencias.cerrar()
+
 def run_telegram_bot():
     global telegram_app
-    telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
+    telegram_app = Application.builder().token(TELEGRAM_TOKEN).post_init(iniciar_servicios).post_shutdown(detener_servicios).build()
     
     telegram_app.add_handler(CommandHandler('start', start_command))
+    telegram_app.add_handler(CommandHandler('cache', cache_command))
+    telegram_app.add_handler(CommandHandler('mensajes', mensajes_command))
     telegram_app.add_handler(CallbackQueryHandler(button_handler))
     telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     telegram_app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
@@ -603,12 +1124,26 @@ def run_telegram_bot():
     telegram_app.run_polling()
 
 if __name__ == '__main__':
+    inicializar_recursos()
+
+    # Crea los indices y revisa los planes de las consultas frecuentes
+    indices.inicializar_indices(db)
+
     # Inicializa el estado de las bandejas en la DB ANTES de iniciar los hilos
     inicializar_estado_bandejas()
+
+    # Reenvia a MongoDB las incidencias que quedaron en el diario y arranca su hilo de escritura
+    diario_incidencias.iniciar()
+
+    # Hilo de envio de correos (mantiene abierta la conexion SMTP)
+    servicio_notificaciones.iniciar()
+
+    # Carga los usuarios en memoria y los mantiene al dia con los cambios de MongoDB
+    directorio_usuarios.cargar()
+    directorio_usuarios.iniciar_vigilancia()
+
+    # Arranca el pool de inferencia; cada worker carga y calienta su propio modelo
+    pool_inferencia.iniciar()
     
-    telegram_thread = threading.Thread(target=run_telegram_bot)
-    telegram_thread.daemon = True
-    telegram_thread.start()
-    
-    print("Servidor Flask iniciado...")
-    flask_app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    # El bot y la API de los Pico comparten el mismo loop de asyncio (hilo principal)
+    run_telegram_bot()
\ No newline at end of file
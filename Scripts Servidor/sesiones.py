@@ -0,0 +1,121 @@
+import copy
+import threading
+
+ESTADO_INACTIVO = "INACTIVE"
+
+class BackendMemoria:
+    """
+    Guarda las sesiones como diccionarios en la memoria del proceso. Lee y escribe
+    copias, asi una sesion leida antes de un await no es la misma que la guardada.
+    """
+    def __init__(self):
+        self._sesiones = {} # box_id -> sesion
+        self._indice_chat = {} # user_chat_id -> box_id
+
+    def leer(self, box_id):
+        sesion = self._sesiones.get(box_id)
+        return copy.deepcopy(sesion) if sesion is not None else None
+
+    def escribir(self, box_id, sesion):
+        self._sesiones[box_id] = copy.deepcopy(sesion)
+
+    def claves(self):
+        return list(self._sesiones)
+
+    def box_de_chat(self, chat_id):
+        return self._indice_chat.get(chat_id)
+
+    def indexar_chat(self, chat_id, box_id):
+        self._indice_chat[chat_id] = box_id
+
+    def desindexar_chat(self, chat_id, box_id):
+        if self._indice_chat.get(chat_id) == box_id:
+            del self._indice_chat[chat_id]
+
+class GestorSesiones:
+    """
+    Sesiones de auditoria indexadas por ID de caja (cada sesion guarda el estado de
+    sus bandejas), con busqueda O(1) por user_chat_id y un candado por caja.
+    Las sesiones leidas deben guardarse con guardar() despues de modificarlas.
+    Cada sesion lleva un numero de version: guardar() rechaza una sesion leida
+    antes de otro cambio (ej. se leyo, hubo un await y mientras tanto se reinicio),
+    en lugar de pisar el estado mas nuevo. Los candados son del proceso: el
+    servidor corre como un solo proceso (el broker de comandos tambien es local).
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self._candados = {} # box_id -> RLock
+        self._candado_global = threading.Lock()
+
+    def bloqueo(self, box_id):
+        """Candado de la caja, para que los cambios de estado de una sesion sean atomicos."""
+        with self._candado_global:
+            candado = self._candados.get(box_id)
+            if candado is None:
+                candado = self._candados[box_id] = threading.RLock()
+            return candado
+
+    def obtener(self, box_id):
+        """Devuelve la sesion de la caja, o una sesion inactiva nueva si no existe."""
+        sesion = self._backend.leer(box_id)
+        if sesion is None:
+            sesion = {"state": ESTADO_INACTIVO, "box_id": box_id}
+        return sesion
+
+    def obtener_por_chat(self, chat_id):
+        """Devuelve la sesion activa del usuario de Telegram, o None."""
+        box_id = self._backend.box_de_chat(chat_id)
+        if box_id is None:
+            return None
+        sesion = self._backend.leer(box_id)
+        if not sesion or sesion.get("user_chat_id") != chat_id:
+            return None
+        return sesion
+
+    def guardar(self, sesion):
+        """Guarda la sesion si nadie la cambio desde que se leyo. Devuelve False si estaba desactualizada."""
+        box_id = sesion["box_id"]
+        with self.bloqueo(box_id):
+            anterior = self._backend.leer(box_id)
+            version = anterior.get("version", 0) if anterior else 0
+            if sesion.get("version", 0) != version:
+                print(f"ADVERTENCIA: Cambio descartado en la sesion de la caja {box_id}: se leyo la version {sesion.get('version', 0)} y ya va en la {version}.")
+                return False
+            chat_anterior = anterior.get("user_chat_id") if anterior else None
+            if chat_anterior and chat_anterior != sesion.get("user_chat_id"):
+                self._backend.desindexar_chat(chat_anterior, box_id)
+            sesion["version"] = version + 1
+            self._backend.escribir(box_id, sesion)
+            if sesion.get("user_chat_id"):
+                self._backend.indexar_chat(sesion["user_chat_id"], box_id)
+            return True
+
+    def iniciar(self, sesion, estados_libres=(ESTADO_INACTIVO, "BLOQUEADA")):
+        """
+        Ocupa la caja con una sesion nueva solo si esta libre y el usuario no tiene
+        otra sesion activa en otra caja. Devuelve False si no se pudo iniciar.
+        """
+        box_id = sesion["box_id"]
+        with self.bloqueo(box_id):
+            actual = self.obtener(box_id)
+            if actual.get("state") not in estados_libres:
+                return False
+            otra = self.obtener_por_chat(sesion.get("user_chat_id")) if sesion.get("user_chat_id") else None
+            if otra and otra["box_id"] != box_id and otra.get("state") not in estados_libres:
+                return False
+            sesion["version"] = actual.get("version", 0) # La sesion nueva reemplaza a la actual
+            return self.guardar(sesion)
+
+    def reiniciar(self, box_id):
+        """Deja la caja sin usuario (estado INACTIVE)."""
+        with self.bloqueo(box_id):
+            sesion = {"state": ESTADO_INACTIVO, "box_id": box_id, "version": self.obtener(box_id).get("version", 0)}
+            self.guardar(sesion)
+            return sesion
+
+    def cajas(self):
+        return self._backend.claves()
+
+def crear_gestor():
+    """Crea el gestor con el backend en memoria (otro backend solo necesita la misma interfaz)."""
+    return GestorSesiones(BackendMemoria())
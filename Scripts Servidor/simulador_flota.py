@@ -0,0 +1,255 @@
+"""
+Simulador de una flota de Picos para pruebas de carga del servidor:
+
+    python simulador_flota.py --picos 200 --duracion 120
+    python simulador_flota.py --picos 500 --uids 1234,5678 --pid-servidor 4321 --salida flota.json
+
+Cada Pico virtual repite la logica de main_rasp.py con asyncio: lecturas de
+tarjeta (con ID de traza) enviadas a /verificar_rfid, flancos de los sensores TTP
+enviados en lotes a /report_event, un long-poll continuo a /poll_command como el de
+wifi_manager.poll_server, y ejecucion de comandos (con deduplicacion por
+secuencia/epoca, tiempo de servo simulado y ack a /ack_command).
+Las conexiones se reutilizan (keep-alive) como en cliente_http del Pico; con
+--sin-keep-alive cada peticion abre una conexion nueva, como el firmware anterior.
+Reporta tasa de peticiones, tasa de errores, latencias, latencia de entrega de
+comandos y CPU del proceso del servidor (--pid-servidor, solo Linux).
+Las tarjetas aleatorias son rechazadas por el servidor; con --uids se usan
+tarjetas de prueba registradas (y enlazadas a Telegram) para ejercitar la apertura.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+
+ESPERA_LONG_POLL_S = 20 # Igual que wifi_manager.ESPERA_LONG_POLL_S
+PAUSA_REINTENTO_S = 1.0 # Igual que wifi_manager.PAUSA_REINTENTO_MS
+DURACION_SERVO_S = 0.5 # ServoManager._set_angle espera 500 ms por servo
+MAX_COMANDOS_RECORDADOS = 16
+MAX_EVENTOS_POR_LOTE = 8 # Igual que wifi_manager.MAX_EVENTOS_POR_LOTE
+
+class Estadisticas:
+    def __init__(self):
+        self.peticiones = {} # endpoint -> cantidad
+        self.errores = {} # endpoint -> cantidad
+        self.latencias = {} # endpoint -> [ms]
+        self.entrega_comandos = [] # ms desde la lectura de la tarjeta hasta recibir el comando
+        self.toque_a_servo = [] # ms desde la lectura de la tarjeta hasta terminar el servo
+        self.estados_verificacion = {}
+
+    def registrar(self, endpoint, ms, error=False):
+        self.peticiones[endpoint] = self.peticiones.get(endpoint, 0) + 1
+        if error:
+            self.errores[endpoint] = self.errores.get(endpoint, 0) + 1
+        else:
+            self.latencias.setdefault(endpoint, []).append(ms)
+
+def resumen(muestras):
+    if not muestras:
+        return {"n": 0}
+    ordenadas = sorted(muestras)
+    def p(q):
+        return round(ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * q))], 1)
+    return {"n": len(ordenadas), "p50_ms": p(0.5), "p95_ms": p(0.95), "p99_ms": p(0.99), "max_ms": round(ordenadas[-1], 1)}
+
+class PicoVirtual:
+    """Un Pico con la misma logica que main_rasp.py, pero con red y hardware simulados."""
+    def __init__(self, device_id, sesion, url_base, args, stats):
+        self.device_id = device_id
+        self.sesion = sesion
+        self.url_base = url_base
+        self.args = args
+        self.stats = stats
+        self.comandos_ejecutados = []
+        self.epoca_servidor = None
+        self.trazas = {} # traza -> instante de la lectura de la tarjeta
+        self.acks_pendientes = []
+        self.boot_id = "%08x" % random.getrandbits(32)
+        self.eventos = [] # Buffer de eventos pendientes: (seq, instante, nombre)
+        self.eventos_seq = 0
+
+    def registrar_evento(self, nombre):
+        self.eventos_seq += 1
+        self.eventos.append((self.eventos_seq, time.monotonic(), nombre))
+
+    async def bucle_eventos(self, fin):
+        # En el Pico el long-poll no bloquea al hilo de red; aqui los eventos se envian en paralelo
+        while time.monotonic() < fin:
+            if self.eventos and not await self.enviar_eventos_pendientes():
+                await asyncio.sleep(PAUSA_REINTENTO_S)
+            await asyncio.sleep(0.05)
+
+    async def enviar_eventos_pendientes(self):
+        lote = self.eventos[:MAX_EVENTOS_POR_LOTE]
+        ahora = time.monotonic()
+        data = {"device": self.device_id, "boot": self.boot_id,
+                "events": [{"seq": seq, "event": nombre, "edad_ms": int((ahora - instante) * 1000)} for seq, instante, nombre in lote]}
+        if await self._peticion("/report_event", "POST", json=data) is None:
+            return False
+        del self.eventos[:len(lote)]
+        return True
+
+    async def _peticion(self, endpoint, metodo, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            async with self.sesion.request(metodo, self.url_base + endpoint, **kwargs) as respuesta:
+                datos = await respuesta.json(content_type=None)
+                error = respuesta.status >= 400
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            datos, error = None, True
+        self.stats.registrar(endpoint, (time.perf_counter() - inicio) * 1000, error)
+        return None if error else datos
+
+    # --- Hilo principal de main_rasp (tarjetas y sensores) ---
+    async def bucle_principal(self, fin):
+        proxima_tarjeta = time.monotonic() + random.expovariate(1 / self.args.intervalo_tarjeta)
+        proximo_cierre = time.monotonic() + random.expovariate(1 / self.args.intervalo_cierre)
+        while time.monotonic() < fin:
+            ahora = time.monotonic()
+            if ahora >= proxima_tarjeta:
+                await self.leer_tarjeta()
+                proxima_tarjeta = time.monotonic() + random.expovariate(1 / self.args.intervalo_tarjeta)
+            if ahora >= proximo_cierre:
+                # Flanco de subida de un sensor TTP
+                self.registrar_evento(f"inicio_cierre_{random.choice((1, 2))}")
+                proximo_cierre = time.monotonic() + random.expovariate(1 / self.args.intervalo_cierre)
+            await asyncio.sleep(0.05) # time.sleep_ms(50) del bucle principal
+
+    async def leer_tarjeta(self):
+        uid = random.choice(self.args.uids) if self.args.uids else str(random.getrandbits(32))
+        traza = "%s-%08x" % (self.device_id, random.getrandbits(32))
+        # Se registra antes de enviar: el comando puede llegar al long-poll antes que la respuesta
+        self.trazas[traza] = time.monotonic()
+        respuesta = await self._peticion("/verificar_rfid", "POST", json={"uid": uid, "device": self.device_id, "trace": traza})
+        if respuesta:
+            estado = respuesta.get("status")
+            self.stats.estados_verificacion[estado] = self.stats.estados_verificacion.get(estado, 0) + 1
+        if not respuesta or respuesta.get("status") != "acceso_concedido":
+            self.trazas.pop(traza, None)
+
+    # --- Hilo de red de main_rasp (long-poll y acks) ---
+    async def bucle_red(self, fin):
+        while time.monotonic() < fin:
+            comando = await self._peticion("/poll_command", "GET", params={"device": self.device_id, "espera": ESPERA_LONG_POLL_S},
+                                           timeout=aiohttp.ClientTimeout(total=ESPERA_LONG_POLL_S + 10))
+            if comando is None:
+                await asyncio.sleep(PAUSA_REINTENTO_S)
+            elif comando.get("command"):
+                await self.ejecutar(comando)
+            while self.acks_pendientes:
+                if await self._peticion("/ack_command", "POST", json=self.acks_pendientes[0]) is None:
+                    break
+                self.acks_pendientes.pop(0)
+
+    async def ejecutar(self, comando):
+        recibido = time.monotonic()
+        seq, epoca, traza = comando.get("seq"), comando.get("epoca"), comando.get("trace")
+        if epoca != self.epoca_servidor:
+            self.epoca_servidor = epoca
+            self.comandos_ejecutados = []
+        repetido = seq is not None and seq in self.comandos_ejecutados
+        if not repetido:
+            if traza in self.trazas:
+                self.stats.entrega_comandos.append((recibido - self.trazas[traza]) * 1000)
+            await asyncio.sleep(DURACION_SERVO_S * (2 if comando["command"] == "close_all" else 1))
+            if comando["command"] == "close_all":
+                self.registrar_evento("cierre_exitoso_final")
+        if seq is None:
+            return
+        ack = {"device": self.device_id, "seq": seq, "epoca": epoca}
+        if not repetido:
+            self.comandos_ejecutados = (self.comandos_ejecutados + [seq])[-MAX_COMANDOS_RECORDADOS:]
+            if traza:
+                fin_servo = time.monotonic()
+                ack.update(trace=traza, servo_ms=int((fin_servo - recibido) * 1000))
+                if traza in self.trazas:
+                    toque_a_servo_ms = int((fin_servo - self.trazas[traza]) * 1000)
+                    ack["toque_a_servo_ms"] = toque_a_servo_ms
+                    self.stats.toque_a_servo.append(toque_a_servo_ms)
+        self.acks_pendientes.append(ack)
+
+    async def correr(self, retraso, fin):
+        await asyncio.sleep(retraso) # Arranque escalonado (rampa)
+        await asyncio.gather(self.bucle_principal(fin), self.bucle_red(fin), self.bucle_eventos(fin))
+
+# --- CPU del servidor ---
+def _cpu_proceso_s(pid):
+    """Segundos de CPU (usuario + sistema) del proceso, leidos de /proc (Linux)."""
+    with open(f"/proc/{pid}/stat") as f:
+        campos = f.read().rsplit(")", 1)[1].split()
+    return (int(campos[11]) + int(campos[12])) / os.sysconf("SC_CLK_TCK")
+
+async def medir_cpu(pid, fin, muestras):
+    anterior, instante = _cpu_proceso_s(pid), time.monotonic()
+    while time.monotonic() < fin:
+        await asyncio.sleep(1)
+        actual, ahora = _cpu_proceso_s(pid), time.monotonic()
+        muestras.append(100 * (actual - anterior) / (ahora - instante))
+        anterior, instante = actual, ahora
+
+async def simular(args):
+    stats = Estadisticas()
+    url_base = f"http://{args.servidor}"
+    # Sin keep-alive cada peticion abre su propia conexion, como el firmware anterior con HTTP/1.0
+    conector = aiohttp.TCPConnector(limit=0, force_close=args.sin_keep_alive)
+    muestras_cpu = []
+    async with aiohttp.ClientSession(connector=conector, timeout=aiohttp.ClientTimeout(total=30)) as sesion:
+        inicio = time.monotonic()
+        fin = inicio + args.rampa + args.duracion
+        picos = [PicoVirtual(f"{args.prefijo}_{i}", sesion, url_base, args, stats) for i in range(args.picos)]
+        tareas = [pico.correr(args.rampa * i / max(1, args.picos), fin) for i, pico in enumerate(picos)]
+        if args.pid_servidor:
+            tareas.append(medir_cpu(args.pid_servidor, fin, muestras_cpu))
+        print(f"Simulando {args.picos} Picos contra {url_base} durante {args.duracion} s (rampa de {args.rampa} s)...")
+        await asyncio.gather(*tareas)
+        duracion = time.monotonic() - inicio
+
+        metricas_servidor = None
+        try:
+            async with sesion.get(url_base + "/metrics", params={"formato": "json"}) as respuesta:
+                metricas_servidor = await respuesta.json(content_type=None)
+        except (aiohttp.ClientError, ValueError):
+            pass
+
+    total = sum(stats.peticiones.values())
+    errores = sum(stats.errores.values())
+    return {
+        "picos": args.picos,
+        "duracion_s": round(duracion, 1),
+        "peticiones_por_segundo": round(total / duracion, 1),
+        "tasa_errores": round(errores / total, 4) if total else 0,
+        "endpoints": {
+            endpoint: {"peticiones": cantidad, "errores": stats.errores.get(endpoint, 0),
+                       "por_segundo": round(cantidad / duracion, 1), "latencia": resumen(stats.latencias.get(endpoint, []))}
+            for endpoint, cantidad in sorted(stats.peticiones.items())
+        },
+        "verificaciones": stats.estados_verificacion,
+        "entrega_comandos": resumen(stats.entrega_comandos),
+        "toque_a_servo": resumen(stats.toque_a_servo),
+        "cpu_servidor": {"promedio_pct": round(sum(muestras_cpu) / len(muestras_cpu), 1), "max_pct": round(max(muestras_cpu), 1)} if muestras_cpu else None,
+        "metricas_servidor": metricas_servidor,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simula una flota de Picos contra el servidor de la caja de herramientas.")
+    parser.add_argument("--servidor", default="localhost:5000", help="host:puerto de la API de los Pico")
+    parser.add_argument("--picos", type=int, default=100)
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos de carga sostenida")
+    parser.add_argument("--rampa", type=float, default=10, help="Segundos para arrancar todos los Picos")
+    parser.add_argument("--intervalo-tarjeta", type=float, default=30, help="Segundos promedio entre lecturas de tarjeta por Pico")
+    parser.add_argument("--intervalo-cierre", type=float, default=60, help="Segundos promedio entre flancos TTP por Pico")
+    parser.add_argument("--uids", type=lambda s: [u for u in s.split(",") if u], default=[], help="UIDs de tarjetas de prueba registradas, separados por comas")
+    parser.add_argument("--prefijo", default="sim", help="Prefijo del DEVICE_ID de los Picos virtuales")
+    parser.add_argument("--sin-keep-alive", action="store_true", help="Abrir una conexion por peticion (firmware anterior)")
+    parser.add_argument("--pid-servidor", type=int, help="PID del servidor para medir su CPU (Linux)")
+    parser.add_argument("--salida", help="Archivo JSON para guardar el reporte")
+    args = parser.parse_args()
+
+    reporte = asyncio.run(simular(args))
+    print(json.dumps({k: v for k, v in reporte.items() if k != "metricas_servidor"}, indent=2))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, indent=2)
+        print(f"Reporte guardado en '{args.salida}'.")
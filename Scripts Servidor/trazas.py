@@ -0,0 +1,166 @@
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Limites (ms) de los buckets de los histogramas
+LIMITES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+class Histograma:
+    """Buckets acumulados de latencia (ms) y una ventana de muestras recientes para los percentiles."""
+    def __init__(self, muestras_recientes=2048):
+        self.cuentas = [0] * (len(LIMITES_MS) + 1) # El ultimo bucket es +Inf
+        self.total = 0
+        self.suma_ms = 0.0
+        self._recientes = deque(maxlen=muestras_recientes)
+
+    def observar(self, ms):
+        for i, limite in enumerate(LIMITES_MS):
+            if ms <= limite:
+                self.cuentas[i] += 1
+                break
+        else:
+            self.cuentas[-1] += 1
+        self.total += 1
+        self.suma_ms += ms
+        self._recientes.append(ms)
+
+    def percentiles(self, ps=(0.5, 0.95, 0.99)):
+        muestras = sorted(self._recientes)
+        if not muestras:
+            return {p: 0.0 for p in ps}
+        return {p: muestras[min(len(muestras) - 1, int(len(muestras) * p))] for p in ps}
+
+class Traza:
+    def __init__(self, traza_id, device_id):
+        self.id = traza_id
+        self.device_id = device_id
+        self.inicio = time.monotonic()
+        self.etapas = [] # (nombre, ms desde el inicio de la traza)
+        self.spans = [] # (nombre, duracion en ms)
+        self.comandos_pendientes = 0
+
+class Trazador:
+    """
+    Trazas de punta a punta de cada lectura de tarjeta. El Pico crea el ID de traza
+    al leer el UID; el servidor marca las etapas (verificacion, encolado, entrega
+    por /poll_command, ack del servo) y mide spans de las operaciones lentas
+    (MongoDB, inferencia, envios a Telegram). Cada etapa y span alimenta un
+    histograma cuyos p50/p95/p99 se publican en /metrics.
+    """
+    def __init__(self, vida_traza_segundos=120):
+        self.vida_traza_segundos = vida_traza_segundos
+        self._trazas = {} # traza_id -> Traza activa
+        self._histogramas = {} # nombre -> Histograma
+        self._lock = threading.Lock()
+
+    # --- Trazas ---
+    def iniciar(self, traza_id=None, device_id=None):
+        """Empieza una traza (con el ID que envio el Pico o uno nuevo) y devuelve su ID."""
+        traza_id = traza_id or uuid.uuid4().hex[:16]
+        with self._lock:
+            self._purgar()
+            self._trazas[traza_id] = Traza(traza_id, device_id)
+        return traza_id
+
+    def marcar(self, traza_id, etapa):
+        """Registra el tiempo transcurrido desde el inicio de la traza hasta esta etapa."""
+        with self._lock:
+            traza = self._trazas.get(traza_id)
+            if traza is None or any(nombre == etapa for nombre, _ in traza.etapas):
+                return # Traza desconocida/vencida o etapa repetida (ej. comando reentregado)
+            ms = (time.monotonic() - traza.inicio) * 1000
+            traza.etapas.append((etapa, ms))
+            self._histograma(f"etapa.{etapa}").observar(ms)
+
+    def esperar_comandos(self, traza_id, cantidad):
+        """La traza termina cuando el Pico confirme esta cantidad de comandos."""
+        with self._lock:
+            traza = self._trazas.get(traza_id)
+            if traza:
+                traza.comandos_pendientes += cantidad
+
+    def confirmar_comando(self, traza_id):
+        """Ack de un comando de la traza; al llegar el ultimo, la traza se cierra."""
+        self.marcar(traza_id, "ack")
+        with self._lock:
+            traza = self._trazas.get(traza_id)
+            if traza is None:
+                return
+            traza.comandos_pendientes -= 1
+            if traza.comandos_pendientes > 0:
+                return
+        self.terminar(traza_id)
+
+    def terminar(self, traza_id, resultado=None):
+        with self._lock:
+            traza = self._trazas.pop(traza_id, None)
+            if traza is None:
+                return
+            total_ms = (time.monotonic() - traza.inicio) * 1000
+            self._histograma("traza.total").observar(total_ms)
+        detalle = ", ".join(f"{nombre} {ms:.0f} ms" for nombre, ms in traza.etapas + traza.spans)
+        sufijo = f" [{resultado}]" if resultado else ""
+        print(f"--- TRAZA {traza.id} ({traza.device_id}){sufijo}: {detalle or 'sin etapas'}; total {total_ms:.0f} ms ---")
+
+    def _purgar(self):
+        """Descarta trazas cuyo ack nunca llego (se llama con el candado tomado)."""
+        limite = time.monotonic() - self.vida_traza_segundos
+        for traza_id in [t for t, traza in self._trazas.items() if traza.inicio < limite]:
+            del self._trazas[traza_id]
+
+    # --- Spans ---
+    def registrar(self, nombre, duracion_ms, traza_id=None):
+        with self._lock:
+            self._histograma(f"span.{nombre}").observar(duracion_ms)
+            traza = self._trazas.get(traza_id) if traza_id else None
+            if traza:
+                traza.spans.append((nombre, duracion_ms))
+
+    @contextmanager
+    def span(self, nombre, traza_id=None):
+        """Mide la duracion del bloque: 'with trazador.span("mongo_bandejas", traza):'"""
+        inicio = time.monotonic()
+        try:
+            yield
+        finally:
+            self.registrar(nombre, (time.monotonic() - inicio) * 1000, traza_id)
+
+    # --- Exportacion ---
+    def _histograma(self, nombre):
+        histograma = self._histogramas.get(nombre)
+        if histograma is None:
+            histograma = self._histogramas[nombre] = Histograma()
+        return histograma
+
+    def metricas(self):
+        """{nombre: {cuenta, p50_ms, p95_ms, p99_ms, promedio_ms}} de todas las etapas y spans."""
+        with self._lock:
+            resultado = {}
+            for nombre, h in sorted(self._histogramas.items()):
+                p = h.percentiles()
+                resultado[nombre] = {
+                    "cuenta": h.total, "p50_ms": round(p[0.5], 1), "p95_ms": round(p[0.95], 1),
+                    "p99_ms": round(p[0.99], 1), "promedio_ms": round(h.suma_ms / h.total, 1) if h.total else 0.0,
+                }
+            return resultado
+
+    def texto_prometheus(self):
+        """Los histogramas en el formato de texto de Prometheus."""
+        lineas = [
+            "# HELP caja_latencia_ms Latencia de etapas y spans de la caja de herramientas",
+            "# TYPE caja_latencia_ms histogram",
+        ]
+        percentiles = ["# TYPE caja_latencia_percentil_ms gauge"]
+        with self._lock:
+            for nombre, h in sorted(self._histogramas.items()):
+                acumulado = 0
+                for limite, cuenta in zip(list(LIMITES_MS) + ["+Inf"], h.cuentas):
+                    acumulado += cuenta
+                    lineas.append(f'caja_latencia_ms_bucket{{nombre="{nombre}",le="{limite}"}} {acumulado}')
+                lineas.append(f'caja_latencia_ms_sum{{nombre="{nombre}"}} {h.suma_ms:.3f}')
+                lineas.append(f'caja_latencia_ms_count{{nombre="{nombre}"}} {h.total}')
+                for p, valor in h.percentiles().items():
+                    percentiles.append(f'caja_latencia_percentil_ms{{nombre="{nombre}",percentil="{p}"}} {valor:.3f}')
+        return "\n".join(lineas + percentiles) + "\n"
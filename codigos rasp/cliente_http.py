@@ -0,0 +1,166 @@
+import socket
+import select
+import ujson
+
+class ClienteHTTP:
+    """
+    Cliente HTTP/1.1 minimo que mantiene abierta una conexion con el servidor y la
+    reutiliza entre peticiones: sin handshake TCP por peticion y con un buffer de
+    recepcion preasignado, para no fragmentar el heap del RP2040. Si el servidor
+    cerro la conexion inactiva, se reconecta y se reenvia la peticion una vez.
+    No importa 'machine' ni 'network', asi que se puede probar con el port unix
+    de MicroPython contra un servidor local:
+
+        cliente = ClienteHTTP("127.0.0.1", 5000)
+        codigo, datos = cliente.peticion("POST", "/verificar_rfid", {"uid": "123"})
+
+    Para el long-poll, enviar() y recibir() permiten esperar la respuesta sin bloquear.
+    """
+    def __init__(self, host, puerto=5000, timeout_ms=5000, tamano_buffer=1024):
+        self.host = host
+        self.puerto = puerto
+        self.timeout_ms = timeout_ms
+        self._buffer = bytearray(tamano_buffer)
+        self._vista = memoryview(self._buffer)
+        self._direccion = None
+        self._sock = None
+        self._poller = select.poll()
+        self.esperando = False # Hay una peticion enviada cuya respuesta aun no se leyo
+        self.conexiones = 0
+        self.peticiones = 0
+        self._reiniciar_respuesta()
+
+    # --- Conexion ---
+    def _conectar(self):
+        if self._direccion is None:
+            self._direccion = socket.getaddrinfo(self.host, self.puerto)[0][-1]
+        sock = socket.socket()
+        sock.settimeout(self.timeout_ms / 1000)
+        try:
+            sock.connect(self._direccion)
+        except OSError:
+            sock.close()
+            raise
+        self._poller.register(sock, select.POLLIN)
+        self._sock = sock
+        self.conexiones += 1
+
+    def cerrar(self):
+        if self._sock:
+            try:
+                self._poller.unregister(self._sock)
+            except Exception:
+                pass
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+        self._sock = None
+        self.esperando = False
+
+    # --- Peticiones ---
+    def peticion(self, metodo, ruta, datos=None):
+        """Envia la peticion y espera la respuesta. Devuelve (codigo HTTP, cuerpo JSON o None)."""
+        for intento in (0, 1):
+            reutilizada = self._sock is not None
+            try:
+                self.enviar(metodo, ruta, datos)
+                respuesta = self.recibir(self.timeout_ms)
+            except OSError:
+                # Una conexion reutilizada pudo haber sido cerrada por el servidor: se reintenta con una nueva
+                if reutilizada and not intento and self._recibidos == 0:
+                    continue
+                raise
+            if respuesta is None:
+                self.cerrar()
+                raise OSError("sin respuesta del servidor")
+            return respuesta
+
+    def enviar(self, metodo, ruta, datos=None):
+        """Envia la peticion sin esperar la respuesta (se lee con recibir)."""
+        cuerpo = ujson.dumps(datos).encode() if datos is not None else b""
+        cabecera = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (
+            metodo, ruta, self.host, len(cuerpo))
+        self._reiniciar_respuesta()
+        if self._sock is None:
+            self._conectar()
+        try:
+            self._sock.sendall(cabecera.encode() + cuerpo)
+        except OSError:
+            self.cerrar()
+            raise
+        self.esperando = True
+        self.peticiones += 1
+
+    def recibir(self, espera_ms=0):
+        """
+        Lee lo que haya llegado de la respuesta, esperando como maximo 'espera_ms'.
+        Devuelve (codigo HTTP, cuerpo JSON o None) cuando la respuesta esta completa, o None.
+        """
+        try:
+            while self._poller.poll(espera_ms):
+                if self._recibidos == len(self._buffer):
+                    self._ampliar_buffer()
+                n = self._sock.readinto(self._vista[self._recibidos:])
+                if n is None:
+                    break
+                if not n:
+                    # Sin Content-Length el cuerpo termina cuando el servidor cierra la conexion
+                    if self._fin_cabecera >= 0 and self._largo < 0:
+                        return self._terminar(True)
+                    raise OSError("conexion cerrada por el servidor")
+                self._recibidos += n
+                if self._fin_cabecera < 0:
+                    self._leer_cabecera()
+                if self._fin_cabecera >= 0 and 0 <= self._largo <= self._recibidos - self._fin_cabecera:
+                    return self._terminar(self._cerrar_al_terminar)
+        except OSError:
+            self.cerrar()
+            raise
+        return None
+
+    # --- Respuesta ---
+    def _reiniciar_respuesta(self):
+        self._recibidos = 0
+        self._fin_cabecera = -1
+        self._largo = -1
+        self._codigo = 0
+        self._cerrar_al_terminar = False
+
+    def _ampliar_buffer(self):
+        """Solo si una respuesta no cabe en el buffer (no deberia pasar con las respuestas del servidor)."""
+        nuevo = bytearray(len(self._buffer) * 2)
+        nuevo[:len(self._buffer)] = self._buffer
+        self._buffer = nuevo
+        self._vista = memoryview(nuevo)
+
+    def _leer_cabecera(self):
+        datos = bytes(self._vista[:self._recibidos])
+        fin = datos.find(b"\r\n\r\n")
+        if fin < 0:
+            return
+        lineas = datos[:fin].split(b"\r\n")
+        self._codigo = int(lineas[0].split()[1])
+        self._cerrar_al_terminar = lineas[0].startswith(b"HTTP/1.0")
+        for linea in lineas[1:]:
+            partes = linea.split(b":", 1)
+            if len(partes) != 2:
+                continue
+            nombre, valor = partes[0].strip().lower(), partes[1].strip().lower()
+            if nombre == b"content-length":
+                self._largo = int(valor)
+            elif nombre == b"connection" and valor == b"close":
+                self._cerrar_al_terminar = True
+        self._fin_cabecera = fin + 4
+
+    def _terminar(self, cerrar):
+        fin = self._recibidos if self._largo < 0 else self._fin_cabecera + self._largo
+        cuerpo = bytes(self._vista[self._fin_cabecera:fin])
+        try:
+            datos = ujson.loads(cuerpo) if cuerpo else None
+        except ValueError:
+            datos = None # Ej. una pagina de error que no es JSON
+        self.esperando = False
+        if cerrar:
+            self.cerrar()
+        return self._codigo, datos
@@ -0,0 +1,132 @@
+import hashlib
+import ubinascii
+import ujson
+
+ARCHIVO_LISTA = "lista_acceso.json"
+
+def _hmac_sha256(clave, mensaje):
+    """HMAC-SHA256 con hashlib (MicroPython no trae el modulo hmac)."""
+    if len(clave) > 64:
+        clave = hashlib.sha256(clave).digest()
+    clave = clave + b"\x00" * (64 - len(clave))
+    interno = hashlib.sha256(bytes(b ^ 0x36 for b in clave) + mensaje).digest()
+    return ubinascii.hexlify(hashlib.sha256(bytes(b ^ 0x5C for b in clave) + interno).digest()).decode()
+
+def huella_uid(clave, uid):
+    """Misma huella que publica el servidor (lista_acceso.huella_uid): la lista no trae UIDs."""
+    return _hmac_sha256(clave, str(uid).encode())[:32]
+
+def _mensaje(tipo, epoca, desde, version, altas, bajas):
+    """Mismo texto canonico que firma el servidor (lista_acceso.mensaje_firmado)."""
+    return ("%s|%d|%d|%d|%s|%s" % (
+        tipo, epoca, desde, version,
+        ";".join("%s:%d" % (uid, mascara) for uid, mascara in sorted(altas)),
+        ",".join(sorted(bajas)),
+    )).encode()
+
+class ListaAcceso:
+    """
+    Copia local de las tarjetas autorizadas y sus bandejas (bit 0 = Bandeja 1,
+    bit 1 = Bandeja 2), firmada por el servidor con una clave compartida. Cada
+    tarjeta esta por su huella (HMAC del UID), asi que ni la lista ni el archivo
+    en flash revelan UIDs. Se guarda en flash para sobrevivir a reinicios y
+    cortes del servidor, y se busca con busqueda binaria sobre las huellas ordenadas. El hilo de red aplica las
+    actualizaciones; el hilo principal solo consulta, y cada actualizacion
+    reemplaza las listas de una vez para que una consulta nunca vea una mitad.
+    """
+    def __init__(self, clave, archivo=ARCHIVO_LISTA):
+        self.clave = clave.encode() if clave else None
+        self.archivo = archivo
+        self.epoca = 0
+        self.version = 0
+        self._datos = ([], bytearray()) # (huellas ordenadas, mascara de cada una)
+
+    @property
+    def activa(self):
+        return self.clave is not None
+
+    # --- Consulta ---
+    def consultar(self, uid):
+        """Mascara de bandejas permitidas para el UID, o 0 si no esta en la lista."""
+        if not self.activa:
+            return 0
+        huella = huella_uid(self.clave, uid)
+        huellas, permisos = self._datos
+        bajo, alto = 0, len(huellas) - 1
+        while bajo <= alto:
+            medio = (bajo + alto) // 2
+            if huellas[medio] == huella:
+                return permisos[medio]
+            if huellas[medio] < huella:
+                bajo = medio + 1
+            else:
+                alto = medio - 1
+        return 0
+
+    def __len__(self):
+        return len(self._datos[0])
+
+    # --- Actualizacion ---
+    def aplicar(self, respuesta):
+        """Aplica una respuesta de /lista_acceso (completa o delta) si su firma es valida."""
+        if not self.activa or not respuesta:
+            return False
+        tipo = respuesta.get("tipo")
+        if tipo == "sin_cambios":
+            return True
+        if tipo not in ("completa", "delta"):
+            return False
+        epoca, desde, version = respuesta["epoca"], respuesta["desde"], respuesta["version"]
+        altas, bajas = respuesta.get("altas", []), respuesta.get("bajas", [])
+        if _hmac_sha256(self.clave, _mensaje(tipo, epoca, desde, version, altas, bajas)) != respuesta.get("firma"):
+            print("LISTA ACCESO: Firma invalida, se descarta la actualizacion.")
+            return False
+        if tipo == "delta" and (epoca != self.epoca or desde != self.version):
+            return False # Delta sobre otra version: en la proxima consulta se pide de nuevo
+
+        entradas = {} if tipo == "completa" else dict(zip(*self._datos))
+        for huella in bajas:
+            entradas.pop(huella, None)
+        for huella, mascara in altas:
+            entradas[huella] = mascara
+        self._reemplazar(epoca, version, entradas)
+        self.guardar()
+        print(f"LISTA ACCESO: Version {version} ({tipo}), {len(self)} tarjetas.")
+        return True
+
+    def _reemplazar(self, epoca, version, entradas):
+        huellas = sorted(entradas)
+        self._datos = (huellas, bytearray(entradas[huella] for huella in huellas))
+        self.epoca = epoca
+        self.version = version
+
+    # --- Flash ---
+    def _firma_local(self):
+        huellas, permisos = self._datos
+        return _hmac_sha256(self.clave, _mensaje("completa", self.epoca, 0, self.version, list(zip(huellas, permisos)), []))
+
+    def guardar(self):
+        huellas, permisos = self._datos
+        try:
+            with open(self.archivo, "w") as f:
+                ujson.dump({"epoca": self.epoca, "version": self.version, "huellas": huellas,
+                            "permisos": list(permisos), "firma": self._firma_local()}, f)
+        except OSError as e:
+            print(f"LISTA ACCESO: No se pudo guardar en flash: {e}")
+
+    def cargar(self):
+        """Lee la lista guardada en flash; si falta o su firma no coincide, queda vacia."""
+        if not self.activa:
+            return False
+        try:
+            with open(self.archivo) as f:
+                datos = ujson.load(f)
+            self._reemplazar(datos["epoca"], datos["version"], dict(zip(datos["huellas"], datos["permisos"])))
+        except (OSError, ValueError, KeyError):
+            return False
+        if self._firma_local() != datos.get("firma"):
+            print("LISTA ACCESO: La lista en flash no es valida, se descarta.")
+            self._reemplazar(0, 0, {})
+            return False
+        print(f"LISTA ACCESO: Version {self.version} cargada de flash, {len(self)} tarjetas.")
+        return True
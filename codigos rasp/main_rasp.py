@@ -1,22 +1,43 @@
 import time
 import _thread
+import secrets
 from machine import Pin
 from servo_control import ServoManager
 import wifi_manager
-from rfid_reader import MFRC522_Reader
+from rfid_reader import MFRC522_Reader, EscanerRFID
+from lista_acceso import ListaAcceso
 
 # --- Configuracion de Hardware ---
 led = Pin("LED", Pin.OUT)
 rfid = MFRC522_Reader(spi_id=0, sck=2, mosi=3, miso=4, cs=1, rst=0)
+escaner = EscanerRFID(rfid) # Entrega cada tarjeta una sola vez aunque siga sobre el lector
 ttp_1 = Pin(16, Pin.IN, Pin.PULL_DOWN)
 ttp_2 = Pin(17, Pin.IN, Pin.PULL_DOWN)
 buzzer = Pin(15, Pin.OUT)
 servos = ServoManager(pin_servo1=28, pin_servo2=27)
 
+# --- Lista local de tarjetas autorizadas (sin clave en secrets.py no se decide localmente) ---
+lista = ListaAcceso(getattr(secrets, "LISTA_ACCESO_CLAVE", None))
+lista.cargar()
+INTERVALO_LISTA_MS = 60000 # Cada cuanto se piden al servidor los cambios de la lista
+
 # --- Variables de Estado Global ---
 uid_to_verify = None
+traza_a_verificar = None # ID de traza de la ultima tarjeta leida
+inicio_traza = 0 # ticks_ms de la lectura de esa tarjeta
 server_response = None
+apertura_local = None # (mascara, uid, traza) de bandejas abiertas sin esperar al servidor, pendientes de su confirmacion
+modo_admin_hasta = None # ticks_ms hasta el que la proxima tarjeta es para registro/enlace y no se decide con la lista local
+MODO_ADMIN_MAXIMO_MS = 600000 # Por si se pierde el aviso de fin del modo administrador
 command_queue_pico = []
+acks_pendientes = [] # (seq, epoca, traza, tiempos) de comandos ejecutados que falta confirmar al servidor
+movimientos_en_curso = [] # (ids de movimientos, seq, epoca, traza, inicio_servo, inicio_toque, cierre_final)
+lock_colas = _thread.allocate_lock() # Protege las listas compartidas entre ambos hilos
+
+# Secuencias de los ultimos comandos ejecutados, para no repetir uno reentregado
+comandos_ejecutados = []
+epoca_servidor = None
+MAX_COMANDOS_RECORDADOS = 16
 
 # Estados anteriores de los sensores TTP
 prev_ttp1_state = 0
@@ -25,28 +46,45 @@ prev_ttp2_state = 0
 # --- Hilo de Red ---
 def network_thread():
     """Hilo secundario que maneja toda la comunicacion de red."""
-    global uid_to_verify, server_response, command_queue_pico
+    global uid_to_verify, server_response, command_queue_pico, acks_pendientes
     
     print("THREAD RED: Hilo de red iniciado.")
     wifi_manager.connect(led)
+    proxima_lista = time.ticks_ms()
     
     while True:
         try:
             if uid_to_verify:
-                response = wifi_manager.verify_uid_on_server(uid_to_verify)
+                response = wifi_manager.verify_uid_on_server(uid_to_verify, traza_a_verificar)
                 server_response = response
                 uid_to_verify = None
 
-            command = wifi_manager.poll_server()
+            # Long-poll: espera como maximo 50 ms por vuelta y la peticion sigue abierta en el servidor
+            command = wifi_manager.poll_server(espera_ms=50)
             if command and command.get('command'):
                  print(f"THREAD RED: Comando recibido del servidor: {command}")
-                 command_queue_pico.append(command)
+                 with lock_colas:
+                     command_queue_pico.append(command)
+
+            # Pide los cambios de la lista de tarjetas autorizadas desde la version guardada
+            if lista.activa and time.ticks_diff(time.ticks_ms(), proxima_lista) >= 0:
+                lista.aplicar(wifi_manager.descargar_lista_acceso(lista.epoca, lista.version))
+                proxima_lista = time.ticks_add(time.ticks_ms(), INTERVALO_LISTA_MS)
+
+            # Envia los eventos de los sensores guardados en el buffer (se conservan si no hay red)
+            wifi_manager.enviar_eventos_pendientes()
+
+            # Confirma los comandos ya ejecutados; si falla, se reintenta en la siguiente vuelta
+            while acks_pendientes:
+                seq, epoca, traza, tiempos = acks_pendientes[0]
+                if not wifi_manager.ack_command(seq, epoca, traza, tiempos):
+                    break
+                with lock_colas:
+                    acks_pendientes.pop(0)
         except Exception as e:
             print(f"THREAD RED: Error de red - {e}")
             wifi_manager.connect(led)
 
-        time.sleep_ms(200)
-
 # --- Funciones de Sonido ---
 def play_beep(duration_ms=100):
     buzzer.on()
@@ -58,6 +96,18 @@ def play_error_beep():
         play_beep(50)
         time.sleep_ms(50)
 
+# --- Bandejas ---
+def mover_bandejas(mascara, abrir):
+    """
+    Abre o cierra las bandejas de la mascara (bit 0 = Bandeja 1, bit 1 = Bandeja 2).
+    Los movimientos se siguen en movimientos_en_curso como los de los comandos, sin ack.
+    """
+    movimientos = ()
+    if mascara & 1: movimientos += servos.open_tray_1() if abrir else servos.close_tray_1()
+    if mascara & 2: movimientos += servos.open_tray_2() if abrir else servos.close_tray_2()
+    movimientos_en_curso.append((movimientos, None, None, None, time.ticks_ms(), None, False))
+    return movimientos
+
 # --- Arranque ---
 _thread.start_new_thread(network_thread, ())
 print("HILO PRINCIPAL: Sistema listo. Escaneando RFID...")
@@ -68,49 +118,122 @@ while True:
     current_ttp1_state = ttp_1.value()
     if current_ttp1_state == 1 and prev_ttp1_state == 0:
         print("HILO PRINCIPAL: Detectado inicio de cierre Bandeja 1 (TTP1).")
-        wifi_manager.report_event_to_server({"event": "inicio_cierre_1"})
+        wifi_manager.registrar_evento("inicio_cierre_1")
     prev_ttp1_state = current_ttp1_state
 
     current_ttp2_state = ttp_2.value()
     if current_ttp2_state == 1 and prev_ttp2_state == 0:
         print("HILO PRINCIPAL: Detectado inicio de cierre Bandeja 2 (TTP2).")
-        wifi_manager.report_event_to_server({"event": "inicio_cierre_2"})
+        wifi_manager.registrar_evento("inicio_cierre_2")
     prev_ttp2_state = current_ttp2_state
 
     # --- Logica de Lectura RFID ---
-    if not uid_to_verify:
-        uid = rfid.read_card()
-        if uid:
-            print(f"HILO PRINCIPAL: Tarjeta detectada. UID: {uid}. Enviando a hilo de red...")
-            uid_to_verify = uid
+    # Se escanea siempre, asi una tarjeta que sigue sobre el lector no se reenvia al terminar su verificacion
+    uid = escaner.escanear()
+    if uid and uid_to_verify:
+        escaner.olvidar(uid) # Otra tarjeta mientras se verifica la anterior: se entregara en la siguiente lectura
+    elif uid:
+        print(f"HILO PRINCIPAL: Tarjeta detectada. UID: {uid}. Enviando a hilo de red...")
+        inicio_traza = time.ticks_ms()
+        traza_a_verificar = wifi_manager.nueva_traza()
+        uid_to_verify = uid
+        # Tarjeta conocida con la caja bloqueada: se abre ya y el servidor confirma despues.
+        # En modo administrador la tarjeta se esta registrando o enlazando, asi que decide solo el servidor
+        en_modo_admin = modo_admin_hasta is not None and time.ticks_diff(modo_admin_hasta, time.ticks_ms()) > 0
+        mascara = lista.consultar(str(uid)) if servos.bloqueada() and not en_modo_admin else 0
+        apertura_local = (mascara, str(uid), traza_a_verificar) if mascara else None
+        if apertura_local:
+            print(f"HILO PRINCIPAL: Tarjeta autorizada en la lista local. Abriendo bandejas ({mascara}).")
+            mover_bandejas(mascara, True)
+            play_beep(200)
+        else:
             play_beep()
 
     # --- Procesamiento de Respuestas del Servidor ---
     if server_response:
         print(f"HILO PRINCIPAL: Respuesta de verificacion recibida: {server_response}")
         status = server_response.get('status')
-        if status == "acceso_denegado": play_error_beep()
+        if apertura_local:
+            mascara, uid_local, traza_local = apertura_local
+            if status not in ("acceso_concedido", "error"):
+                # El servidor no confirmo la apertura local: se vuelven a bloquear las bandejas
+                print("HILO PRINCIPAL: El servidor rechazo la apertura local. Bloqueando bandejas.")
+                mover_bandejas(mascara, False)
+                play_error_beep()
+            elif status == "error":
+                # Sin servidor la decision local se mantiene; queda en el buffer de eventos
+                # y se reintenta hasta que el servidor la reciba y abra la sesion (o la rechace)
+                print("HILO PRINCIPAL: Servidor no disponible, se mantiene la apertura local.")
+                wifi_manager.registrar_evento("acceso_local", {"uid": uid_local, "trace": traza_local, "bandejas": mascara})
+            apertura_local = None
+        elif status == "acceso_denegado": play_error_beep()
         else: play_beep(200)
         server_response = None
 
     if command_queue_pico:
         
-        remote_command = command_queue_pico.pop(0)
+        with lock_colas:
+            remote_command = command_queue_pico.pop(0)
         
         command = remote_command.get('command')
         tray = remote_command.get('tray')
+        seq = remote_command.get('seq')
+        epoca = remote_command.get('epoca')
+        traza = remote_command.get('trace')
+        inicio_servo = time.ticks_ms()
+
+        # Si el servidor se reinicio, sus numeros de secuencia vuelven a empezar
+        if epoca != epoca_servidor:
+            epoca_servidor = epoca
+            comandos_ejecutados = []
+
+        if seq is not None and seq in comandos_ejecutados:
+            # Comando reentregado (se perdio el ack): solo se vuelve a confirmar
+            print(f"HILO PRINCIPAL: Comando {seq} ya ejecutado, se ignora.")
+            command = None
         
+        # Los servos se mueven en segundo plano; el ack se envia cuando terminan
+        movimientos = ()
         if command == 'open':
-            if tray == 1: servos.open_tray_1()
-            elif tray == 2: servos.open_tray_2()
+            if tray == 1: movimientos = servos.open_tray_1()
+            elif tray == 2: movimientos = servos.open_tray_2()
         elif command == 'close':
-            if tray == 1: servos.close_tray_1()
-            elif tray == 2: servos.close_tray_2()
+            if tray == 1: movimientos = servos.close_tray_1()
+            elif tray == 2: movimientos = servos.close_tray_2()
         elif command == 'close_all':
             print("HILO PRINCIPAL: Recibido comando de bloqueo final. BLOQUEANDO TODO.")
-            servos.close_all_trays()
+            movimientos = servos.close_all_trays()
             play_beep(500)
-            wifi_manager.report_event_to_server({"event": "cierre_exitoso_final"})
+        elif command == 'modo_admin':
+            modo_admin_hasta = time.ticks_add(time.ticks_ms(), MODO_ADMIN_MAXIMO_MS) if remote_command.get('activo') else None
+
+        if command:
+            if seq is not None:
+                comandos_ejecutados.append(seq)
+                if len(comandos_ejecutados) > MAX_COMANDOS_RECORDADOS:
+                    comandos_ejecutados.pop(0)
+            inicio_toque = inicio_traza if traza and traza == traza_a_verificar else None
+            movimientos_en_curso.append((movimientos, seq, epoca, traza, inicio_servo, inicio_toque, command == 'close_all'))
+        elif seq is not None:
+            with lock_colas:
+                acks_pendientes.append((seq, epoca, traza, None))
+
+    # --- Movimientos de servos terminados: se confirman al servidor ---
+    servos.actualizar()
+    for movimiento in [m for m in movimientos_en_curso if servos.terminado(m[0])]:
+        movimientos_en_curso.remove(movimiento)
+        ids, seq, epoca, traza, inicio_servo, inicio_toque, cierre_final = movimiento
+        if cierre_final:
+            wifi_manager.registrar_evento("cierre_exitoso_final")
+        if seq is not None:
+            tiempos = None
+            if traza:
+                fin_servo = time.ticks_ms()
+                tiempos = {"servo_ms": time.ticks_diff(fin_servo, inicio_servo)}
+                if inicio_toque is not None:
+                    tiempos["toque_a_servo_ms"] = time.ticks_diff(fin_servo, inicio_toque)
+            with lock_colas:
+                acks_pendientes.append((seq, epoca, traza, tiempos))
 
     time.sleep_ms(50)
 
@@ -1,3 +1,4 @@
+import time
 from mfrc522 import MFRC522
 
 class MFRC522_Reader:
@@ -14,3 +15,89 @@ class MFRC522_Reader:
             if stat == self.lector.OK:
                 return int.from_bytes(bytes(uid), "little", False)
         return None
+
+class EscanerRFID:
+    """
+    Bucle de lectura del lector RFID con supresion de repetidos. Una tarjeta que
+    sigue sobre el lector se vuelve a leer en cada escaneo, pero solo se entrega
+    una vez: mientras se siga viendo (o se haya visto hace menos de
+    'ventana_supresion_ms') sus lecturas se suprimen. El periodo de escaneo se
+    adapta: rapido mientras hay actividad reciente y mas lento en reposo, para
+    gastar menos tiempo de SPI. El MFRC522 solo detecta una tarjeta si se le pide
+    (REQA), asi que no hay un modo por interrupcion que evite el sondeo.
+    Guarda un historial corto de lecturas y estadisticas del tiempo de lectura.
+    """
+    def __init__(self, lector, ventana_supresion_ms=2000, periodo_activo_ms=50, periodo_reposo_ms=100,
+                 duracion_actividad_ms=3000, capacidad_historial=8):
+        self.lector = lector
+        self.ventana_supresion_ms = ventana_supresion_ms
+        self.periodo_activo_ms = periodo_activo_ms
+        self.periodo_reposo_ms = periodo_reposo_ms
+        self.duracion_actividad_ms = duracion_actividad_ms
+        self.capacidad_historial = capacidad_historial
+        self.historial = [] # [uid, ticks_ms primera lectura, ticks_ms ultima lectura, lecturas], la mas reciente al final
+        self._proximo_escaneo = time.ticks_ms()
+        self._ultima_actividad = time.ticks_add(time.ticks_ms(), -duracion_actividad_ms)
+        self.escaneos = 0
+        self.detecciones = 0
+        self.entregadas = 0
+        self.suprimidas = 0
+        self._tiempo_total_us = 0
+        self._tiempo_max_us = 0
+
+    def _buscar(self, uid):
+        for entrada in self.historial:
+            if entrada[0] == uid:
+                return entrada
+        return None
+
+    def escanear(self):
+        """
+        Llamar en cada vuelta del bucle principal. Lee el lector si ya toca segun el
+        periodo actual y devuelve el UID de una tarjeta recien presentada, o None.
+        """
+        ahora = time.ticks_ms()
+        if time.ticks_diff(ahora, self._proximo_escaneo) < 0:
+            return None
+        inicio = time.ticks_us()
+        uid = self.lector.read_uid()
+        duracion = time.ticks_diff(time.ticks_us(), inicio)
+        self.escaneos += 1
+        self._tiempo_total_us += duracion
+        self._tiempo_max_us = max(self._tiempo_max_us, duracion)
+
+        activo = time.ticks_diff(ahora, self._ultima_actividad) < self.duracion_actividad_ms
+        if uid is None:
+            self._proximo_escaneo = time.ticks_add(ahora, self.periodo_activo_ms if activo else self.periodo_reposo_ms)
+            return None
+
+        self.detecciones += 1
+        self._ultima_actividad = ahora
+        self._proximo_escaneo = time.ticks_add(ahora, self.periodo_activo_ms)
+        entrada = self._buscar(uid)
+        if entrada and time.ticks_diff(ahora, entrada[2]) < self.ventana_supresion_ms:
+            # La misma tarjeta sigue sobre el lector (o se volvio a pasar enseguida)
+            entrada[2] = ahora
+            entrada[3] += 1
+            self.suprimidas += 1
+            return None
+        if entrada:
+            self.historial.remove(entrada)
+        self.historial.append([uid, ahora, ahora, 1])
+        if len(self.historial) > self.capacidad_historial:
+            self.historial.pop(0)
+        self.entregadas += 1
+        return uid
+
+    def olvidar(self, uid):
+        """Quita la supresion de un UID (ej. se leyo mientras no se podia atender) para entregarlo de nuevo."""
+        entrada = self._buscar(uid)
+        if entrada:
+            self.historial.remove(entrada)
+
+    def estadisticas(self):
+        return {
+            "escaneos": self.escaneos, "detecciones": self.detecciones, "entregadas": self.entregadas,
+            "suprimidas": self.suprimidas, "lectura_max_us": self._tiempo_max_us,
+            "lectura_promedio_us": self._tiempo_total_us // self.escaneos if self.escaneos else 0,
+        }
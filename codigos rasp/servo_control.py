@@ -1,52 +1,143 @@
-from machine import Pin, PWM
+from machine import Pin, PWM, Timer
 import time
 
 class ServoManager:
     """
     Controla un par de servomotores con logica de proteccion
     y angulos de operacion especificos para cada uno.
+
+    Los movimientos no bloquean: cada orden aplica el PWM y un Timer lo desactiva
+    al terminar el movimiento, asi que ambos servos se mueven en paralelo y el
+    bucle principal sigue leyendo tarjetas y sensores. Si un servo esta en
+    movimiento, la siguiente orden para ese servo queda en cola. Cada orden
+    devuelve el ID de sus movimientos para consultar despues si ya terminaron.
     """
+    DURACION_MOVIMIENTO_MS = 500
+
     def __init__(self, pin_servo1, pin_servo2):
         """Inicializa los dos servos y los mueve a la posicion de bloqueo."""
         self.servo1_pin = Pin(pin_servo1)
         self.servo2_pin = Pin(pin_servo2)
-        
+
         self.ANGLE_CLOSE_SERVO1 = 180
         self.ANGLE_CLOSE_SERVO2 = 90
         self.ANGLE_OPEN = 0
 
+        self._pines = {1: self.servo1_pin, 2: self.servo2_pin}
+        self._cola = [] # (id, servo, angulo) de movimientos pendientes
+        self._movimientos = {} # servo -> (id, pwm, ticks_ms de fin) del movimiento en curso
+        self._angulos = {} # servo -> ultimo angulo ordenado
+        self._siguiente_id = 0
+        self._timer = Timer()
+        self._actualizando = False
+        self._repetir = False
+
         print("Inicializando servos en posicion de bloqueo...")
         self.close_all_trays()
+        self.esperar()
+
+    def _set_angle(self, servo, angle):
+        """Metodo interno: encola el movimiento de un servo y devuelve su ID."""
+        self._siguiente_id += 1
+        self._cola.append((self._siguiente_id, servo, angle))
+        self.actualizar()
+        return self._siguiente_id
 
-    def _set_angle(self, pin_obj, angle):
-        """Metodo interno para mover un servo y luego desactivarlo."""
+    def _mover(self, servo, angle, ahora):
         try:
-            pwm = PWM(pin_obj)
+            pwm = PWM(self._pines[servo])
             pwm.freq(50)
-            min_duty = 1638  
+            min_duty = 1638
             max_duty = 8191
             duty = min_duty + (angle / 180) * (max_duty - min_duty)
             pwm.duty_u16(int(duty))
-            time.sleep_ms(500)
-            pwm.deinit()
+            return pwm, time.ticks_add(ahora, self.DURACION_MOVIMIENTO_MS)
         except Exception as e:
-            print(f"Error al mover el servo en el pin {pin_obj}: {e}")
+            print(f"Error al mover el servo en el pin {self._pines[servo]}: {e}")
+            return None, ahora
+
+    # --- Planificacion ---
+    def actualizar(self, _timer=None):
+        """
+        Desactiva los servos que terminaron su movimiento e inicia los pendientes.
+        Lo llama el Timer al terminar cada movimiento; el bucle principal tambien lo
+        llama en cada vuelta por si el Timer llego mientras otra llamada estaba en curso.
+        """
+        if self._actualizando:
+            self._repetir = True
+            return
+        self._actualizando = True
+        try:
+            self._repetir = True
+            while self._repetir:
+                self._repetir = False
+                self._actualizar()
+        finally:
+            self._actualizando = False
+
+    def _actualizar(self):
+        ahora = time.ticks_ms()
+        for servo in [s for s, (_, _, fin) in self._movimientos.items() if time.ticks_diff(fin, ahora) <= 0]:
+            pwm = self._movimientos.pop(servo)[1]
+            if pwm:
+                pwm.deinit()
+
+        pendientes = []
+        for movimiento in self._cola:
+            id_movimiento, servo, angle = movimiento
+            if servo in self._movimientos or any(s == servo for _, s, _ in pendientes):
+                pendientes.append(movimiento) # El servo esta ocupado: se conserva el orden
+                continue
+            pwm, fin = self._mover(servo, angle, ahora)
+            self._movimientos[servo] = (id_movimiento, pwm, fin)
+            self._angulos[servo] = angle
+        self._cola = pendientes
+
+        if self._movimientos:
+            espera = min(time.ticks_diff(fin, ahora) for _, _, fin in self._movimientos.values())
+            self._timer.init(mode=Timer.ONE_SHOT, period=max(1, espera), callback=self.actualizar)
 
+    # --- Estado ---
+    def ocupado(self):
+        """True si algun servo se esta moviendo o tiene movimientos en cola."""
+        return bool(self._cola or self._movimientos)
+
+    def terminado(self, ids):
+        """True si ya terminaron todos los movimientos con esos IDs."""
+        en_curso = [i for i, _, _ in self._movimientos.values()] + [i for i, _, _ in self._cola]
+        return not any(i in en_curso for i in ids)
+
+    def estado(self):
+        """{servo: (ultimo angulo ordenado, en movimiento)} para consultar desde el bucle principal."""
+        return {servo: (self._angulos.get(servo), servo in self._movimientos) for servo in self._pines}
+
+    def bloqueada(self):
+        """
+        True si ambas bandejas estan en posicion de bloqueo: el ultimo movimiento de
+        cada servo fue de cierre y ya termino, y no hay movimientos en cola.
+        """
+        return (not self._cola and not self._movimientos and self._angulos.get(1) == self.ANGLE_CLOSE_SERVO1
+                and self._angulos.get(2) == self.ANGLE_CLOSE_SERVO2)
+
+    def esperar(self):
+        """Bloquea hasta que terminen todos los movimientos (solo para el arranque)."""
+        while self.ocupado():
+            self.actualizar()
+            time.sleep_ms(10)
+
+    # --- Ordenes (devuelven los IDs de sus movimientos) ---
     def open_tray_1(self):
-        self._set_angle(self.servo1_pin, self.ANGLE_OPEN)
+        return (self._set_angle(1, self.ANGLE_OPEN),)
 
     def open_tray_2(self):
-        self._set_angle(self.servo2_pin, self.ANGLE_OPEN)
-        
+        return (self._set_angle(2, self.ANGLE_OPEN),)
+
     def close_tray_1(self):
-        self._set_angle(self.servo1_pin, self.ANGLE_CLOSE_SERVO1)
+        return (self._set_angle(1, self.ANGLE_CLOSE_SERVO1),)
 
     def close_tray_2(self):
-        self._set_angle(self.servo2_pin, self.ANGLE_CLOSE_SERVO2)
-        
-    def close_all_trays(self):
-        self.close_tray_1()
-        self.close_tray_2()
-
-
+        return (self._set_angle(2, self.ANGLE_CLOSE_SERVO2),)
 
+    def close_all_trays(self):
+        # Ambos servos se mueven a la vez
+        return self.close_tray_1() + self.close_tray_2()
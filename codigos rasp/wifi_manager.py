@@ -1,12 +1,40 @@
 import network
 import time
+import _thread
+import random
 import secrets
-import urequests
-import ujson
 from machine import Pin, reset
+from cliente_http import ClienteHTTP
+
+DEVICE_ID = getattr(secrets, "DEVICE_ID", "caja_1") # Identifica esta caja ante el servidor
+PUERTO_SERVIDOR = 5000
+ESPERA_LONG_POLL_S = 20 # Segundos que el servidor retiene /poll_command si no hay comandos
+PAUSA_REINTENTO_MS = 1000 # Pausa antes de reabrir el long-poll tras un error
+CAPACIDAD_EVENTOS = 32 # Eventos guardados mientras no hay red (al llenarse se pierde el mas antiguo)
+MAX_EVENTOS_POR_LOTE = 8
+BOOT_ID = "%08x" % random.getrandbits(32) # Distingue este arranque: la secuencia de eventos vuelve a 1
+
+# Buffer circular de eventos pendientes de enviar: (seq, ticks_ms, nombre)
+_eventos = [None] * CAPACIDAD_EVENTOS
+_eventos_inicio = 0
+_eventos_cantidad = 0
+_eventos_seq = 0
+_eventos_reintento = 0
+_eventos_lock = _thread.allocate_lock()
+eventos_perdidos = 0
+
+# Conexiones persistentes (HTTP/1.1 keep-alive) con el servidor, usadas solo desde el hilo de red:
+# una para verificaciones, eventos y acks, y otra para el long-poll, que queda abierto
+_cliente = ClienteHTTP(secrets.SERVER_IP, PUERTO_SERVIDOR)
+_cliente_poll = ClienteHTTP(secrets.SERVER_IP, PUERTO_SERVIDOR, tamano_buffer=512)
+_poll_inicio = 0
+_poll_reintento = 0
 
 def connect(led):
     """Intenta conectarse a la red Wi-Fi de forma persistente."""
+    # Las conexiones abiertas antes de perder la red ya no sirven
+    _cliente.cerrar()
+    _cliente_poll.cerrar()
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
     time.sleep(1)
@@ -34,43 +62,138 @@ def connect(led):
         led.on()
         return True
 
-def report_event_to_server(event_data):
-    """Envía un evento de sensor al servidor."""
-    url = f"http://{secrets.SERVER_IP}:5000/report_event"
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = urequests.post(url, data=ujson.dumps(event_data), headers=headers)
-        response.close()
+def registrar_evento(nombre, datos=None):
+    """
+    Guarda un evento en el buffer sin tocar la red, asi que el hilo principal no
+    se bloquea. El hilo de red lo envia con enviar_eventos_pendientes(). 'datos'
+    (un dict) se agrega a los campos del evento.
+    """
+    global _eventos_inicio, _eventos_cantidad, _eventos_seq, eventos_perdidos
+    with _eventos_lock:
+        _eventos_seq += 1
+        if _eventos_cantidad == CAPACIDAD_EVENTOS:
+            # Buffer lleno: se descarta el evento mas antiguo
+            _eventos_inicio = (_eventos_inicio + 1) % CAPACIDAD_EVENTOS
+            _eventos_cantidad -= 1
+            eventos_perdidos += 1
+        _eventos[(_eventos_inicio + _eventos_cantidad) % CAPACIDAD_EVENTOS] = (_eventos_seq, time.ticks_ms(), nombre, datos)
+        _eventos_cantidad += 1
+        return _eventos_seq
+
+def enviar_eventos_pendientes():
+    """
+    Envia al servidor un lote con los eventos mas antiguos del buffer. Solo se
+    quitan del buffer cuando el servidor responde; si falla, se reintenta despues
+    de PAUSA_REINTENTO_MS (el servidor descarta los que ya habia recibido).
+    Devuelve True si el buffer quedo vacio.
+    """
+    global _eventos_inicio, _eventos_cantidad, _eventos_reintento
+    if not _eventos_cantidad:
         return True
+    if time.ticks_diff(_eventos_reintento, time.ticks_ms()) > 0:
+        return False
+    with _eventos_lock:
+        lote = [_eventos[(_eventos_inicio + i) % CAPACIDAD_EVENTOS] for i in range(min(_eventos_cantidad, MAX_EVENTOS_POR_LOTE))]
+    ahora = time.ticks_ms()
+    eventos = []
+    for seq, instante, nombre, datos in lote:
+        evento = {'seq': seq, 'event': nombre, 'edad_ms': time.ticks_diff(ahora, instante)}
+        if datos:
+            evento.update(datos)
+        eventos.append(evento)
+    data = {'device': DEVICE_ID, 'boot': BOOT_ID, 'events': eventos}
+    try:
+        codigo, _ = _cliente.peticion("POST", "/report_event", data)
+        correcto = codigo < 300
     except Exception as e:
-        print(f"Error al reportar evento: {e}")
+        print(f"Error al reportar eventos: {e}")
+        correcto = False
+    if not correcto:
+        _eventos_reintento = time.ticks_add(time.ticks_ms(), PAUSA_REINTENTO_MS)
         return False
 
-def verify_uid_on_server(uid):
+    ultimo_enviado = lote[-1][0]
+    with _eventos_lock:
+        # Mientras se enviaba pudieron sobrescribirse eventos del lote: se quitan solo los que siguen
+        while _eventos_cantidad and _eventos[_eventos_inicio][0] <= ultimo_enviado:
+            _eventos[_eventos_inicio] = None
+            _eventos_inicio = (_eventos_inicio + 1) % CAPACIDAD_EVENTOS
+            _eventos_cantidad -= 1
+        return _eventos_cantidad == 0
+
+def nueva_traza():
+    """ID de traza para una lectura de tarjeta; el servidor lo sigue hasta el ack del servo."""
+    return "%s-%08x" % (DEVICE_ID, random.getrandbits(32))
+
+def verify_uid_on_server(uid, traza=None):
     """Envía un UID al servidor para su verificación."""
-    url = f"http://{secrets.SERVER_IP}:5000/verificar_rfid"
-    headers = {'Content-Type': 'application/json'}
-    data = {'uid': str(uid)}
+    data = {'uid': str(uid), 'device': DEVICE_ID}
+    if traza:
+        data['trace'] = traza
     
     try:
-        response = urequests.post(url, data=ujson.dumps(data), headers=headers)
-        response_data = response.json()
-        response.close()
-        return response_data
+        _, response_data = _cliente.peticion("POST", "/verificar_rfid", data)
+        return response_data or {"status": "error", "message": "respuesta vacia"}
     except Exception as e:
         print(f"Error al verificar UID: {e}")
         return {"status": "error", "message": str(e)}
 
-def poll_server():
-    """Pide al servidor si hay algún comando pendiente."""
-    url = f"http://{secrets.SERVER_IP}:5000/poll_command"
+def descargar_lista_acceso(epoca, version):
+    """Pide la lista de tarjetas autorizadas; el servidor envia solo los cambios desde 'version'."""
     try:
-        response = urequests.get(url, timeout=5) 
-        command_data = response.json()
-        response.close()
-        return command_data
-    except Exception:
-        # Es normal que esto falle a veces, no se imprime el error.
+        codigo, datos = _cliente.peticion("GET", f"/lista_acceso?device={DEVICE_ID}&epoca={epoca}&desde={version}")
+        return datos if codigo < 300 else None
+    except Exception as e:
+        print(f"Error al descargar la lista de acceso: {e}")
         return None
 
+def ack_command(seq, epoca, traza=None, tiempos=None):
+    """
+    Confirma al servidor que un comando ya fue ejecutado. Si el comando traia un
+    ID de traza, se envian tambien los tiempos medidos en el Pico (servo_ms, toque_a_servo_ms).
+    """
+    data = {'device': DEVICE_ID, 'seq': seq, 'epoca': epoca}
+    if traza:
+        data['trace'] = traza
+        data.update(tiempos or {})
+    try:
+        codigo, _ = _cliente.peticion("POST", "/ack_command", data)
+        return codigo < 300
+    except Exception as e:
+        print(f"Error al confirmar comando: {e}")
+        return False
+
+def poll_server(espera_ms=50):
+    """
+    Pide al servidor si hay algún comando pendiente usando long-poll.
+    La peticion queda abierta en el servidor hasta que haya un comando; cada
+    llamada espera como maximo 'espera_ms' a que llegue la respuesta, para que el
+    hilo de red pueda seguir atendiendo otras tareas. La conexion se reutiliza
+    para el siguiente long-poll. Devuelve el comando, {} o None.
+    """
+    global _poll_inicio, _poll_reintento
+    if not _cliente_poll.esperando:
+        if time.ticks_diff(_poll_reintento, time.ticks_ms()) > 0:
+            time.sleep_ms(espera_ms)
+            return None
+        try:
+            _cliente_poll.enviar("GET", f"/poll_command?device={DEVICE_ID}&espera={ESPERA_LONG_POLL_S}")
+            _poll_inicio = time.ticks_ms()
+        except Exception:
+            # Es normal que esto falle a veces, no se imprime el error.
+            _poll_reintento = time.ticks_add(time.ticks_ms(), PAUSA_REINTENTO_MS)
+            return None
+
+    try:
+        respuesta = _cliente_poll.recibir(espera_ms)
+    except Exception:
+        _poll_reintento = time.ticks_add(time.ticks_ms(), PAUSA_REINTENTO_MS)
+        return None
+    if respuesta is not None:
+        codigo, comando = respuesta
+        return comando if codigo < 300 and comando is not None else {}
 
+    # Si el servidor no respondio en el tiempo esperado, la conexion se da por perdida
+    if time.ticks_diff(time.ticks_ms(), _poll_inicio) > (ESPERA_LONG_POLL_S + 10) * 1000:
+        _cliente_poll.cerrar()
+    return None